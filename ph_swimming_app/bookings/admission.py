@@ -0,0 +1,211 @@
+import functools
+import math
+import threading
+import time
+from django.conf import settings
+from django.contrib import messages
+from django.core import signing
+from django.core.cache import cache
+from django.shortcuts import redirect, render
+from open_hours.capacity import cached_places
+
+"""
+Admission control for guest booking POSTs.
+
+When a popular session opens, guests are let through to the booking write
+at a steady rate instead of all at once:
+
+* requests for a session already known to be full are turned away from
+  the cached capacity, before any database work (joining its waiting
+  list still goes through);
+* up to BURST bookings are admitted in each BURST / RATE second window,
+  so RATE a second on average;
+* everyone else takes a numbered ticket in a bounded queue and is shown a
+  waiting page that resubmits the booking with the signed ticket. A
+  ticket is admitted once the live tickets ahead of it fit in the window's
+  remaining places. A full queue answers 503 straight away.
+
+The window counts and the queue live in the shared cache
+(settings.CACHES), so the limit holds across workers and a ticket works
+on whichever worker the retry lands on. A ticket not seen again within
+twice its retry delay belongs to a guest who left; it stops counting,
+and holding it later means joining the back of the queue.
+"""
+
+TOKEN_FIELD = 'admission_ticket'
+TOKEN_SALT = 'bookings.admission'
+# Signed tickets older than this are not even looked up
+TOKEN_MAX_AGE = 600
+
+WINDOW_KEY = 'bookings:admission:window:{}'
+NEXT_KEY = 'bookings:admission:next'
+HEAD_KEY = 'bookings:admission:head'
+TICKET_KEY = 'bookings:admission:ticket:{}'
+
+
+class Admission:
+    def __init__(self, admitted, ticket=None, position=None, retry_after=None):
+        self.admitted = admitted
+        self.ticket = ticket
+        self.position = position
+        self.retry_after = retry_after
+
+    @property
+    def rejected(self):
+        return not self.admitted and self.ticket is None
+
+
+class AdmissionController:
+    """
+    Fixed-window rate limit in front of a queue of numbered tickets, all
+    kept in the shared cache.
+    """
+
+    def __init__(self, rate=20, burst=40, max_queue=500, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.clock = clock
+        self.window_seconds = burst / rate
+
+    def _window_key(self, now):
+        return WINDOW_KEY.format(int(now // self.window_seconds))
+
+    def _places_left(self, now):
+        return self.burst - cache.get(self._window_key(now), 0)
+
+    def _take_place(self, now):
+        key = self._window_key(now)
+        timeout = math.ceil(self.window_seconds) + 1
+        if cache.add(key, 1, timeout=timeout):
+            return True
+        try:
+            return cache.incr(key) <= self.burst
+        except ValueError:
+            # Expired between the add and the incr
+            return cache.add(key, 1, timeout=timeout)
+
+    def _live_tickets(self, now):
+        """
+        The tickets still waiting, oldest first. Moves the head past the
+        ones that were admitted or abandoned.
+        """
+        bounds = cache.get_many([HEAD_KEY, NEXT_KEY])
+        head, issued = bounds.get(HEAD_KEY, 0), bounds.get(NEXT_KEY, 0)
+        if head >= issued:
+            return []
+        keys = {TICKET_KEY.format(ticket): ticket for ticket in range(head, issued)}
+        live = sorted(keys[key] for key, deadline in cache.get_many(keys).items() if deadline >= now)
+        first = live[0] if live else issued
+        if first > head:
+            cache.set(HEAD_KEY, first, timeout=None)
+        return live
+
+    def _issue(self):
+        cache.add(NEXT_KEY, 0, timeout=None)
+        try:
+            return cache.incr(NEXT_KEY) - 1
+        except ValueError:
+            cache.add(NEXT_KEY, 1, timeout=None)
+            return 0
+
+    def admit(self, ticket=None):
+        """
+        Lets a request through, or queues it. Pass the ticket it was given
+        last time to keep its place.
+        """
+        now = self.clock()
+        live = self._live_tickets(now)
+        if ticket is not None and ticket not in live:
+            # Admitted, abandoned or never issued: join the back of the queue
+            ticket = None
+
+        if ticket is None:
+            if not live and self._take_place(now):
+                return Admission(True)
+            if len(live) >= self.max_queue:
+                return Admission(False)
+            ticket = self._issue()
+            live.append(ticket)
+
+        position = live.index(ticket) + 1
+        if position <= self._places_left(now) and self._take_place(now):
+            cache.delete(TICKET_KEY.format(ticket))
+            return Admission(True)
+        retry_after = max(1, round(position / self.rate))
+        cache.set(TICKET_KEY.format(ticket), now + 2 * retry_after, timeout=2 * retry_after + 1)
+        return Admission(False, ticket, position, retry_after)
+
+    @property
+    def queue_length(self):
+        return len(self._live_tickets(self.clock()))
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController(**getattr(settings, 'BOOKING_ADMISSION', {}))
+    return _controller
+
+
+def sign_ticket(ticket):
+    return signing.dumps({'ticket': ticket}, salt=TOKEN_SALT)
+
+
+def read_ticket(token):
+    try:
+        data = signing.loads(token, salt=TOKEN_SALT, max_age=TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    return data.get('ticket')
+
+
+def admission_control(view):
+    """
+    Puts a guest booking view's POSTs behind the admission controller.
+    Expects the session id in ?session= and the party size in the form.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'POST':
+            return view(request, *args, **kwargs)
+
+        session_id = request.GET.get('session')
+        places = cached_places(session_id) if session_id else None
+        try:
+            wanted = int(request.POST.get('number_of_people') or 1)
+        except ValueError:
+            wanted = 1
+        if places is not None and wanted > places and 'join_waitlist' not in request.POST:
+            messages.error(request, "Sorry, that session does not have enough space left.")
+            return redirect('booking_home')
+
+        controller = get_controller()
+        ticket = read_ticket(request.POST.get(TOKEN_FIELD, ''))
+        admission = controller.admit(ticket)
+        if admission.admitted:
+            return view(request, *args, **kwargs)
+        if admission.rejected:
+            response = render(request, 'bookings/waiting_room.html', {'busy': True}, status=503)
+            response['Retry-After'] = '30'
+            return response
+
+        response = render(request, 'bookings/waiting_room.html', {
+            'position': admission.position,
+            'retry_after': admission.retry_after,
+            'fields': [
+                (key, value) for key, values in request.POST.lists() for value in values
+                if key not in (TOKEN_FIELD, 'csrfmiddlewaretoken')
+            ],
+            'token_field': TOKEN_FIELD,
+            'token': sign_ticket(admission.ticket),
+        }, status=429)
+        response['Retry-After'] = str(admission.retry_after)
+        return response
+    return wrapper
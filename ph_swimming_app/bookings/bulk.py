@@ -0,0 +1,329 @@
+import codecs
+import csv
+import io
+from itertools import islice
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from open_hours.models import Session, SessionOccurrence, slot_label
+from open_hours.events import publish_availability
+from .models import Booking, WaitlistEntry
+
+"""
+Bulk CSV export / import of bookings for staff.
+
+Export streams rows straight from a database cursor. Import reads the file
+in chunks, validates each chunk with a handful of set-based queries and
+inserts it with bulk_create, so a full season file is never held in memory
+and never costs a full_clean() + aggregate per row.
+"""
+
+EXPORT_COLUMNS = [
+    'id', 'caravan_number', 'first_name', 'last_name', 'email', 'number_of_people',
+    'attended', 'booking_date', 'session', 'session_day', 'start_time', 'activity',
+]
+IMPORT_COLUMNS = ['caravan_number', 'first_name', 'last_name', 'email', 'number_of_people', 'session']
+IMPORT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+
+
+class Echo:
+    """
+    File-like object whose write() just hands the line back to csv.writer.
+    """
+
+    def write(self, value):
+        return value
+
+
+def _export_values(day=None, activity=None, session=None):
+    """
+    The export rows; the filters must already be validated (see
+    forms.BookingExportForm), as the query only runs once streaming starts.
+    """
+    bookings = Booking.objects.order_by('session__session_day', 'session__start_time', 'id')
+    if day:
+        bookings = bookings.filter(session__session_day=day)
+    if activity:
+        bookings = bookings.filter(session__activity_id=activity)
+    if session:
+        bookings = bookings.filter(session_id=session)
+    return bookings.values_list(
+        'id', 'caravan_number', 'first_name', 'last_name', 'email', 'number_of_people',
+        'attended', 'booking_date', 'session_id', 'session__session_day', 'session__start_time',
+        'session__activity__activity_name',
+    )
+
+
+def _export_line(writer, row):
+    # start_time as HH:MM, as staff type it
+    return writer.writerow(row[:10] + (slot_label(row[10]),) + row[11:])
+
+
+def export_rows(day=None, activity=None, session=None, chunk_size=2000):
+    """
+    Yields the CSV export line by line, header first.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in _export_values(day, activity, session).iterator(chunk_size=chunk_size):
+        yield _export_line(writer, row)
+
+
+async def aexport_rows(day=None, activity=None, session=None, chunk_size=2000):
+    """
+    export_rows for the ASGI server. Django reads a sync iterator there
+    with sync_to_async(list), building the whole file before sending it;
+    this fetches one chunk at a time in a worker thread instead.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    rows = _export_values(day, activity, session).iterator(chunk_size=chunk_size)
+    # Always the same thread, which holds the cursor between chunks
+    next_chunk = sync_to_async(lambda: list(islice(rows, chunk_size)), thread_sensitive=True)
+    while chunk := await next_chunk():
+        for row in chunk:
+            yield _export_line(writer, row)
+
+
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"Line {line}: {message}")
+
+
+def _parse_row(row):
+    """
+    Cheap per-row checks that need no database access.
+    """
+    missing = [column for column in IMPORT_COLUMNS if not (row.get(column) or '').strip()]
+    if missing:
+        raise ValidationError(f"missing {', '.join(missing)}")
+    try:
+        people = int(row['number_of_people'])
+        session_id = int(row['session'])
+    except ValueError:
+        raise ValidationError("number_of_people and session must be whole numbers")
+    if people < 1:
+        raise ValidationError("number_of_people must be at least 1")
+    caravan = row['caravan_number'].strip()
+    if len(caravan) > 6:
+        raise ValidationError("caravan_number is longer than 6 characters")
+    validate_email(row['email'].strip())
+    return Booking(
+        caravan_number=caravan,
+        first_name=row['first_name'].strip()[:50],
+        last_name=row['last_name'].strip()[:50],
+        email=row['email'].strip(),
+        session_id=session_id,
+        number_of_people=people,
+        attended=(row.get('attended') or '').strip().lower() in ('1', 'true', 'yes'),
+    )
+
+
+def _import_chunk(rows, result, seen_caravans):
+    parsed = []
+    for line, row in rows:
+        try:
+            parsed.append((line, _parse_row(row)))
+        except ValidationError as e:
+            result.reject(line, " ".join(e.messages))
+    if not parsed:
+        return
+
+    try:
+        rejected, accepted = _save_chunk(parsed, seen_caravans)
+    except IntegrityError:
+        # A booking for one of these caravans was saved after the check;
+        # the rerun sees it and rejects that row
+        try:
+            rejected, accepted = _save_chunk(parsed, seen_caravans)
+        except IntegrityError:
+            # Raced again; give up on this chunk rather than the whole import
+            rejected = [
+                (line, "could not be saved while other bookings were being made; import it again")
+                for line, _ in parsed
+            ]
+            accepted = []
+    for line, message in rejected:
+        result.reject(line, message)
+    seen_caravans.update(booking.caravan_number for booking in accepted)
+    result.created += len(accepted)
+
+
+def _save_chunk(parsed, seen_caravans):
+    """
+    Checks and inserts one chunk in a single transaction. Returns the
+    rejected (line, message) pairs and the bookings created.
+    """
+    with transaction.atomic():
+        caravans = [booking.caravan_number for _, booking in parsed]
+        taken = set(Booking.objects.filter(caravan_number__in=caravans).values_list('caravan_number', flat=True))
+
+        # Like Booking.save(), imported bookings are for each session's next
+        # run. Lock those runs, then check capacity in memory.
+        session_ids = {booking.session_id for _, booking in parsed}
+        sessions = Session.objects.filter(pk__in=session_ids, activity__isnull=False)
+        occurrence_ids = {session.pk: SessionOccurrence.next_for(session).pk for session in sessions}
+        remaining = {
+            occurrence.session_id: occurrence.available_places
+            for occurrence in SessionOccurrence.objects.select_for_update(of=('self',))
+            .select_related('activity')
+            .filter(pk__in=occurrence_ids.values())
+        }
+
+        accepted = []
+        rejected = []
+        chunk_caravans = set()
+        taken_places = {}
+        for line, booking in parsed:
+            caravan = booking.caravan_number
+            if caravan in taken or caravan in seen_caravans or caravan in chunk_caravans:
+                rejected.append((line, f"caravan {caravan} already has a booking"))
+            elif booking.session_id not in remaining:
+                rejected.append((line, f"session {booking.session_id} does not exist"))
+            elif booking.number_of_people > remaining[booking.session_id]:
+                rejected.append((line, f"session {booking.session_id} does not have enough space"))
+            else:
+                remaining[booking.session_id] -= booking.number_of_people
+                taken_places[booking.session_id] = taken_places.get(booking.session_id, 0) + booking.number_of_people
+                chunk_caravans.add(caravan)
+                accepted.append(booking)
+
+        for booking in accepted:
+            booking.occurrence_id = occurrence_ids[booking.session_id]
+
+        Booking.objects.bulk_create(accepted)
+        for session_id, people in taken_places.items():
+            Session.objects.filter(pk=session_id).update(booked_number=F('booked_number') + people)
+            SessionOccurrence.objects.filter(pk=occurrence_ids[session_id]).update(
+                booked_number=F('booked_number') + people
+            )
+        transaction.on_commit(lambda: publish_availability(list(taken_places)))
+    return rejected, accepted
+
+
+def import_bookings(csv_file, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Imports bookings from an uploaded CSV file. Rows that are invalid, reuse
+    a caravan number or do not fit in their session are reported and skipped.
+    """
+    result = ImportResult()
+    _check_utf8(csv_file)
+    text = io.TextIOWrapper(csv_file, encoding='utf-8-sig', newline='')
+    try:
+        reader = csv.DictReader(text)
+        missing = [column for column in IMPORT_COLUMNS if column not in (reader.fieldnames or [])]
+    except csv.Error as e:
+        raise ValidationError(f"The file could not be read as CSV: {e}")
+    if missing:
+        raise ValidationError(f"The file is missing the columns: {', '.join(missing)}")
+
+    # Header is line 1, so data rows start at line 2
+    numbered = enumerate(reader, start=2)
+    seen_caravans = set()
+    while True:
+        chunk = []
+        broken = None
+        try:
+            chunk.extend(islice(numbered, chunk_size))
+        except csv.Error as e:
+            # extend() keeps the rows read before the broken one
+            broken = e
+        if chunk:
+            _import_chunk(chunk, result, seen_caravans)
+        if broken:
+            result.reject(reader.line_num, f"could not be read as CSV ({broken}); the rest of the file was skipped")
+            break
+        if len(chunk) < chunk_size:
+            break
+    return result
+
+
+def _check_utf8(csv_file, block_size=64 * 1024):
+    """
+    Reads the upload once to make sure it is UTF-8 before any row is
+    imported, then rewinds it.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for block in iter(lambda: csv_file.read(block_size), b''):
+            decoder.decode(block)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        raise ValidationError("The file is not UTF-8 text. Save it as \"CSV UTF-8\" and upload it again.")
+    finally:
+        csv_file.seek(0)
+
+
+BATCH_ACTIONS = ('attend', 'release')
+
+
+def apply_session_actions(session, items):
+    """
+    Applies a list of {"booking_id", "action"} items to one session's
+    bookings in a single transaction: one locked read, one bulk_update for
+    attendance, one delete() for releases, one counter update per
+    occurrence and one waitlist promotion.
+    Returns a result per item, in the order given.
+    """
+    booking_ids = []
+    for item in items:
+        try:
+            booking_ids.append(int(item.get('booking_id')))
+        except (TypeError, ValueError):
+            pass
+
+    results = []
+    with transaction.atomic():
+        bookings = {
+            booking.pk: booking
+            for booking in Booking.objects.select_for_update().filter(session=session, pk__in=booking_ids)
+        }
+        attended = {}
+        released = {}
+        for item in items:
+            booking_id = item.get('booking_id')
+            action = item.get('action')
+            try:
+                booking = bookings.get(int(booking_id))
+            except (TypeError, ValueError):
+                booking = None
+            if booking is None:
+                results.append({'booking_id': booking_id, 'status': 'error', 'message': 'Booking not found.'})
+            elif action not in BATCH_ACTIONS:
+                results.append({'booking_id': booking_id, 'status': 'error', 'message': f'Unknown action "{action}".'})
+            elif booking.pk in released:
+                results.append({'booking_id': booking_id, 'status': 'error', 'message': 'Booking already released.'})
+            elif action == 'attend':
+                booking.attended = True
+                attended[booking.pk] = booking
+                results.append({'booking_id': booking.pk, 'status': 'success',
+                                'message': f'Booking for {booking.first_name} marked as attended.'})
+            else:
+                attended.pop(booking.pk, None)
+                released[booking.pk] = booking
+                results.append({'booking_id': booking.pk, 'status': 'success',
+                                'message': f'Booking for {booking.first_name} released.'})
+
+        if attended:
+            Booking.objects.bulk_update(attended.values(), ['attended'])
+        if released:
+            Booking.objects.filter(pk__in=released).delete()
+            by_occurrence = {}
+            for booking in released.values():
+                by_occurrence[booking.occurrence_id] = by_occurrence.get(booking.occurrence_id, 0) + booking.number_of_people
+            for occurrence_id, people in by_occurrence.items():
+                Session.release_places(session.pk, people, occurrence_id)
+            WaitlistEntry.promote(session.pk)
+            transaction.on_commit(lambda: publish_availability([session.pk]))
+
+    return results
@@ -1,11 +1,11 @@
 from django import forms
 from .models import Booking
-from open_hours.models import Session
+from open_hours.models import Activity, Session, DAY_CHOICES
 
 class GuestBookingForm(forms.ModelForm):
     class Meta:
         model = Booking
-        fields = ['first_name', 'last_name', 'email', 'number_of_people']
+        fields = ['caravan_number', 'first_name', 'last_name', 'email', 'number_of_people']
         exclude = ('session',)
 
 
@@ -17,5 +17,38 @@ class StaffBookingForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         locked_session = kwargs.pop('locked_session', False)
         super().__init__(*args, **kwargs)
+        # Each option's label names the activity, so fetch them together
+        self.fields["session"].queryset = Session.objects.select_related("activity")
         if locked_session:
-            self.fields["session"].widget = forms.HiddenInput()
\ No newline at end of file
+            self.fields["session"].widget = forms.HiddenInput()
+
+
+class GuestLookupForm(forms.Form):
+    caravan_number = forms.CharField(max_length=6)
+    email = forms.EmailField(help_text="The email address you booked with.")
+
+    def clean_caravan_number(self):
+        return self.cleaned_data["caravan_number"].strip()
+
+
+class BookingExportForm(forms.Form):
+    day = forms.ChoiceField(choices=[("", "All")] + DAY_CHOICES, required=False)
+    activity = forms.IntegerField(required=False, min_value=1)
+    session = forms.IntegerField(required=False, min_value=1)
+
+
+class BookingImportForm(forms.Form):
+    csv_file = forms.FileField(label="Bookings CSV")
+
+
+class OccupancyReportForm(forms.Form):
+    activity = forms.ModelChoiceField(queryset=Activity.objects.exclude(activity_name="Lunch"), required=False)
+    days = forms.MultipleChoiceField(choices=DAY_CHOICES, required=False, widget=forms.CheckboxSelectMultiple)
+    start = forms.DateField(required=False, label="From", widget=forms.DateInput(attrs={"type": "date"}))
+    end = forms.DateField(required=False, label="To", widget=forms.DateInput(attrs={"type": "date"}))
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get("start") and cleaned_data.get("end") and cleaned_data["start"] > cleaned_data["end"]:
+            raise forms.ValidationError("The start date must be on or before the end date.")
+        return cleaned_data
@@ -0,0 +1,253 @@
+import multiprocessing
+import random
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import F, Sum
+from django.test import Client
+from django.test.utils import setup_test_environment
+from django.urls import reverse
+from django.utils.http import int_to_base36
+from bookings.models import Booking
+from open_hours.models import Activity, Session, SessionOccurrence, DAY_CHOICES, SESSION_TIMES, end_of
+
+"""
+Local load generator for the booking flow.
+
+Runs against a throwaway test database (created and destroyed by the
+command), so it is safe to point at a laptop's SQLite or local Postgres
+settings. Workers drive the real views through Django's test client;
+on SQLite they take turns, so only Postgres shows contention.
+
+Guest bookings go through admission control and idempotency like real
+ones, so each operation's responses are reported by status code, and
+only redirects to the success page count as bookings made.
+"""
+
+OPERATIONS = {
+    'guest_booking': 4,
+    'staff_release': 1,
+    'timetable_read': 3,
+    'get_sessions': 4,
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def caravan_number(worker, workers, made):
+    """
+    A caravan number no other worker uses: the bookings are numbered
+    round-robin across workers, in base 36 to fit the 6-character field.
+    """
+    return int_to_base36(made * workers + worker).rjust(6, '0')
+
+
+def run_worker(worker, workers, duration, seed, session_ids, activity_ids, staff_id):
+    """
+    Hammers the views until `duration` seconds have passed and returns
+    {operation: [latency in ms, ...]}, an error count and a Counter of
+    status codes per operation, and the number of bookings made.
+    """
+    rng = random.Random(seed + worker)
+    guest = Client()
+    staff = Client()
+    staff_logged_in = False
+    names = list(OPERATIONS)
+    weights = [OPERATIONS[name] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    statuses = {name: Counter() for name in names}
+    success_url = reverse('booking_success')
+    made = booked = 0
+
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        operation = rng.choices(names, weights)[0]
+        session_id = rng.choice(session_ids)
+        started = time.perf_counter()
+        try:
+            if operation == 'guest_booking':
+                made += 1
+                response = guest.post(
+                    reverse('make_booking') + f'?session={session_id}',
+                    {
+                        'caravan_number': caravan_number(worker, workers, made),
+                        'first_name': 'Load',
+                        'last_name': 'Test',
+                        'email': f'load{worker}-{made}@example.com',
+                        'number_of_people': rng.randint(1, 4),
+                    },
+                )
+                # A 429 from the waiting room or a full session's redirect is not a booking
+                if response.status_code == 302 and response.url == success_url:
+                    booked += 1
+            elif operation == 'staff_release':
+                if not staff_logged_in:
+                    # Here, so a failed login counts as an error and is retried
+                    staff.force_login(User.objects.get(pk=staff_id))
+                    staff_logged_in = True
+                booking_id = (
+                    Booking.objects.filter(session_id=session_id).values_list('id', flat=True).first()
+                )
+                started = time.perf_counter()
+                response = staff.post(
+                    reverse('session_bookings', args=[session_id]),
+                    {'booking_id': booking_id or 0, 'action': 'release'},
+                )
+            elif operation == 'timetable_read':
+                response = guest.get(reverse('home'))
+            else:
+                response = guest.get(reverse('get_sessions', args=[rng.choice(activity_ids)]))
+            statuses[operation][response.status_code] += 1
+            if response.status_code >= 500:
+                errors[operation] += 1
+        except Exception:
+            errors[operation] += 1
+        latencies[operation].append((time.perf_counter() - started) * 1000)
+
+    connections.close_all()
+    return latencies, errors, statuses, booked
+
+
+class Command(BaseCommand):
+    help = 'Load-tests guest booking, staff release and timetable reads against a temporary database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent workers.')
+        parser.add_argument(
+            '--mode', choices=['threads', 'processes'], default='threads',
+            help='Run workers as threads or as separate processes.',
+        )
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run for.')
+        parser.add_argument('--capacity', type=int, default=20, help='Places per session.')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed.')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['duration'] <= 0:
+            raise CommandError('--workers and --duration must be positive.')
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def seed(self, capacity):
+        activities = [
+            Activity.objects.create(activity_name=name, description='Load test', max_number=capacity, price=5)
+            for name in ('Aqua Aerobics', 'Swim School', 'Lane Swimming')
+        ]
+        sessions = Session.objects.bulk_create([
+            Session(
+                activity=activities[i % len(activities)], session_day=day, start_time=slot,
+                end_time=end_of(slot, activities[i % len(activities)].duration),
+            )
+            for i, ((day, _), slot) in enumerate(
+                (day, slot) for day in DAY_CHOICES for slot in SESSION_TIMES
+            )
+        ])
+        staff = User.objects.create_user('loadtest-staff', password='unused', is_staff=True)
+        return [session.pk for session in sessions], [activity.pk for activity in activities], staff.pk
+
+    def run(self, options):
+        session_ids, activity_ids, staff_id = self.seed(options['capacity'])
+        workers = options['workers']
+        # SQLite takes one writer at a time and Django 4.2 starts its
+        # transactions deferred, so concurrent workers would mostly measure
+        # "database is locked". There they run one after another, sharing the time.
+        sequential = connection.vendor == 'sqlite'
+        duration = options['duration'] / workers if sequential else options['duration']
+        worker_args = [
+            (worker, workers, duration, options['seed'], session_ids, activity_ids, staff_id)
+            for worker in range(workers)
+        ]
+
+        if sequential:
+            self.stdout.write(self.style.WARNING(
+                f"SQLite: running {workers} workers one at a time, {duration:.1f}s each. "
+                "Use Postgres to measure contention."
+            ))
+            started = time.monotonic()
+            results = [run_worker(*args) for args in worker_args]
+            self.report(results, time.monotonic() - started)
+            return
+
+        self.stdout.write(
+            f"Running {workers} {options['mode']} for {options['duration']:.0f}s on {connection.vendor}..."
+        )
+        if options['mode'] == 'processes':
+            # Forked workers inherit the set-up Django and the test database
+            # settings; spawned ones would start from scratch
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                raise CommandError('--mode processes needs the fork start method; use --mode threads here.')
+            # Each process opens its own database connection after the fork
+            connections.close_all()
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers)
+
+        started = time.monotonic()
+        with pool:
+            results = list(pool.map(run_worker, *zip(*worker_args)))
+        elapsed = time.monotonic() - started
+
+        self.report(results, elapsed)
+
+    def report(self, results, elapsed):
+        latencies = {name: [] for name in OPERATIONS}
+        errors = {name: 0 for name in OPERATIONS}
+        statuses = {name: Counter() for name in OPERATIONS}
+        booked = 0
+        for worker_latencies, worker_errors, worker_statuses, worker_booked in results:
+            for name in OPERATIONS:
+                latencies[name] += worker_latencies[name]
+                errors[name] += worker_errors[name]
+                statuses[name] += worker_statuses[name]
+            booked += worker_booked
+
+        every = [value for values in latencies.values() for value in values]
+        self.stdout.write(f"\n{'operation':<16}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for name in list(OPERATIONS) + ['all']:
+            values = every if name == 'all' else latencies[name]
+            error_count = sum(errors.values()) if name == 'all' else errors[name]
+            self.stdout.write(
+                f"{name:<16}{len(values):>8}{error_count:>8}"
+                f"{percentile(values, 50):>10.1f}{percentile(values, 95):>10.1f}{percentile(values, 99):>10.1f}"
+            )
+        self.stdout.write(f"\nThroughput: {len(every) / elapsed:.1f} requests/s over {elapsed:.1f}s")
+
+        self.stdout.write("\nResponses by status code:")
+        for name in OPERATIONS:
+            codes = ', '.join(f"{code}: {count}" for code, count in sorted(statuses[name].items())) or '-'
+            self.stdout.write(f"  {name:<16}{codes}")
+        self.stdout.write(f"Bookings made: {booked} of {len(latencies['guest_booking'])} guest booking attempts")
+
+        # Capacity is per dated run, so that is where overselling would show
+        oversold = SessionOccurrence.objects.filter(booked_number__gt=F('activity__max_number')).count()
+        actual = {
+            row['occurrence_id']: row['total']
+            for row in Booking.objects.values('occurrence_id').annotate(total=Sum('number_of_people')).order_by()
+        }
+        occurrences = SessionOccurrence.objects.select_related('activity').filter(activity__isnull=False)
+        overbooked = sum(
+            1 for occurrence in occurrences if actual.get(occurrence.pk, 0) > occurrence.activity.max_number
+        )
+        drifted = sum(
+            1 for pk, booked_number in SessionOccurrence.objects.values_list('pk', 'booked_number')
+            if booked_number != actual.get(pk, 0)
+        )
+        style = self.style.SUCCESS if not (oversold or overbooked or drifted) else self.style.ERROR
+        self.stdout.write(style(
+            f"Oversold runs: {max(oversold, overbooked)} | counter drift: {drifted} runs"
+        ))
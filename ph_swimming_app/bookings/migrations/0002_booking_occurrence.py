@@ -0,0 +1,50 @@
+# Generated by Django 4.2.24 on 2026-10-18 13:26
+
+from datetime import timedelta
+from django.db import migrations, models
+from django.db.models import Sum
+from django.utils import timezone
+import django.db.models.deletion
+
+DAY_CODES = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+
+def attach_to_next_occurrence(apps, schema_editor):
+    """
+    Existing bookings are for the next run of their weekly session.
+    """
+    Booking = apps.get_model('bookings', 'Booking')
+    Session = apps.get_model('open_hours', 'Session')
+    SessionOccurrence = apps.get_model('open_hours', 'SessionOccurrence')
+    today = timezone.localdate()
+
+    booked = Booking.objects.values('session_id').annotate(total=Sum('number_of_people')).order_by()
+    for row in booked:
+        session = Session.objects.get(pk=row['session_id'])
+        if session.session_day not in DAY_CODES:
+            continue
+        days_ahead = (DAY_CODES.index(session.session_day) - today.weekday()) % 7
+        occurrence, _ = SessionOccurrence.objects.get_or_create(
+            session=session,
+            date=today + timedelta(days=days_ahead),
+            defaults={'activity_id': session.activity_id, 'start_time': session.start_time},
+        )
+        SessionOccurrence.objects.filter(pk=occurrence.pk).update(booked_number=row['total'])
+        Booking.objects.filter(session=session).update(occurrence=occurrence)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_hours', '0013_session_occurrence'),
+        ('bookings', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='occurrence',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='open_hours.sessionoccurrence'),
+        ),
+        migrations.RunPython(attach_to_next_occurrence, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.24 on 2026-10-18 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0002_booking_occurrence'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['session', 'attended'], name='booking_session_attended_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['email'], name='booking_email_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.24 on 2026-10-18 13:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_hours', '0017_activity_image_variants'),
+        ('bookings', '0003_booking_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaitlistEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('caravan_number', models.CharField(max_length=6)),
+                ('first_name', models.CharField(max_length=50)),
+                ('last_name', models.CharField(max_length=50)),
+                ('email', models.EmailField(max_length=254)),
+                ('number_of_people', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='waitlist', to='open_hours.session')),
+            ],
+            options={
+                'verbose_name_plural': 'waitlist entries',
+                'indexes': [models.Index(fields=['session', 'id'], name='waitlist_session_order_idx')],
+                'unique_together': {('session', 'caravan_number')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.24 on 2026-10-18 14:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0004_waitlist'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['caravan_number', 'email', 'occurrence', 'session', 'number_of_people', 'id'], name='booking_guest_lookup_idx'),
+        ),
+    ]
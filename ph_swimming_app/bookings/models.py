@@ -1,7 +1,11 @@
 # bookings/models.py
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.forms import ValidationError
+from open_hours.models import Session, SessionOccurrence, next_run_date, slot_label
+from open_hours.events import publish_availability
 
 class Booking(models.Model):
     caravan_number = models.CharField(max_length=6, unique=True)
@@ -12,25 +16,212 @@ class Booking(models.Model):
     number_of_people = models.PositiveIntegerField()
     booking_date = models.DateField(auto_now_add=True)
     attended = models.BooleanField(default=False)
-        
+
+    # The dated run this booking is for; filled in with the session's next occurrence on save
+    occurrence = models.ForeignKey('open_hours.SessionOccurrence', on_delete=models.CASCADE, null=True, blank=True)
+
+    # Set by the staff view when a superuser books over capacity
+    override_capacity = False
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what the counters currently hold for this booking
+        instance._ledger = (
+            instance.__dict__.get('session_id'),
+            instance.__dict__.get('number_of_people'),
+            instance.__dict__.get('occurrence_id'),
+        )
+        return instance
+
     def clean(self):
-        if self.session and self.number_of_people:
-            total_after_booking = (self.session.booked_number + self.number_of_people)
+        if self.session_id and self.session.activity is None:
+            raise ValidationError("This session is not open for booking.")
+        if self.session_id and self.number_of_people and not self.override_capacity:
+            previous_session, previous_people, previous_occurrence = getattr(self, '_ledger', (None, None, None))
+            if previous_session == self.session_id and previous_occurrence:
+                # Staying on the run it already holds places on
+                already_counted = previous_people
+                booked = SessionOccurrence.objects.filter(pk=previous_occurrence).values_list(
+                    'booked_number', flat=True
+                ).first() or 0
+            else:
+                already_counted = 0
+                booked = self.session.people_booked
+            total_after_booking = (booked - already_counted + self.number_of_people)
             if total_after_booking > self.session.activity.max_number:
                 raise ValidationError(f"Sorry, this session does not have enough space. {self.session.activity.max_number} people for this session.")
-        
+
     def save(self, *args, **kwargs):
-        self.full_clean()
-        super().save(*args, **kwargs)
+        self.full_clean(exclude=['occurrence'])
+        previous_session, previous_people, previous_occurrence = getattr(self, '_ledger', (None, None, None))
+
+        with transaction.atomic():
+            if self.occurrence_id is None or (previous_session and previous_session != self.session_id):
+                self.occurrence = SessionOccurrence.next_for(self.session)
 
-        # Update the booked number in the session
-        self.session.booked_number = (
-            self.session.booking_set.aggregate(total=models.Sum('number_of_people'))['total'] or 0
+            same_slot = (previous_session == self.session_id and previous_occurrence == self.occurrence_id)
+            if same_slot:
+                # Lock the run and take the new places before giving back the old ones
+                extra = self.number_of_people - previous_people
+                if extra > 0:
+                    self._reserve(extra)
+                elif extra < 0:
+                    Session.release_places(self.session_id, -extra, self.occurrence_id)
+            else:
+                self._reserve(self.number_of_people)
+                if previous_session:
+                    Session.release_places(previous_session, previous_people, previous_occurrence)
+            super().save(*args, **kwargs)
+            if previous_session and (not same_slot or self.number_of_people < previous_people):
+                WaitlistEntry.promote(previous_session)
+            if not same_slot or previous_people != self.number_of_people:
+                touched = {self.session_id, previous_session} - {None}
+                transaction.on_commit(lambda: publish_availability(touched))
+
+        self._ledger = (self.session_id, self.number_of_people, self.occurrence_id)
+
+    @classmethod
+    def upcoming_for_guest(cls, caravan_number, email):
+        """
+        A party's bookings from today on, with session, activity and date,
+        in one query served by booking_guest_lookup_idx.
+        """
+        return (
+            cls.objects.filter(
+                caravan_number=caravan_number, email=email, occurrence__date__gte=timezone.localdate()
+            )
+            .select_related('session__activity', 'occurrence')
+            .only(
+                'id', 'caravan_number', 'email', 'number_of_people', 'session', 'occurrence',
+                'session__session_day', 'session__start_time', 'session__end_time',
+                'session__activity__activity_name', 'occurrence__date',
+            )
+            .order_by('occurrence__date', 'session__start_time')
         )
-        self.session.save()
+
+    def _reserve(self, number):
+        if not Session.reserve_places(self.session_id, number, self.override_capacity, self.occurrence_id):
+            raise ValidationError("Sorry, this session does not have enough space.")
+
+    def delete(self, *args, **kwargs):
+        counted_session, counted_people, counted_occurrence = getattr(self, '_ledger', (None, None, None))
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            if counted_session:
+                Session.release_places(counted_session, counted_people, counted_occurrence)
+                WaitlistEntry.promote(counted_session)
+                transaction.on_commit(lambda: publish_availability([counted_session]))
+        self._ledger = (None, None, None)
+        return result
 
     def __str__(self):
-        return f"Booking for {self.first_name} {self.last_name} on {self.session.session_day} at {self.session.start_time}"
+        return f"Booking for {self.first_name} {self.last_name} on {self.session.session_day} at {slot_label(self.session.start_time)}"
 
     class Meta:
         verbose_name_plural = "bookings"
+        indexes = [
+            # Session bookings page and attendance counts
+            models.Index(fields=['session', 'attended'], name='booking_session_attended_idx'),
+            # Looking a guest up by email
+            models.Index(fields=['email'], name='booking_email_idx'),
+            # upcoming_for_guest: every booking column it reads is in the
+            # index. Key columns rather than INCLUDE, so SQLite covers it too.
+            models.Index(
+                fields=['caravan_number', 'email', 'occurrence', 'session', 'number_of_people', 'id'],
+                name='booking_guest_lookup_idx',
+            ),
+        ]
+
+
+
+class WaitlistEntry(models.Model):
+    """
+    A party waiting for places on a full session, served in arrival order.
+    """
+    caravan_number = models.CharField(max_length=6)
+    first_name = models.CharField(max_length=50)
+    last_name = models.CharField(max_length=50)
+    email = models.EmailField()
+    session = models.ForeignKey('open_hours.Session', on_delete=models.CASCADE, related_name='waitlist')
+    number_of_people = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def promote(cls, session_id):
+        """
+        Turns the earliest waiting parties that fit into bookings. Called
+        inside the transaction that freed the places; reads at most as
+        many entries as there are free places, since each party needs one.
+        Returns the new bookings.
+        """
+        session = (
+            Session.objects.select_for_update(of=('self',))
+            .select_related('activity')
+            .get(pk=session_id)
+        )
+        if not session.activity:
+            return []
+        # Places are per run; the queue is served onto the next one
+        occurrence = (
+            SessionOccurrence.objects.select_for_update(of=('self',))
+            .select_related('activity')
+            .filter(session=session, date=next_run_date(session.session_day, session.end_time))
+            .first()
+        ) or SessionOccurrence.next_for(session)
+        places_left = occurrence.available_places
+        if places_left <= 0:
+            return []
+
+        candidates = list(
+            cls.objects.select_for_update()
+            .filter(session_id=session_id, number_of_people__lte=places_left)
+            .order_by('id')[:places_left]
+        )
+        if not candidates:
+            return []
+        booked = set(
+            Booking.objects.filter(caravan_number__in=[entry.caravan_number for entry in candidates])
+            .values_list('caravan_number', flat=True)
+        )
+
+        promoted = []
+        finished = []
+        for entry in candidates:
+            if entry.caravan_number in booked:
+                # Booked something else meanwhile; a caravan holds one booking
+                finished.append(entry.pk)
+            elif entry.number_of_people <= places_left:
+                places_left -= entry.number_of_people
+                booked.add(entry.caravan_number)
+                finished.append(entry.pk)
+                promoted.append(Booking(
+                    caravan_number=entry.caravan_number,
+                    first_name=entry.first_name,
+                    last_name=entry.last_name,
+                    email=entry.email,
+                    session_id=session_id,
+                    number_of_people=entry.number_of_people,
+                ))
+        cls.objects.filter(pk__in=finished).delete()
+        if not promoted:
+            return []
+
+        for booking in promoted:
+            booking.occurrence = occurrence
+        Booking.objects.bulk_create(promoted)
+        people = sum(booking.number_of_people for booking in promoted)
+        Session.objects.filter(pk=session_id).update(booked_number=F('booked_number') + people)
+        SessionOccurrence.objects.filter(pk=occurrence.pk).update(booked_number=F('booked_number') + people)
+        return promoted
+
+    def __str__(self):
+        return f"{self.first_name} {self.last_name} waiting for {self.session}"
+
+    class Meta:
+        verbose_name_plural = "waitlist entries"
+        unique_together = ('session', 'caravan_number')
+        indexes = [
+            # promote(): a session's queue in arrival order
+            models.Index(fields=['session', 'id'], name='waitlist_session_order_idx'),
+        ]
@@ -1,3 +1,1235 @@
-from django.test import TestCase
+import json
+import os
+import re
+import shutil
+import tempfile
+from io import StringIO
+from datetime import timedelta
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, router, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from open_hours.models import Activity, Session, SessionOccurrence, IdempotencyKey
+from open_hours.capacity import cached_places, remember_places
+from ph_swimming_app.db_router import PIN_COOKIE, use_replica
+from ph_swimming_app.middleware.replica_middleware import ReplicaPinningMiddleware
+from .admission import AdmissionController, TOKEN_FIELD
+from . import views
+from .bulk import import_bookings
+from .models import Booking, WaitlistEntry
 
-# Create your tests here.
+
+# Query counts measure a view's own database work. Deployed, the cache is
+# Redis (settings.CACHES) and costs no queries; an in-process cache stands
+# in for it here.
+IN_PROCESS_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def make_booking(session, caravan, people=2):
+    booking = Booking(
+        caravan_number=caravan,
+        first_name="Guest",
+        last_name=caravan,
+        email=f"{caravan}@example.com",
+        session=session,
+        number_of_people=people,
+    )
+    booking.save()
+    return booking
+
+
+class CapacityLedgerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.activity = Activity.objects.create(
+            activity_name="Aqua Aerobics", description="Fun", max_number=5, price=5
+        )
+        self.session = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+
+    def booked(self):
+        self.session.refresh_from_db()
+        return self.session.booked_number
+
+    def test_create_and_delete_update_counter(self):
+        booking = make_booking(self.session, "A1", 3)
+        self.assertEqual(self.booked(), 3)
+        booking.delete()
+        self.assertEqual(self.booked(), 0)
+
+    def test_over_capacity_is_rejected(self):
+        make_booking(self.session, "A1", 4)
+        with self.assertRaises(ValidationError):
+            make_booking(self.session, "A2", 2)
+        self.assertEqual(self.booked(), 4)
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_stale_session_cannot_oversell(self):
+        stale = Session.objects.get(pk=self.session.pk)
+        make_booking(self.session, "A1", 4)
+        # The in-memory counter on `stale` still reads 0, the locked check must not
+        with self.assertRaises(ValidationError):
+            make_booking(stale, "A2", 2)
+        self.assertEqual(self.booked(), 4)
+
+    def test_resave_does_not_double_count(self):
+        booking = make_booking(self.session, "A1", 2)
+        booking.attended = True
+        booking.save()
+        self.assertEqual(self.booked(), 2)
+        booking.number_of_people = 5
+        booking.save()
+        self.assertEqual(self.booked(), 5)
+
+    def test_moving_session_moves_places(self):
+        other = Session.objects.create(activity=self.activity, session_day="Tue", start_time="09:00")
+        booking = make_booking(self.session, "A1", 2)
+        booking.session = other
+        booking.save()
+        self.assertEqual(self.booked(), 0)
+        other.refresh_from_db()
+        self.assertEqual(other.booked_number, 2)
+
+    def test_override_skips_capacity(self):
+        booking = Booking(
+            caravan_number="A1", first_name="A", last_name="B", email="a@example.com",
+            session=self.session, number_of_people=7,
+        )
+        booking.override_capacity = True
+        booking.save()
+        self.assertEqual(self.booked(), 7)
+
+    def test_release_and_cancel_views_free_places(self):
+        staff = User.objects.create_user("staff", password="pw", is_staff=True)
+        self.client.force_login(staff)
+        first = make_booking(self.session, "A1", 2)
+        second = make_booking(self.session, "A2", 2)
+
+        self.client.post(reverse("session_bookings", args=[self.session.id]),
+                         {"booking_id": first.id, "action": "release"})
+        self.assertEqual(self.booked(), 2)
+
+        self.client.post(reverse("cancel_booking", args=[second.id]))
+        self.assertEqual(self.booked(), 0)
+
+    def test_guest_booking_view_takes_places(self):
+        response = self.client.post(
+            reverse("make_booking") + f"?session={self.session.id}",
+            {"caravan_number": "A1", "first_name": "A", "last_name": "B",
+             "email": "a@example.com", "number_of_people": 3},
+        )
+        self.assertRedirects(response, reverse("booking_success"))
+        self.assertEqual(self.booked(), 3)
+
+    def test_empty_slot_is_not_open_for_booking(self):
+        empty = Session.objects.create(activity=None, session_day="Tue", start_time="10:00")
+        url = reverse("make_booking") + f"?session={empty.id}"
+        self.assertEqual(self.client.get(url).status_code, 200)
+        response = self.client.post(url, {
+            "caravan_number": "A1", "first_name": "A", "last_name": "B",
+            "email": "a@example.com", "number_of_people": 1,
+        })
+        self.assertContains(response, "This session is not open for booking.")
+        self.assertFalse(Booking.objects.exists())
+
+
+@override_settings(CACHES=IN_PROCESS_CACHE)
+class GetSessionsApiTests(TestCase):
+    def setUp(self):
+        self.activity = Activity.objects.create(
+            activity_name="Aqua Aerobics", description="Fun", max_number=4, price=5
+        )
+
+    def add_sessions(self, count):
+        days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+        times = ["09:00", "10:00", "11:00", "12:00"]
+        slots = [(day, time) for day in days for time in times]
+        used = Session.objects.count()
+        return [
+            Session.objects.create(activity=self.activity, session_day=day, start_time=time)
+            for day, time in slots[used:used + count]
+        ]
+
+    def test_reports_places_left(self):
+        full, partly, empty = self.add_sessions(3)
+        make_booking(full, "A1", 4)
+        make_booking(partly, "A2", 1)
+
+        response = self.client.get(reverse("get_sessions", args=[self.activity.id]))
+        data = {row["pk"]: row for row in response.json()["sessions"]}
+
+        self.assertTrue(data[full.pk]["is_full"])
+        self.assertEqual(data[full.pk]["available_places"], 0)
+        self.assertEqual(data[partly.pk]["available_places"], 3)
+        self.assertEqual(data[empty.pk]["available_places"], 4)
+        self.assertEqual(data[empty.pk]["start_time"], "11:00")
+
+    def test_query_count_does_not_grow_with_sessions(self):
+        url = reverse("get_sessions", args=[self.activity.id])
+        self.add_sessions(2)
+        with self.assertNumQueries(1):
+            self.client.get(url)
+        self.add_sessions(20)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(len(response.json()["sessions"]), 22)
+
+    async def test_served_on_the_async_stack(self):
+        full, partly = await sync_to_async(self.add_sessions)(2)
+        await sync_to_async(make_booking)(full, "A1", 4)
+
+        response = await self.async_client.get(reverse("get_sessions", args=[self.activity.id]))
+        data = {row["pk"]: row for row in response.json()["sessions"]}
+        self.assertTrue(data[full.pk]["is_full"])
+        self.assertEqual(data[partly.pk]["available_places"], 4)
+        self.assertEqual(await sync_to_async(cached_places)(full.pk), 0)
+
+        # Errors on API paths still come back as JSON through the async chain
+        response = await self.async_client.get("/bookings/api/missing/")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"error": "Not Found"})
+
+
+class CsvTransferTests(TestCase):
+    def setUp(self):
+        self.activity = Activity.objects.create(
+            activity_name="Aqua Aerobics", description="Fun", max_number=5, price=5
+        )
+        self.monday = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+        self.tuesday = Session.objects.create(activity=self.activity, session_day="Tue", start_time="09:00")
+        staff = User.objects.create_user("staff", password="pw", is_staff=True)
+        self.client.force_login(staff)
+
+    def upload(self, text):
+        csv_file = SimpleUploadedFile("bookings.csv", text.encode("utf-8"), content_type="text/csv")
+        return self.client.post(reverse("import_bookings"), {"csv_file": csv_file})
+
+    def test_export_streams_filtered_rows(self):
+        make_booking(self.monday, "A1", 2)
+        make_booking(self.tuesday, "B1", 1)
+
+        response = self.client.get(reverse("export_bookings"), {"day": "Tue"})
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(",")[:2], ["id", "caravan_number"])
+        self.assertEqual(len(lines), 2)
+        self.assertIn("B1", lines[1])
+
+    def test_import_checks_capacity_and_duplicates(self):
+        make_booking(self.monday, "A1", 2)
+        response = self.upload(
+            "caravan_number,first_name,last_name,email,number_of_people,session\n"
+            f"C1,Ann,Lee,ann@example.com,2,{self.monday.id}\n"
+            f"C2,Bob,Lee,bob@example.com,2,{self.monday.id}\n"
+            f"A1,Cat,Lee,cat@example.com,1,{self.tuesday.id}\n"
+            f"C3,Dan,Lee,not-an-email,1,{self.tuesday.id}\n"
+            f"C4,Eve,Lee,eve@example.com,4,{self.tuesday.id}\n"
+        )
+        result = response.context["result"]
+        self.assertEqual(result.created, 2)
+        self.assertEqual(result.rejected, 3)
+        self.monday.refresh_from_db()
+        self.tuesday.refresh_from_db()
+        self.assertEqual(self.monday.booked_number, 4)
+        self.assertEqual(self.tuesday.booked_number, 4)
+
+    def test_import_runs_in_chunks(self):
+        rows = "".join(
+            f"X{i},Guest,{i},g{i}@example.com,1,{self.monday.id if i % 2 else self.tuesday.id}\n"
+            for i in range(10)
+        )
+        csv_file = SimpleUploadedFile(
+            "bookings.csv",
+            ("caravan_number,first_name,last_name,email,number_of_people,session\n" + rows).encode(),
+        )
+        result = import_bookings(csv_file, chunk_size=3)
+        self.assertEqual(result.created, 10)
+        self.assertEqual(Booking.objects.count(), 10)
+
+    async def test_export_is_streamed_asynchronously_under_asgi(self):
+        await sync_to_async(make_booking)(self.monday, "A1", 2)
+        await sync_to_async(make_booking)(self.tuesday, "B1", 1)
+        staff = await User.objects.aget(username="staff")
+        await sync_to_async(self.async_client.force_login)(staff)
+
+        with mock.patch("bookings.bulk.export_rows", side_effect=AssertionError("sync iterator used")):
+            response = await self.async_client.get(reverse("export_bookings"))
+        self.assertTrue(response.is_async)
+        lines = [chunk async for chunk in response.__aiter__()]
+        self.assertEqual(len(lines), 3)
+        self.assertIn("B1", lines[2].decode())
+
+    def test_invalid_export_filters_are_refused_before_streaming(self):
+        response = self.client.get(reverse("export_bookings"), {"activity": "abc"})
+        self.assertRedirects(response, reverse("staff_all_sessions"), fetch_redirect_response=False)
+
+    def test_non_utf8_upload_is_reported(self):
+        csv_file = SimpleUploadedFile(
+            "bookings.csv",
+            "caravan_number,first_name,last_name,email,number_of_people,session\n"
+            f"C1,Zo\u00eb,Lee,zoe@example.com,1,{self.monday.id}\n".encode("latin-1"),
+        )
+        response = self.client.post(reverse("import_bookings"), {"csv_file": csv_file})
+        self.assertContains(response, "not UTF-8")
+        self.assertFalse(Booking.objects.exists())
+
+    def test_unreadable_csv_keeps_the_rows_before_it(self):
+        response = self.upload(
+            "caravan_number,first_name,last_name,email,number_of_people,session\n"
+            f"C1,Ann,Lee,ann@example.com,1,{self.monday.id}\n"
+            f"C2,Bob,Lee,bob@exam\0ple.com,1,{self.monday.id}\n"
+        )
+        result = response.context["result"]
+        self.assertEqual((result.created, result.rejected), (1, 1))
+
+    def test_caravan_booked_during_the_import_is_rejected(self):
+        from . import bulk
+        save_chunk = bulk._save_chunk
+        calls = []
+
+        def racing_save(parsed, seen_caravans):
+            calls.append(1)
+            if len(calls) == 1:
+                # Another request books C1 between the check and the insert
+                make_booking(self.tuesday, "C1", 1)
+                raise IntegrityError("UNIQUE constraint failed: bookings_booking.caravan_number")
+            return save_chunk(parsed, seen_caravans)
+
+        with mock.patch("bookings.bulk._save_chunk", side_effect=racing_save):
+            response = self.upload(
+                "caravan_number,first_name,last_name,email,number_of_people,session\n"
+                f"C1,Ann,Lee,ann@example.com,1,{self.monday.id}\n"
+                f"C2,Bob,Lee,bob@example.com,1,{self.monday.id}\n"
+            )
+        result = response.context["result"]
+        self.assertEqual((result.created, result.rejected), (1, 1))
+        self.assertIn("C1 already has a booking", result.errors[0])
+
+    def test_chunk_that_keeps_colliding_is_reported_as_failed(self):
+        collision = IntegrityError("UNIQUE constraint failed: bookings_booking.caravan_number")
+        with mock.patch("bookings.bulk._save_chunk", side_effect=collision):
+            response = self.upload(
+                "caravan_number,first_name,last_name,email,number_of_people,session\n"
+                f"C1,Ann,Lee,ann@example.com,1,{self.monday.id}\n"
+                f"C2,Bob,Lee,bob@example.com,1,{self.monday.id}\n"
+            )
+        result = response.context["result"]
+        self.assertEqual((result.created, result.rejected), (0, 2))
+        self.assertIn("import it again", result.errors[0])
+
+    def test_export_can_be_imported(self):
+        make_booking(self.monday, "A1", 2)
+        exported = b"".join(self.client.get(reverse("export_bookings")).streaming_content)
+        Booking.objects.all().delete()
+        Session.objects.update(booked_number=0)
+        self.upload(exported.decode())
+        self.assertEqual(Booking.objects.get().caravan_number, "A1")
+
+
+class SessionBatchTests(TestCase):
+    def setUp(self):
+        self.activity = Activity.objects.create(
+            activity_name="Aqua Aerobics", description="Fun", max_number=20, price=5
+        )
+        self.session = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+        staff = User.objects.create_user("staff", password="pw", is_staff=True)
+        self.client.force_login(staff)
+
+    def post(self, actions):
+        return self.client.post(
+            reverse("session_bookings_batch", args=[self.session.id]),
+            data=json.dumps({"actions": actions}),
+            content_type="application/json",
+        )
+
+    def test_batch_attend_and_release(self):
+        bookings = [make_booking(self.session, f"A{i}", 2) for i in range(4)]
+        other_session = Session.objects.create(activity=self.activity, session_day="Tue", start_time="09:00")
+        stranger = make_booking(other_session, "Z1", 1)
+
+        response = self.post([
+            {"booking_id": bookings[0].id, "action": "attend"},
+            {"booking_id": bookings[1].id, "action": "attend"},
+            {"booking_id": bookings[2].id, "action": "release"},
+            {"booking_id": bookings[3].id, "action": "release"},
+            {"booking_id": stranger.id, "action": "release"},
+            {"booking_id": bookings[0].id, "action": "dance"},
+        ])
+        statuses = [result["status"] for result in response.json()["results"]]
+        self.assertEqual(statuses, ["success"] * 4 + ["error"] * 2)
+
+        self.assertEqual(Booking.objects.filter(session=self.session, attended=True).count(), 2)
+        self.assertEqual(Booking.objects.filter(session=self.session).count(), 2)
+        self.assertTrue(Booking.objects.filter(pk=stranger.pk).exists())
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.booked_number, 4)
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        bookings = [make_booking(self.session, f"A{i}", 1) for i in range(10)]
+        actions = [{"booking_id": booking.id, "action": "attend"} for booking in bookings[:5]]
+        actions += [{"booking_id": booking.id, "action": "release"} for booking in bookings[5:]]
+        # session lookup, locked read, bulk update, delete, session and
+        # occurrence counter updates, the waitlist check (locked session,
+        # locked next run and queue head), plus the staff user lookups and savepoints
+        with self.assertNumQueries(13):
+            self.post(actions)
+
+    def test_rejects_bad_payload(self):
+        response = self.client.post(
+            reverse("session_bookings_batch", args=[self.session.id]),
+            data="nonsense", content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class StaffSessionListTests(TestCase):
+    def setUp(self):
+        self.activity = Activity.objects.create(
+            activity_name="Aqua Aerobics", description="Fun", max_number=6, price=5
+        )
+        staff = User.objects.create_user("staff", password="pw", is_staff=True)
+        self.client.force_login(staff)
+
+    def add_week(self, days=("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")):
+        for day in days:
+            for time in ["09:00", "10:00", "11:00", "12:00", "13:00", "14:00", "15:00", "16:00"]:
+                Session.objects.create(activity=self.activity, session_day=day, start_time=time)
+
+    def test_pages_follow_the_cursor(self):
+        self.add_week()
+        url = reverse("staff_all_sessions")
+        seen = []
+        cursor = None
+        while True:
+            response = self.client.get(url, {"after": cursor} if cursor else {})
+            seen += [session.id for session in response.context["sessions"]]
+            cursor = response.context["next_cursor"]
+            if not cursor:
+                break
+        self.assertEqual(len(seen), 56)
+        self.assertEqual(len(set(seen)), 56)
+
+    def test_malformed_cursors_start_from_the_top(self):
+        self.add_week(days=("Mon",))
+        for name, cursor in [
+            ("staff_all_sessions", "Mon,09:00:00,abc"),
+            ("staff_all_sessions", "Mon,nine,1"),
+            ("staff_today_sessions", "09:00:00,abc"),
+        ]:
+            response = self.client.get(reverse(name), {"after": cursor})
+            self.assertEqual(response.status_code, 200, (name, cursor))
+        response = self.client.get(reverse("staff_all_sessions"), {"after": "Mon,09:00:00,abc"})
+        self.assertEqual(len(response.context["sessions"]), 8)
+
+    def test_counts_come_from_the_database(self):
+        self.add_week(days=("Mon",))
+        session = Session.objects.get(session_day="Mon", start_time="10:00")
+        make_booking(session, "A1", 4)
+        response = self.client.get(reverse("staff_all_sessions"), {"day": "Mon"})
+        row = next(s for s in response.context["sessions"] if s.id == session.id)
+        self.assertEqual(row.total_booked, 4)
+        self.assertEqual(row.places_left, 2)
+        self.assertContains(response, "<td>2</td>")
+
+    def test_query_count_stays_flat(self):
+        self.add_week(days=("Mon",))
+        url = reverse("staff_all_sessions")
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(url)
+        self.add_week(days=("Tue", "Wed", "Thu", "Fri"))
+        with CaptureQueriesContext(connection) as large:
+            self.client.get(url)
+        self.assertEqual(len(small), len(large))
+
+
+class StaffTodaySessionsTests(TestCase):
+    def test_lists_todays_occurrences(self):
+        activity = Activity.objects.create(activity_name="Aqua Aerobics", description="Fun", max_number=6, price=5)
+        today_code = timezone.localdate().strftime("%a")
+        other_code = (timezone.localdate() + timedelta(days=1)).strftime("%a")
+        today = Session.objects.create(activity=activity, session_day=today_code, start_time="10:00")
+        Session.objects.create(activity=activity, session_day=other_code, start_time="10:00")
+        staff = User.objects.create_user("staff", password="pw", is_staff=True)
+        self.client.force_login(staff)
+
+        # Nothing generated yet: the page only reads
+        response = self.client.get(reverse("staff_today_sessions"))
+        self.assertEqual(list(response.context["today_sessions"]), [])
+        self.assertFalse(SessionOccurrence.objects.exists())
+
+        call_command("generate_occurrences", weeks=1, stdout=StringIO())
+        booking = Booking(
+            caravan_number="A1", first_name="Guest", last_name="A1", email="a1@example.com", session=today,
+            number_of_people=2, occurrence=SessionOccurrence.objects.get(session=today, date=timezone.localdate()),
+        )
+        booking.save()
+        response = self.client.get(reverse("staff_today_sessions"))
+
+        rows = response.context["today_sessions"]
+        self.assertEqual([row.session_id for row in rows], [today.id])
+        self.assertEqual(rows[0].total_booked, 2)
+        self.assertContains(response, reverse("session_bookings", args=[today.id]))
+
+
+class QueryPlanTests(TestCase):
+    """
+    The hot lookups in bookings.views and open_hours.views must be served by
+    an index. Each test runs the view and explains the SQL it actually sent.
+    On Postgres sequential scans are switched off so the planner reports
+    whether an index could be used at all on these tiny tables.
+    """
+
+    def setUp(self):
+        self.activity = Activity.objects.create(
+            activity_name="Aqua Aerobics", description="Fun", max_number=6, price=5
+        )
+        self.session = Session.objects.create(
+            activity=self.activity, session_day=timezone.localdate().strftime("%a"), start_time="16:00"
+        )
+        self.booking = make_booking(self.session, "A1", 2)
+        self.staff = User.objects.create_user("staff", password="pw", is_staff=True)
+
+    def queries(self, run, pattern):
+        """
+        The SQL that run() sent matching `pattern`.
+        """
+        with CaptureQueriesContext(connection) as context:
+            run()
+        matching = [query["sql"] for query in context.captured_queries if re.search(pattern, query["sql"])]
+        self.assertTrue(matching, f"No query matched {pattern!r}")
+        return matching
+
+    def explain(self, sql):
+        if connection.vendor == "postgresql":
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute(f"EXPLAIN {sql}")
+                return "\n".join(row[0] for row in cursor.fetchall())
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            return "\n".join(row[-1] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, sql):
+        if connection.vendor not in ("postgresql", "sqlite"):
+            self.skipTest(f"No query plan check for {connection.vendor}")
+        plan = self.explain(sql)
+        if connection.vendor == "postgresql":
+            self.assertNotIn("Seq Scan", plan)
+            return
+        for line in plan.splitlines():
+            if re.search(r"\bSCAN\b", line) and "USING" not in line:
+                self.fail(f"Full table scan in query plan:\n{plan}\nfor:\n{sql}")
+        self.assertRegex(plan, r"USING (COVERING )?INDEX|USING INTEGER PRIMARY KEY")
+
+    def test_get_sessions_uses_activity_index(self):
+        url = reverse("get_sessions", args=[self.activity.id])
+        for sql in self.queries(lambda: self.client.get(url), r'FROM "open_hours_session"'):
+            self.assertUsesIndex(sql)
+
+    def test_slot_lookup_uses_unique_index(self):
+        self.client.force_login(User.objects.create_superuser("admin", password="pw"))
+        post = lambda: self.client.post(
+            reverse("add_session"), {"session_day": "Tue", "start_time": "10:00", "activity": self.activity.id}
+        )
+        for sql in self.queries(post, r'FROM "open_hours_session" WHERE .*"session_day"'):
+            self.assertUsesIndex(sql)
+
+    def test_session_bookings_use_session_index(self):
+        self.client.force_login(self.staff)
+        for name in ("session_bookings", "session_bookings_list"):
+            url = reverse(name, args=[self.session.id])
+            for sql in self.queries(lambda: self.client.get(url), r'FROM "bookings_booking"'):
+                self.assertUsesIndex(sql)
+
+    def test_caravan_check_uses_index(self):
+        url = reverse("make_booking") + f"?session={self.session.id}"
+        data = {"caravan_number": "A2", "first_name": "A", "last_name": "B", "email": "a2@example.com",
+                "number_of_people": 1}
+        post = lambda: self.client.post(url, data)
+        for sql in self.queries(post, r'FROM "bookings_booking" WHERE .*"caravan_number" ='):
+            self.assertUsesIndex(sql)
+
+    def test_guest_booking_lookup_is_covered(self):
+        self.client.post(reverse("my_bookings"), {"caravan_number": "A1", "email": "A1@example.com"})
+        [sql] = self.queries(lambda: self.client.get(reverse("my_bookings")), r'FROM "bookings_booking"')
+        self.assertUsesIndex(sql)
+        if connection.vendor == "sqlite":
+            self.assertIn("USING COVERING INDEX booking_guest_lookup_idx", self.explain(sql))
+
+    def test_today_and_archive_use_date_index(self):
+        self.client.force_login(self.staff)
+        get = lambda: self.client.get(reverse("staff_today_sessions"))
+        for sql in self.queries(get, r'FROM "open_hours_sessionoccurrence"'):
+            self.assertUsesIndex(sql)
+
+        reset = lambda: call_command(
+            "reset_bookings", date=self.booking.occurrence.date.isoformat(), stdout=StringIO()
+        )
+        for sql in self.queries(reset, r'^SELECT .* FROM "bookings_booking" WHERE .*"occurrence_id" ='):
+            self.assertUsesIndex(sql)
+
+
+@override_settings(CACHES=IN_PROCESS_CACHE)
+class QueryBudgetTests(TestCase):
+    """
+    Every page and API endpoint has a fixed query budget. Each view is
+    measured on a small and on a larger timetable; the count must stay
+    within budget and must not grow with the number of rows.
+    """
+
+    # view name, URL args, GET params, query budget. Budgets include the two
+    # session/user lookups made for the logged-in staff member.
+    BUDGETS = [
+        ("booking_home", [], {}, 3),
+        ("make_booking", [], {"session": "FIRST_SESSION"}, 3),
+        ("booking_success", [], {}, 2),
+        ("get_sessions", ["ACTIVITY"], {}, 2),
+        ("staff_today_sessions", [], {}, 5),
+        ("staff_all_sessions", [], {}, 4),
+        ("session_bookings", ["FIRST_SESSION"], {}, 5),
+        ("session_bookings_list", ["FIRST_SESSION"], {}, 4),
+        ("staff_make_booking", [], {}, 3),
+        ("staff_make_booking_for_session", ["FIRST_SESSION"], {}, 4),
+        ("cancel_booking", ["FIRST_BOOKING"], {}, 3),
+        ("export_bookings", [], {}, 3),
+        ("import_bookings", [], {}, 2),
+        ("occupancy_report", [], {}, 5),
+    ]
+
+    def setUp(self):
+        self.activities = [
+            Activity.objects.create(activity_name=name, description="Fun", max_number=40, price=5)
+            for name in ("Aqua Aerobics", "Swim School", "Lunch")
+        ]
+        self.staff = User.objects.create_user("staff", password="pw", is_staff=True)
+        self.caravans = 0
+
+    def seed(self, days):
+        times = ["09:00", "10:00", "11:00", "12:00", "13:00", "14:00", "15:00", "16:00"]
+        for day in days:
+            for i, time in enumerate(times):
+                session = Session.objects.create(
+                    activity=self.activities[i % len(self.activities)], session_day=day, start_time=time
+                )
+                for _ in range(3):
+                    self.caravans += 1
+                    make_booking(session, f"C{self.caravans}", 1)
+
+    def url(self, name, args, params):
+        first_session = Session.objects.exclude(activity__activity_name="Lunch").order_by("id").first()
+        replacements = {
+            "FIRST_SESSION": first_session.id,
+            "FIRST_BOOKING": Booking.objects.order_by("id").first().id,
+            "ACTIVITY": self.activities[0].id,
+        }
+        url = reverse(name, args=[replacements.get(arg, arg) for arg in args])
+        query = {key: replacements.get(value, value) for key, value in params.items()}
+        return url, query
+
+    def count_queries(self, name, args, params):
+        url, query = self.url(name, args, params)
+        self.client.force_login(self.staff)
+        # Warm the auth/session lookups so they are counted the same way every time
+        self.client.get(reverse("booking_success"))
+        # Budgets are for a cold render, with no cached fragments
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, query)
+            if getattr(response, "streaming", False):
+                b"".join(response.streaming_content)
+        self.assertEqual(response.status_code, 200, name)
+        return len(queries)
+
+    def test_views_stay_within_budget(self):
+        today = timezone.localdate().strftime("%a")
+        self.seed([today])
+        small = {name: self.count_queries(name, args, params) for name, args, params, _ in self.BUDGETS}
+
+        self.seed([code for code in ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun") if code != today])
+        for name, args, params, budget in self.BUDGETS:
+            with self.subTest(view=name):
+                large = self.count_queries(name, args, params)
+                self.assertEqual(large, small[name], f"{name} query count grows with rows")
+                self.assertLessEqual(large, budget, f"{name} is over its query budget")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@override_settings(CACHES=IN_PROCESS_CACHE)
+class AdmissionControllerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.clock = FakeClock()
+        self.controller = AdmissionController(rate=2, burst=2, max_queue=3, clock=self.clock)
+
+    def test_burst_then_queue_then_reject(self):
+        self.assertTrue(self.controller.admit().admitted)
+        self.assertTrue(self.controller.admit().admitted)
+        waiting = [self.controller.admit() for _ in range(3)]
+        self.assertEqual([admission.position for admission in waiting], [1, 2, 3])
+        self.assertTrue(self.controller.admit().rejected)
+
+        # The next window has two places, so the first two in line fit,
+        # whichever of them comes back first
+        self.clock.now = 1
+        self.assertTrue(self.controller.admit(waiting[1].ticket).admitted)
+        self.assertEqual(self.controller.admit().position, 3)
+        self.assertTrue(self.controller.admit(waiting[0].ticket).admitted)
+        self.assertEqual(self.controller.admit(waiting[2].ticket).position, 1)
+
+    def test_tickets_work_on_any_worker(self):
+        self.controller.admit()
+        self.controller.admit()
+        waiting = self.controller.admit()
+        other_worker = AdmissionController(rate=2, burst=2, max_queue=3, clock=self.clock)
+        self.assertEqual(other_worker.admit(waiting.ticket).position, 1)
+        self.clock.now = 1
+        self.assertTrue(other_worker.admit(waiting.ticket).admitted)
+        self.assertEqual(self.controller.queue_length, 0)
+
+    def test_abandoned_tickets_are_skipped(self):
+        controller = AdmissionController(rate=1, burst=1, max_queue=3, clock=self.clock)
+        controller.admit()
+        gone = controller.admit()
+        stays = controller.admit()
+        self.assertEqual((gone.retry_after, stays.retry_after), (1, 2))
+        self.clock.now = 1
+        self.assertEqual(controller.admit(stays.ticket).position, 2)
+        # `gone` was not seen for twice its retry delay, so `stays` moves up
+        self.clock.now = 2.5
+        self.assertTrue(controller.admit(stays.ticket).admitted)
+        self.assertEqual(controller.queue_length, 0)
+        self.assertNotEqual(controller.admit(gone.ticket).ticket, gone.ticket)
+
+
+@override_settings(CACHES=IN_PROCESS_CACHE)
+class AdmissionViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.activity = Activity.objects.create(activity_name="Aqua Aerobics", description="Fun", max_number=5, price=5)
+        self.session = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+        self.url = reverse("make_booking") + f"?session={self.session.id}"
+        self.clock = FakeClock()
+        self.controller = AdmissionController(rate=1, burst=1, max_queue=1, clock=self.clock)
+        patcher = mock.patch("bookings.admission.get_controller", return_value=self.controller)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, caravan, people=1, **extra):
+        return self.client.post(self.url, {
+            "caravan_number": caravan, "first_name": "A", "last_name": "B",
+            "email": f"{caravan}@example.com", "number_of_people": people, **extra,
+        })
+
+    def test_full_session_fails_fast_from_cache(self):
+        remember_places({self.session.id: 2})
+        with self.assertNumQueries(0):
+            response = self.post("A1", people=3)
+        self.assertRedirects(response, reverse("booking_home"))
+        self.assertEqual(self.controller.queue_length, 0)
+
+    def test_queued_guest_books_when_their_turn_comes(self):
+        self.assertRedirects(self.post("A1"), reverse("booking_success"))
+
+        response = self.post("A2")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertContains(response, 'id="queue-position">1<', status_code=429)
+        token = response.context["token"]
+        self.assertEqual(self.post("A3").status_code, 503)
+        self.assertFalse(Booking.objects.filter(caravan_number="A2").exists())
+
+        self.clock.now = 1
+        self.assertRedirects(self.post("A2", **{TOKEN_FIELD: token}), reverse("booking_success"))
+        self.assertTrue(Booking.objects.filter(caravan_number="A2").exists())
+
+    def test_get_is_not_throttled(self):
+        self.controller.admit()
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+
+class WaitlistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.activity = Activity.objects.create(activity_name="Aqua Aerobics", description="Fun", max_number=6, price=5)
+        self.session = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+        self.staff = User.objects.create_user("staff", password="pw", is_staff=True)
+
+    def wait(self, caravan, people):
+        return WaitlistEntry.objects.create(
+            caravan_number=caravan, first_name="W", last_name=caravan, email=f"{caravan}@example.com",
+            session=self.session, number_of_people=people,
+        )
+
+    def booked(self):
+        self.session.refresh_from_db()
+        return self.session.booked_number
+
+    def test_full_session_offers_the_waitlist(self):
+        make_booking(self.session, "A1", 6)
+        data = {"caravan_number": "W1", "first_name": "A", "last_name": "B", "email": "w@example.com",
+                "number_of_people": 2}
+        url = reverse("make_booking") + f"?session={self.session.id}"
+        self.assertContains(self.client.post(url, data), 'name="join_waitlist"')
+        self.assertRedirects(self.client.post(url, {**data, "join_waitlist": "1"}), reverse("booking_home"))
+        self.client.post(url, {**data, "join_waitlist": "1"})
+        self.assertEqual(WaitlistEntry.objects.filter(session=self.session, caravan_number="W1").count(), 1)
+
+    def test_waitlist_needs_a_session(self):
+        data = {"caravan_number": "W1", "first_name": "A", "last_name": "B", "email": "w@example.com",
+                "number_of_people": 2, "join_waitlist": "1"}
+        response = self.client.post(reverse("make_booking"), data)
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(WaitlistEntry.objects.exists())
+
+    def test_joining_with_room_left_books_straight_away(self):
+        make_booking(self.session, "A1", 4)
+        data = {"caravan_number": "W1", "first_name": "A", "last_name": "B", "email": "w@example.com",
+                "number_of_people": 2, "join_waitlist": "1"}
+        url = reverse("make_booking") + f"?session={self.session.id}"
+        self.assertRedirects(self.client.post(url, data), reverse("booking_success"))
+        self.assertTrue(Booking.objects.filter(session=self.session, caravan_number="W1").exists())
+        self.assertFalse(WaitlistEntry.objects.exists())
+        self.assertEqual(self.booked(), 6)
+
+    def test_release_promotes_parties_that_fit_in_order(self):
+        big = make_booking(self.session, "A1", 4)
+        make_booking(self.session, "A2", 2)
+        self.wait("W1", 3)
+        self.wait("W2", 5)
+        self.wait("W3", 1)
+        self.wait("W4", 1)
+
+        big.delete()
+
+        # 4 places free: W1 (3) then W3 (1); W2 is too big, W4 no longer fits
+        self.assertEqual(
+            set(Booking.objects.filter(session=self.session).values_list("caravan_number", flat=True)),
+            {"A2", "W1", "W3"},
+        )
+        self.assertEqual(self.booked(), 6)
+        self.assertEqual(list(self.session.waitlist.order_by("id").values_list("caravan_number", flat=True)),
+                         ["W2", "W4"])
+        promoted = Booking.objects.get(caravan_number="W1")
+        self.assertEqual(promoted.occurrence, SessionOccurrence.next_for(self.session))
+        self.assertEqual(promoted.occurrence.booked_number, 6)
+
+    def test_staff_release_and_cancel_promote(self):
+        first = make_booking(self.session, "A1", 3)
+        second = make_booking(self.session, "A2", 3)
+        self.wait("W1", 3)
+        self.wait("W2", 3)
+        self.client.force_login(self.staff)
+
+        self.client.post(reverse("session_bookings", args=[self.session.id]),
+                         {"booking_id": first.id, "action": "release"})
+        self.assertTrue(Booking.objects.filter(caravan_number="W1").exists())
+        self.client.post(reverse("cancel_booking", args=[second.id]))
+        self.assertTrue(Booking.objects.filter(caravan_number="W2").exists())
+        self.assertEqual(self.booked(), 6)
+        self.assertFalse(self.session.waitlist.exists())
+
+    def test_shrinking_a_booking_promotes(self):
+        booking = make_booking(self.session, "A1", 6)
+        self.wait("W1", 2)
+        booking.number_of_people = 4
+        booking.save()
+        self.assertTrue(Booking.objects.filter(caravan_number="W1").exists())
+        self.assertEqual(self.booked(), 6)
+
+    def test_caravan_that_booked_elsewhere_is_dropped(self):
+        other = Session.objects.create(activity=self.activity, session_day="Tue", start_time="09:00")
+        booking = make_booking(self.session, "A1", 6)
+        self.wait("W1", 2)
+        make_booking(other, "W1", 1)
+        booking.delete()
+        self.assertFalse(self.session.waitlist.exists())
+        self.assertFalse(Booking.objects.filter(session=self.session).exists())
+
+    def test_promotion_reads_a_bounded_slice(self):
+        booking = make_booking(self.session, "A1", 6)
+        for i in range(50):
+            self.wait(f"W{i}", 1)
+        with CaptureQueriesContext(connection) as queries:
+            booking.delete()
+        waitlist_reads = [q["sql"] for q in queries if 'FROM "bookings_waitlistentry"' in q["sql"] and q["sql"].startswith("SELECT")]
+        self.assertEqual(len(waitlist_reads), 1)
+        self.assertIn("LIMIT 6", waitlist_reads[0])
+        self.assertEqual(self.session.waitlist.count(), 44)
+
+
+class OccupancyReportViewTests(TestCase):
+    def setUp(self):
+        self.activity = Activity.objects.create(activity_name="Aqua Aerobics", description="Fun", max_number=8, price=5)
+        self.session = Session.objects.create(activity=self.activity, session_day="Tue", start_time="09:00")
+        self.staff = User.objects.create_user("staff", password="pw", is_staff=True)
+        self.client.force_login(self.staff)
+
+    def test_report_reads_the_rollups_after_a_reset(self):
+        make_booking(self.session, "A1", 4)
+        occurrence_date = SessionOccurrence.next_for(self.session).date
+        call_command("reset_bookings", date=occurrence_date.isoformat(), stdout=StringIO())
+        url = reverse("occupancy_report")
+        self.assertContains(self.client.get(url), "No history has been rolled up yet")
+
+        call_command("refresh_occupancy", stdout=StringIO())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {"activity": self.activity.pk, "days": ["Tue"]})
+        self.assertContains(response, "50.0%")
+        self.assertFalse([q for q in queries if "historical" in q["sql"]])
+
+        response = self.client.get(url, {"start": "2026-09-01", "end": "2026-08-01"})
+        self.assertContains(response, "on or before the end date")
+        self.assertNotContains(response, "50.0%")
+
+    def test_staff_only(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse("occupancy_report")).status_code, 302)
+
+
+class GuestBookingLookupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.activity = Activity.objects.create(activity_name="Aqua Aerobics", description="Fun", max_number=4, price=5)
+        self.session = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+        self.booking = make_booking(self.session, "A1", 3)
+
+    def look_up(self, caravan="A1", email="A1@example.com"):
+        return self.client.post(reverse("my_bookings"), {"caravan_number": caravan, "email": email})
+
+    def test_lookup_returns_upcoming_bookings_in_one_query(self):
+        past = SessionOccurrence.objects.get(pk=self.booking.occurrence_id)
+        past.pk = None
+        past.date = timezone.localdate() - timedelta(days=7)
+        past.save()
+        Booking.objects.filter(pk=make_booking(self.session, "B1", 1).pk).update(occurrence=past)
+
+        with self.assertNumQueries(1):
+            bookings = list(Booking.upcoming_for_guest("A1", "A1@example.com"))
+            self.assertEqual(bookings[0].session.activity.activity_name, "Aqua Aerobics")
+            self.assertEqual(bookings[0].occurrence.date, self.booking.occurrence.date)
+        self.assertEqual(bookings, [self.booking])
+        self.assertFalse(Booking.upcoming_for_guest("A1", "other@example.com").exists())
+        self.assertFalse(Booking.upcoming_for_guest("B1", "B1@example.com").exists())
+
+        response = self.client.post(reverse("guest_bookings_api"), {"caravan_number": "A1", "email": "A1@example.com"})
+        self.assertEqual(response.json()["bookings"], [{
+            "pk": self.booking.pk, "activity": "Aqua Aerobics", "date": self.booking.occurrence.date.isoformat(),
+            "session_day": "Mon", "start_time": "09:00", "end_time": "10:00", "number_of_people": 3,
+        }])
+        self.assertEqual(self.client.post(reverse("guest_bookings_api"), {"caravan_number": "A1"}).status_code, 400)
+
+    def test_page_lists_the_looked_up_party(self):
+        self.assertNotContains(self.client.get(reverse("my_bookings")), "Aqua Aerobics")
+        self.assertRedirects(self.look_up(), reverse("my_bookings"))
+        response = self.client.get(reverse("my_bookings"))
+        self.assertContains(response, "Aqua Aerobics")
+        self.assertContains(response, reverse("guest_cancel_booking", args=[self.booking.pk]))
+
+        self.look_up(email="wrong@example.com")
+        self.assertContains(self.client.get(reverse("my_bookings")), "No upcoming bookings found")
+
+    def test_cancel_frees_places_and_promotes_the_waitlist(self):
+        WaitlistEntry.objects.create(
+            caravan_number="W1", first_name="W", last_name="1", email="w@example.com",
+            session=self.session, number_of_people=2,
+        )
+        self.look_up()
+        url = reverse("guest_cancel_booking", args=[self.booking.pk])
+        self.assertRedirects(self.client.post(url), reverse("my_bookings"))
+
+        self.assertFalse(Booking.objects.filter(pk=self.booking.pk).exists())
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.booked_number, 2)
+        self.assertTrue(Booking.objects.filter(caravan_number="W1").exists())
+
+        # A second click finds nothing left to give back
+        self.client.post(url)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.booked_number, 2)
+
+    def test_cannot_cancel_someone_elses_booking(self):
+        other = make_booking(self.session, "B1", 1)
+        self.look_up()
+        self.client.post(reverse("guest_cancel_booking", args=[other.pk]))
+        self.assertTrue(Booking.objects.filter(pk=other.pk).exists())
+
+        anonymous = self.client_class()
+        self.assertRedirects(
+            anonymous.post(reverse("guest_cancel_booking", args=[self.booking.pk])), reverse("my_bookings")
+        )
+        self.assertTrue(Booking.objects.filter(pk=self.booking.pk).exists())
+
+
+class IdempotentBookingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.activity = Activity.objects.create(activity_name="Aqua Aerobics", description="Fun", max_number=6, price=5)
+        self.session = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+        self.url = reverse("make_booking") + f"?session={self.session.id}"
+        self.data = {"caravan_number": "A1", "first_name": "A", "last_name": "B", "email": "a@example.com",
+                     "number_of_people": 2, "idempotency_key": "k-1"}
+
+    def test_form_carries_a_key(self):
+        self.assertContains(self.client.get(self.url), 'name="idempotency_key"')
+
+    def test_double_submit_books_once(self):
+        first = self.client.post(self.url, self.data)
+        self.assertRedirects(first, reverse("booking_success"))
+        # the failed claim (insert inside a savepoint) and one read; no booking work
+        with self.assertNumQueries(5):
+            second = self.client.post(self.url, self.data)
+        self.assertRedirects(second, reverse("booking_success"))
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(Booking.objects.count(), 1)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.booked_number, 2)
+
+    def test_key_reused_for_other_data_is_refused(self):
+        self.client.post(self.url, self.data)
+        response = self.client.post(self.url, {**self.data, "number_of_people": 3})
+        self.assertEqual(response.status_code, 422)
+
+    def test_retry_while_first_is_running(self):
+        self.client.post(self.url, self.data)
+        IdempotencyKey.objects.update(status_code=0)
+        with mock.patch("open_hours.idempotency.FORM_WAIT_SECONDS", 0):
+            response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 409)
+        self.assertContains(response, "still being processed", status_code=409)
+        self.assertEqual(response["Content-Type"], "text/html; charset=utf-8")
+
+        response = self.client.post(self.url, self.data, HTTP_IDEMPOTENCY_KEY="k-1")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["success"], False)
+
+    def test_double_submit_waits_for_the_first_answer(self):
+        self.client.post(self.url, self.data)
+        stored = IdempotencyKey.objects.values("status_code", "location").get()
+        IdempotencyKey.objects.update(status_code=0, location="")
+
+        def first_request_finishes(seconds):
+            IdempotencyKey.objects.update(**stored)
+
+        with mock.patch("open_hours.idempotency.time.sleep", side_effect=first_request_finishes):
+            response = self.client.post(self.url, self.data)
+        self.assertRedirects(response, reverse("booking_success"))
+        self.assertEqual(response["Idempotent-Replayed"], "true")
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_claims_only_hold_a_short_lease(self):
+        leases = []
+        save = Booking.save
+
+        def save_and_look(booking, *args, **kwargs):
+            leases.append(IdempotencyKey.objects.get().expires_at)
+            return save(booking, *args, **kwargs)
+
+        with mock.patch.object(Booking, "save", save_and_look):
+            self.client.post(self.url, self.data)
+        # Held for the lease while running, for the TTL once answered
+        self.assertLess(leases[0], timezone.now() + timedelta(minutes=2))
+        self.assertGreater(IdempotencyKey.objects.get().expires_at, timezone.now() + timedelta(hours=23))
+
+        # A request that died before answering frees the key when its lease runs out
+        IdempotencyKey.objects.update(status_code=0, expires_at=timezone.now() - timedelta(seconds=1))
+        Booking.objects.all().delete()
+        self.assertRedirects(self.client.post(self.url, self.data), reverse("booking_success"))
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_expired_key_runs_again(self):
+        self.client.post(self.url, self.data)
+        Booking.objects.all().delete()
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertRedirects(self.client.post(self.url, self.data), reverse("booking_success"))
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_keys_are_per_user(self):
+        staff = User.objects.create_user("staff", password="pw", is_staff=True)
+        other = User.objects.create_user("other", password="pw", is_staff=True)
+        data = {**self.data, "session": self.session.id, "attended": ""}
+        self.client.force_login(staff)
+        self.client.post(reverse("staff_make_booking"), data)
+        self.client.force_login(other)
+        response = self.client.post(reverse("staff_make_booking"), {**data, "caravan_number": "A2"})
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(Booking.objects.count(), 2)
+
+
+@override_settings(DATABASE_REPLICAS=["replica_0"])
+class ReplicaRoutingTests(TestCase):
+    """
+    replica_0 is a second SQLite file holding only the timetable and
+    booking tables.
+    Rows are copied to it by hand, so it lags the primary until a test
+    catches it up.
+    """
+
+    # replica_0 only exists once setUpClass adds it, so the runner's
+    # checks and test databases cannot ask for it by name
+    databases = "__all__"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_dir = tempfile.mkdtemp()
+        configured = connections.configure_settings({
+            "default": settings.DATABASES["default"],
+            "replica_0": {"ENGINE": "django.db.backends.sqlite3", "NAME": os.path.join(cls.replica_dir, "replica.sqlite3")},
+        })
+        connections.settings["replica_0"] = configured["replica_0"]
+        with connections["replica_0"].schema_editor() as editor:
+            for model in (Activity, Session, SessionOccurrence, Booking):
+                editor.create_model(model)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections["replica_0"].close()
+        del connections["replica_0"]
+        del connections.settings["replica_0"]
+        shutil.rmtree(cls.replica_dir)
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.seen = []
+
+    def replicate(self, *rows):
+        for row in rows:
+            type(row).objects.using("replica_0").bulk_create([row])
+
+    def test_a_lagging_replica_is_only_read_until_the_browser_writes(self):
+        activity = Activity.objects.create(activity_name="Swim", description="Laps", max_number=10, price=5)
+        session = Session.objects.create(activity=activity, session_day="Mon", start_time="09:00")
+        self.replicate(activity, session)
+        Session.objects.filter(pk=session.pk).update(booked_number=4)
+
+        @use_replica
+        def view(request):
+            self.seen.append(Session.objects.get(pk=session.pk).booked_number)
+            return HttpResponse()
+
+        self.handle(self.factory.get("/"), view)
+        request = self.factory.get("/")
+        request.COOKIES[PIN_COOKIE] = "1"
+        self.handle(request, view)
+        # The replica has not seen the booking; the pinned read has
+        self.assertEqual(self.seen, [0, 4])
+
+        # Once the replica catches up, unpinned reads see the booking too
+        self.seen.clear()
+        Session.objects.using("replica_0").filter(pk=session.pk).update(booked_number=4)
+        self.handle(self.factory.get("/"), view)
+        self.assertEqual(self.seen, [4])
+
+    def handle(self, request, view):
+        return ReplicaPinningMiddleware(view)(request)
+
+    def reading_view(self, write=False):
+        @use_replica
+        def view(request):
+            self.seen.append(Session.objects.all().db)
+            if write:
+                self.seen.append(router.db_for_write(Booking))
+                self.seen.append(Session.objects.all().db)
+            return HttpResponse()
+        return view
+
+    def test_read_only_views_use_the_replica(self):
+        response = self.handle(self.factory.get("/"), self.reading_view())
+        self.assertEqual(self.seen, ["replica_0"])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_staff_lists_read_the_replica(self):
+        activity = Activity(pk=99, activity_name="Replica Swim", description="Laps", max_number=10, price=5)
+        session = Session(pk=99, activity=activity, session_day="Mon", start_time="09:00")
+        occurrence = SessionOccurrence(
+            pk=99, session=session, activity=activity, date=timezone.localdate(), start_time="09:00"
+        )
+        self.replicate(activity, session, occurrence)
+        request = self.factory.get("/")
+        request.user = User.objects.create_user("staff", password="pw", is_staff=True)
+        # Only the replica has today's run
+        self.assertContains(self.handle(request, views.staff_today_sessions), "Replica Swim")
+
+    def test_other_views_and_code_outside_requests_use_the_primary(self):
+        def view(request):
+            self.seen.append(Session.objects.all().db)
+            return HttpResponse()
+
+        self.handle(self.factory.get("/"), view)
+        self.assertEqual(self.seen, ["default"])
+        self.assertEqual(Session.objects.all().db, "default")
+
+    def test_the_database_cache_stays_on_the_primary_and_does_not_pin(self):
+        from django.core.cache.backends.db import DatabaseCache
+        cache_entry = DatabaseCache("django_cache", {}).cache_model_class
+
+        @use_replica
+        def view(request):
+            self.seen.append(router.db_for_read(cache_entry))
+            self.seen.append(router.db_for_write(cache_entry))
+            self.seen.append(Session.objects.all().db)
+            return HttpResponse()
+
+        response = self.handle(self.factory.get("/"), view)
+        self.assertEqual(self.seen, ["default", "default", "replica_0"])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_sessions_and_users_stay_on_the_primary_and_do_not_pin(self):
+        from django.contrib.sessions.models import Session as BrowserSession
+
+        @use_replica
+        def view(request):
+            for model in (BrowserSession, User):
+                self.seen.append(router.db_for_read(model))
+                self.seen.append(router.db_for_write(model))
+            self.seen.append(Session.objects.all().db)
+            return HttpResponse()
+
+        response = self.handle(self.factory.get("/"), view)
+        self.assertEqual(self.seen, ["default"] * 4 + ["replica_0"])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_a_write_pins_the_request_and_the_browser(self):
+        response = self.handle(self.factory.get("/"), self.reading_view(write=True))
+        self.assertEqual(self.seen, ["replica_0", "default", "default"])
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        # The follow-up page reads the primary while the pin lasts
+        self.seen.clear()
+        request = self.factory.get("/")
+        request.COOKIES[PIN_COOKIE] = "1"
+        self.handle(request, self.reading_view())
+        self.assertEqual(self.seen, ["default"])
+
+    def test_posts_read_from_the_primary(self):
+        self.handle(self.factory.post("/"), self.reading_view())
+        self.assertEqual(self.seen, ["default"])
+
+    def test_guest_sees_their_booking_after_booking(self):
+        activity = Activity.objects.create(activity_name="Aqua Aerobics", description="Fun", max_number=6, price=5)
+        session = Session.objects.create(activity=activity, session_day="Mon", start_time="09:00")
+        response = self.client.post(reverse("make_booking") + f"?session={session.id}", {
+            "caravan_number": "A1", "first_name": "A", "last_name": "B", "email": "a@example.com",
+            "number_of_people": 2,
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(PIN_COOKIE, response.cookies)
+        # The test client sends the cookie back, so the next read-only view stays on the primary
+        self.assertEqual(self.client.cookies[PIN_COOKIE].value, "1")
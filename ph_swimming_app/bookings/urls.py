@@ -8,9 +8,16 @@ urlpatterns = [
     path("sessions/all/", views.staff_all_sessions, name="staff_all_sessions"),
     path("sessions/today/", views.staff_today_sessions, name="staff_today_sessions"),
     path("session/<int:session_id>/", views.session_bookings, name="session_bookings"),
+    path("session/<int:session_id>/batch/", views.session_bookings_batch, name="session_bookings_batch"),
     path("staff/booking/", views.staff_make_booking, name="staff_make_booking"),
     path('staff/booking/<int:session_id>/', views.staff_make_booking, name='staff_make_booking_for_session'),
     path('staff/sessions/<int:session_id>/bookings/', views.session_bookings_list, name='session_bookings_list'),
+    path("staff/bookings/export/", views.export_bookings, name="export_bookings"),
+    path("staff/bookings/import/", views.import_bookings_view, name="import_bookings"),
+    path("staff/reports/occupancy/", views.occupancy_report_view, name="occupancy_report"),
     path("success/", views.booking_success, name="booking_success"),
+    path("mine/", views.my_bookings, name="my_bookings"),
+    path("mine/<int:booking_id>/cancel/", views.guest_cancel_booking, name="guest_cancel_booking"),
+    path("api/mine/", views.guest_bookings_api, name="guest_bookings_api"),
     path("api/sessions/<int:activity_id>/", views.get_sessions, name="get_sessions"),
 ]
@@ -1,33 +1,79 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.core.exceptions import ValidationError
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
-from .models import Booking
-from open_hours.models import Activity, Session
-from .forms import GuestBookingForm, StaffBookingForm
-from django.db.models import Sum, F
+from .models import Booking, WaitlistEntry
+from open_hours.models import Activity, Session, SessionOccurrence, RollupWatermark, DAY_CHOICES, slot_label
+from open_hours.rollups import OCCUPANCY, occupancy_report
+from open_hours.events import publish_availability
+from .forms import (
+    GuestBookingForm, StaffBookingForm, BookingExportForm, BookingImportForm, GuestLookupForm, OccupancyReportForm,
+)
+from .bulk import aexport_rows, export_rows, import_bookings, apply_session_actions
+from .admission import admission_control
+from open_hours.capacity import aremember_places
+from open_hours.idempotency import idempotent
+from ph_swimming_app.db_router import use_replica
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Coalesce
 from datetime import datetime, date, time, timedelta
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from django.core.handlers.asgi import ASGIRequest
+from django.utils import timezone
+import json
 
 """ Guest Views """
+@use_replica
 def booking_home(request):
     """
     Displays a grid of available activities for a guest to select.
     """
-    activities = Activity.objects.exclude(activity_name='Lunch')
+    # Only read when the cached cards are missing; from the primary, since
+    # the cards are then kept until an Activity changes
+    activities = Activity.objects.using(DEFAULT_DB_ALIAS).exclude(activity_name='Lunch')
     return render(request, "bookings/booking_home.html", {
         "activities": activities,
     })
 
+@idempotent('make_booking')
+@admission_control
 def make_booking(request):
     session_id = request.GET.get("session")
     session = None
     if session_id:
-        session = get_object_or_404(Session, pk=session_id)
+        session = get_object_or_404(Session.with_next_run(Session.objects.select_related('activity')), pk=session_id)
         
+    offer_waitlist = False
     if request.method == "POST":
         form = GuestBookingForm(request.POST)
+        if form.is_valid() and "join_waitlist" in request.POST:
+            if session is None or session.activity is None:
+                raise Http404("No session selected.")
+            caravan_number = form.cleaned_data["caravan_number"]
+            with transaction.atomic():
+                entry, created = WaitlistEntry.objects.get_or_create(
+                    session=session,
+                    caravan_number=caravan_number,
+                    defaults={
+                        field: form.cleaned_data[field]
+                        for field in ("first_name", "last_name", "email", "number_of_people")
+                    },
+                )
+                # Places may have freed up since the page was shown
+                promoted = WaitlistEntry.promote(session.pk) if created else []
+                if promoted:
+                    transaction.on_commit(lambda: publish_availability([session.pk]))
+            if any(booking.caravan_number == caravan_number for booking in promoted):
+                messages.success(request, "Space was available after all, so you're booked in!")
+                return redirect("booking_success")
+            if created:
+                messages.success(request, "You're on the waiting list. We'll book you in as soon as space frees up.")
+            else:
+                messages.info(request, "This caravan is already on the waiting list for this session.")
+            return redirect("booking_home")
         if form.is_valid():
             booking = form.save(commit=False)
             booking.session = session
@@ -36,7 +82,8 @@ def make_booking(request):
                 messages.success(request, "Booking confirmed!")
                 return redirect("booking_success")
             except ValidationError as e:
-                messages.error(request, e.message)
+                messages.error(request, " ".join(e.messages))
+                offer_waitlist = session is not None and session.activity is not None
     else:
         # Pre-populate the form with the selected session
         form = GuestBookingForm(initial={'session': session})
@@ -44,49 +91,118 @@ def make_booking(request):
     return render(request, "bookings/make_booking.html", {
         "form": form,
         "session": session,
+        "offer_waitlist": offer_waitlist,
     })
 
 
 def booking_success(request):
     return render(request, "bookings/booking_success.html")
 
-def get_sessions(request, activity_id):
+
+# Session key holding the [caravan_number, email] a guest last looked up
+GUEST_LOOKUP_KEY = "guest_lookup"
+
+
+def guest_booking_data(booking):
+    return {
+        "pk": booking.pk,
+        "activity": booking.session.activity.activity_name if booking.session.activity else "",
+        "date": booking.occurrence.date.isoformat(),
+        "session_day": booking.session.session_day,
+        "start_time": slot_label(booking.session.start_time) or "",
+        "end_time": slot_label(booking.session.end_time) or "",
+        "number_of_people": booking.number_of_people,
+    }
+
+
+@use_replica
+def my_bookings(request):
     """
-    API endpoint to retrieve sessions for a given activity.
-    Always returns valid JSON, even if Session fields are inconsistent.
+    Lets a guest find their upcoming bookings by caravan number and email,
+    and cancel them.
     """
-    try:
-        sessions = Session.objects.filter(activity__id=activity_id).order_by('session_day', 'start_time')
-
-        sessions_data = []
-        for session in sessions:
-            # Handle session_day
-            day_val = getattr(session, "session_day", "")
-            if hasattr(day_val, "strftime"):
-                session_day_str = day_val.strftime("%Y-%m-%d")
-            else:
-                session_day_str = str(day_val) if day_val is not None else ""
-
-            # Handle start_time
-            time_val = getattr(session, "start_time", "")
-            if hasattr(time_val, "strftime"):
-                start_time_str = time_val.strftime("%H:%M")
-            else:
-                start_time_str = str(time_val) if time_val is not None else ""
+    if request.method == "POST":
+        form = GuestLookupForm(request.POST)
+        if form.is_valid():
+            request.session[GUEST_LOOKUP_KEY] = [form.cleaned_data["caravan_number"], form.cleaned_data["email"]]
+            return redirect("my_bookings")
+    else:
+        lookup = request.session.get(GUEST_LOOKUP_KEY)
+        form = GuestLookupForm(initial=dict(zip(("caravan_number", "email"), lookup or [])))
 
-            # Handle is_full
-            is_full_val = session.is_full() if callable(session.is_full) else bool(session.is_full)
+    lookup = request.session.get(GUEST_LOOKUP_KEY)
+    return render(request, "bookings/my_bookings.html", {
+        "form": form,
+        "looked_up": lookup is not None,
+        "bookings": Booking.upcoming_for_guest(*lookup) if lookup else [],
+    })
 
-            # Handle available_places (fallback to 0 if missing)
-            available_places_val = getattr(session, "available_places", 0)
 
-            sessions_data.append({
-                "pk": session.pk,
-                "session_day": session_day_str,
-                "start_time": start_time_str,
-                "is_full": is_full_val,
-                "available_places": available_places_val,
-            })
+@require_POST
+def guest_cancel_booking(request, booking_id):
+    """
+    Cancels one of the looked-up guest's bookings. Goes through
+    Booking.delete(), as staff cancellations do, so the places are given
+    back and the waiting list is served.
+    """
+    lookup = request.session.get(GUEST_LOOKUP_KEY)
+    if not lookup:
+        return redirect("my_bookings")
+    with transaction.atomic():
+        # Locked, so a double-click cannot give the places back twice
+        booking = (
+            Booking.upcoming_for_guest(*lookup).select_for_update(of=("self",))
+            .filter(pk=booking_id).first()
+        )
+        if booking is None:
+            messages.error(request, "That booking could not be found. It may already have been cancelled.")
+        else:
+            booking.delete()
+            messages.success(request, "Your booking has been cancelled.")
+    return redirect("my_bookings")
+
+
+@require_POST
+@use_replica
+def guest_bookings_api(request):
+    """
+    API endpoint returning a guest's upcoming bookings.
+    Expects caravan_number and email as form fields.
+    """
+    form = GuestLookupForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({"status": "error", "message": "Enter your caravan number and email."}, status=400)
+    bookings = Booking.upcoming_for_guest(form.cleaned_data["caravan_number"], form.cleaned_data["email"])
+    return JsonResponse({"bookings": [guest_booking_data(booking) for booking in bookings]})
+
+@use_replica
+async def get_sessions(request, activity_id):
+    """
+    API endpoint to retrieve sessions for a given activity.
+    Places left on each session's next run are worked out by the database
+    in a single query, so the cost does not grow with the number of sessions.
+    """
+    try:
+        sessions = (
+            Session.with_next_run(Session.objects.filter(activity__id=activity_id))
+            .order_by('session_day', 'start_time')
+            .values('pk', 'session_day', 'start_time', 'places_left')
+        )
+
+        sessions_data = [
+            {
+                "pk": session["pk"],
+                "session_day": session["session_day"] or "",
+                "start_time": slot_label(session["start_time"]) or "",
+                "is_full": session["places_left"] <= 0,
+                "available_places": session["places_left"],
+            }
+            async for session in sessions
+        ]
+        # Lets make_booking turn guests away from full sessions without a
+        # query. Replica counts may lag a release, so only the primary's go in.
+        if sessions.db == DEFAULT_DB_ALIAS:
+            await aremember_places({session["pk"]: session["available_places"] for session in sessions_data})
 
         return JsonResponse({"sessions": sessions_data}, status=200)
 
@@ -96,33 +212,80 @@ def get_sessions(request, activity_id):
 
 """ Staff Views """
 
+SESSIONS_PER_PAGE = 50
+
+
+def with_booking_counts(sessions):
+    """
+    Adds total_booked and places_left, worked out by the database. For
+    weekly sessions both are for the next run; occurrences are one run.
+    """
+    if sessions.model is Session:
+        return Session.with_next_run(sessions.select_related('activity')).annotate(total_booked=F('next_booked'))
+    return sessions.select_related('activity').annotate(
+        total_booked=F('booked_number'),
+        places_left=Coalesce(F('activity__max_number'), 0) - F('booked_number'),
+    )
+
+
+def keyset_page(sessions, ordering, after, size=SESSIONS_PER_PAGE):
+    """
+    Returns one page of sessions that come after the `after` cursor in
+    `ordering`, plus the cursor for the next page (or None).
+    Seeking on the ordered columns keeps every page equally cheap.
+    """
+    sessions = sessions.order_by(*ordering)
+    if after:
+        values = after.split(",")
+        if len(values) == len(ordering):
+            seek = Q()
+            for i, field in enumerate(ordering):
+                step = Q(**{f"{field}__gt": values[i]})
+                for previous, value in zip(ordering[:i], values[:i]):
+                    step &= Q(**{previous: value})
+                seek |= step
+            try:
+                sessions = sessions.filter(seek)
+            except (ValueError, ValidationError):
+                # Not a cursor we handed out; start from the top
+                pass
+
+    page = list(sessions[:size + 1])
+    next_cursor = None
+    if len(page) > size:
+        page = page[:size]
+        last = page[-1]
+        next_cursor = ",".join(str(getattr(last, field)) for field in ordering)
+    return page, next_cursor
+
+
 @staff_member_required
+@use_replica
 def staff_today_sessions(request):
     """
     Staff view to display a grid of today's sessions with booking counts.
     """
-    today_code = date.today().strftime('%a')
-    
-    # Filter for sessions happening today and exclude 'Lunch' activity
-    today_sessions = Session.objects.filter(
-        session_day=today_code, 
-        activity__activity_name__isnull=False
-    ).exclude(
-        activity__activity_name='Lunch'
-    ).annotate(
-        total_booked=Sum('booking__number_of_people')
-    ).order_by('start_time')
-
-    # Ensure total_booked is 0 for sessions with no bookings
-    for session in today_sessions:
-        if session.total_booked is None:
-            session.total_booked = 0
+    today = timezone.localdate()
+
+    # Today's dated runs (generated ahead by reset_bookings and
+    # generate_occurrences), found through the (date, start_time) index; exclude 'Lunch' activity
+    today_sessions = with_booking_counts(
+        SessionOccurrence.objects.filter(
+            date=today,
+            activity__activity_name__isnull=False
+        ).exclude(
+            activity__activity_name='Lunch'
+        )
+    )
+    today_sessions, next_cursor = keyset_page(today_sessions, ('start_time', 'id'), request.GET.get("after"))
 
     return render(request, "bookings/staff_sessions_grid.html", {
-        "today_sessions": today_sessions
+        "today_sessions": today_sessions,
+        "next_cursor": next_cursor,
     })
 
 @staff_member_required
+@use_replica
 def session_bookings_list(request, session_id):
     """
     Displays a list of all bookings for a specific session.
@@ -196,9 +359,29 @@ def session_bookings(request, session_id):
     return render(request, "bookings/session_bookings.html", {
         "session": session,
         "bookings": bookings,
+        "waitlist": session.waitlist.order_by("id"),
     })
 
 @staff_member_required
+@require_POST
+def session_bookings_batch(request, session_id):
+    """
+    Applies several attend / release actions to a session's bookings at once.
+    Expects JSON: {"actions": [{"booking_id": 1, "action": "attend"}, ...]}
+    """
+    session = get_object_or_404(Session, id=session_id)
+    try:
+        items = json.loads(request.body).get("actions")
+    except (ValueError, AttributeError):
+        items = None
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return JsonResponse({"status": "error", "message": "Send a list of actions."}, status=400)
+
+    results = apply_session_actions(session, items)
+    return JsonResponse({"status": "success", "results": results})
+
+@staff_member_required
+@use_replica
 def staff_all_sessions(request):
     """
     Staff view to display ALL sessions with booking counts and filtering.
@@ -206,16 +389,7 @@ def staff_all_sessions(request):
     day_filter = request.GET.get("day")
     activity_filter = request.GET.get("activity")
 
-    sessions = Session.objects.exclude(
-        activity__activity_name='Lunch'
-    ).annotate(
-        total_booked=Sum('booking__number_of_people')
-    ).order_by('session_day', 'start_time')
-
-    # Ensure total_booked is 0 if no bookings exist
-    for session in sessions:
-        if session.total_booked is None:
-            session.total_booked = 0
+    sessions = Session.objects.exclude(activity__activity_name='Lunch')
 
     # Apply filters
     if day_filter:
@@ -223,17 +397,46 @@ def staff_all_sessions(request):
     if activity_filter:
         sessions = sessions.filter(activity_id=activity_filter)
 
+    sessions, next_cursor = keyset_page(
+        with_booking_counts(sessions),
+        ('session_day', 'start_time', 'id'),
+        request.GET.get("after"),
+    )
+
     activities = Activity.objects.exclude(activity_name="Lunch")
 
     return render(request, "bookings/staff_all_sessions.html", {
         "sessions": sessions,
         "activities": activities,
+        "day_choices": DAY_CHOICES,
         "selected_day": day_filter,
         "selected_activity": activity_filter,
+        "next_cursor": next_cursor,
     })
 
 
 @staff_member_required
+@use_replica
+def occupancy_report_view(request):
+    """
+    Staff report of fill rate and attendance per activity, weekday and
+    slot. Reads only the occupancy rollups (see refresh_occupancy).
+    """
+    form = OccupancyReportForm(request.GET or None)
+    if form.is_bound and not form.is_valid():
+        rows = []
+    else:
+        rows = occupancy_report(**(form.cleaned_data if form.is_bound else {}))
+
+    return render(request, "bookings/occupancy_report.html", {
+        "form": form,
+        "rows": rows,
+        "watermark": RollupWatermark.objects.filter(name=OCCUPANCY).first(),
+    })
+
+
+@staff_member_required
+@idempotent('staff_make_booking')
 def staff_make_booking(request, session_id=None):
     """
     Allow staff to create a booking for a guest.
@@ -250,19 +453,19 @@ def staff_make_booking(request, session_id=None):
 
     if request.method == "POST":
         form = StaffBookingForm(request.POST, initial=initial_data, locked_session=locked_session)
+        # Superusers skip the capacity check, both in the form and in the ledger
+        form.instance.override_capacity = request.user.is_superuser
         if form.is_valid():
             booking = form.save(commit=False)
             try:
+                booking.save()
                 if request.user.is_superuser:
-                    booking.full_clean(exclude=None)
-                    booking.save()
                     messages.success(request, "Booking confirmed (override).")
                 else:
-                    booking.save()
                     messages.success(request, "Booking confirmed.")
                 return redirect("staff_all_sessions")
             except ValidationError as e:
-                messages.error(request, e.message)
+                messages.error(request, " ".join(e.messages))
     else:
         form = StaffBookingForm(initial=initial_data, locked_session=locked_session)
 
@@ -274,7 +477,7 @@ def staff_make_booking(request, session_id=None):
 # Cancel a booking
 @staff_member_required
 def cancel_booking(request, booking_id):
-    booking = get_object_or_404(Booking, id=booking_id)
+    booking = get_object_or_404(Booking.objects.select_related('session__activity'), id=booking_id)
     session = booking.session
 
     if request.method == "POST":
@@ -284,3 +487,43 @@ def cancel_booking(request, booking_id):
     
     return render(request, "bookings/cancel_booking.html", {
         "booking": booking})
+
+
+@staff_member_required
+def export_bookings(request):
+    """
+    Streams bookings as CSV, optionally filtered by day, activity and session.
+    """
+    # Checked up front: once streaming starts an error cannot become a response
+    form = BookingExportForm(request.GET)
+    if not form.is_valid():
+        messages.error(request, "The export filters are not valid.")
+        return redirect("staff_all_sessions")
+    # Served by uvicorn, a sync iterator would be read whole before sending
+    stream = aexport_rows if isinstance(request, ASGIRequest) else export_rows
+    response = StreamingHttpResponse(stream(**form.cleaned_data), content_type="text/csv")
+    response["Content-Disposition"] = 'attachment; filename="bookings.csv"'
+    return response
+
+
+@staff_member_required
+def import_bookings_view(request):
+    """
+    Imports bookings from a CSV file, checking capacity per session in bulk.
+    """
+    result = None
+    if request.method == "POST":
+        form = BookingImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            try:
+                result = import_bookings(form.cleaned_data["csv_file"])
+                messages.success(request, f"Imported {result.created} bookings, skipped {result.rejected}.")
+            except ValidationError as e:
+                messages.error(request, " ".join(e.messages))
+    else:
+        form = BookingImportForm()
+
+    return render(request, "bookings/staff_import.html", {
+        "form": form,
+        "result": result,
+    })
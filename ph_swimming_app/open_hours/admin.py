@@ -1,10 +1,48 @@
-from django.contrib import admin
-from .models import OpeningHour, Activity, Session
-from bookings.models import Booking
+from django.contrib import admin, messages
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from .models import OpeningHour, Activity, Session, SessionOccurrence, TimetableVersion, VersionSlot
+from .versions import clone_version, activate_version
+from bookings.models import Booking, WaitlistEntry
 
 
 # Register your models here.
 admin.site.register(OpeningHour)
 admin.site.register(Activity)
 admin.site.register(Session)
-admin.site.register(Booking)
\ No newline at end of file
+admin.site.register(SessionOccurrence)
+admin.site.register(Booking)
+admin.site.register(WaitlistEntry)
+
+
+class VersionSlotInline(admin.TabularInline):
+    model = VersionSlot
+    extra = 0
+
+
+@admin.register(TimetableVersion)
+class TimetableVersionAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'created_at', 'activated_at')
+    list_filter = ('status',)
+    readonly_fields = ('status', 'activated_at')
+    inlines = [VersionSlotInline]
+    actions = ['clone_selected', 'activate_selected']
+
+    @admin.action(description='Clone as a new draft')
+    def clone_selected(self, request, queryset):
+        for version in queryset:
+            copy = clone_version(f'Copy of {version.name} ({timezone.now():%Y-%m-%d %H:%M:%S})', version)
+            self.message_user(request, f'Created draft "{copy.name}".')
+
+    @admin.action(description='Activate (make live)')
+    def activate_selected(self, request, queryset):
+        if queryset.count() != 1:
+            self.message_user(request, 'Select exactly one version to activate.', messages.ERROR)
+            return
+        version = queryset.get()
+        try:
+            changed = activate_version(version)
+        except ValidationError as e:
+            self.message_user(request, ' '.join(e.messages), messages.ERROR)
+            return
+        self.message_user(request, f'"{version.name}" is now live ({changed} slots changed).')
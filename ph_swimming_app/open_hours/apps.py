@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class OpenHoursConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'open_hours'
+
+    def ready(self):
+        from . import signals  # noqa: F401
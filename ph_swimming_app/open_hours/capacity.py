@@ -0,0 +1,36 @@
+from django.core.cache import cache
+
+"""
+Cached places-left on each session's next run.
+
+Only used to turn guests away cheaply when a session is already full; the
+booking itself is still checked against the locked occurrence row. Releases
+drop the cached value straight away in the shared cache (settings.CACHES),
+so a freed place is never hidden from any worker, and the short timeout
+covers edits to an activity's capacity.
+"""
+
+PLACES_KEY = 'open_hours:places_left:{}'
+PLACES_TIMEOUT = 30
+
+
+def cached_places(session_id):
+    return cache.get(PLACES_KEY.format(session_id))
+
+
+def remember_places(places_by_session):
+    cache.set_many(
+        {PLACES_KEY.format(session_id): places for session_id, places in places_by_session.items()},
+        timeout=PLACES_TIMEOUT,
+    )
+
+
+async def aremember_places(places_by_session):
+    await cache.aset_many(
+        {PLACES_KEY.format(session_id): places for session_id, places in places_by_session.items()},
+        timeout=PLACES_TIMEOUT,
+    )
+
+
+def forget_places(session_id):
+    cache.delete(PLACES_KEY.format(session_id))
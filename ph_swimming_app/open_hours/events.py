@@ -0,0 +1,212 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from django.conf import settings
+from .models import Session, slot_label
+
+"""
+Event broker for the live timetable / availability stream.
+
+Every open browser tab subscribes to the broker in its worker, so a
+booking change is published once and fanned out to all tabs instead of
+each tab polling get_sessions. Events can be published from sync code
+(views, model saves) and are handed to each subscriber's event loop.
+
+With settings.EVENTS_REDIS_URL set, events are published on a Redis
+channel that every worker listens to, so a change made in one worker
+reaches the tabs connected to all of them. Without it the broker is
+in-process only: fine for a single worker, local runs and tests, but
+with several workers a tab only hears about changes made by the worker
+it is connected to.
+"""
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_SECONDS = 15
+# How long one stream stays open before the browser is made to reconnect
+STREAM_SECONDS = 300
+
+
+class Subscription:
+    """
+    One listener, optionally narrowed to an activity and/or a day.
+    """
+
+    def __init__(self, broker, filters, max_queue):
+        self.broker = broker
+        self.filters = {key: str(value) for key, value in filters.items() if value}
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_queue)
+
+    def wants(self, keys):
+        for key, value in self.filters.items():
+            if key in keys and str(keys[key]) != value:
+                return False
+        return True
+
+    def put(self, message):
+        if self.queue.full():
+            # A slow client only needs the latest state, drop the oldest event
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class EventBroker:
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._last_id = 0
+
+    def subscribe(self, activity=None, day=None):
+        """
+        Must be called from the event loop that will read the events.
+        """
+        subscription = Subscription(self, {'activity': activity, 'day': day}, self.max_queue)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def has_listeners(self):
+        return bool(self._subscribers)
+
+    def publish(self, event, data, **keys):
+        """
+        Sends an event to every subscriber whose filters match `keys`.
+        Events without a key (e.g. no day) reach subscribers filtering on it.
+        """
+        keys = {key: value for key, value in keys.items() if value is not None}
+        with self._lock:
+            self._last_id += 1
+            message = {'id': self._last_id, 'event': event, 'data': data}
+            subscribers = [sub for sub in self._subscribers if sub.wants(keys)]
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, message)
+            except RuntimeError:
+                # The subscriber's loop has shut down
+                self.unsubscribe(subscription)
+        return message
+
+
+class RedisEventBroker(EventBroker):
+    """
+    Publishes through a Redis channel. A listener thread in each worker
+    hands what arrives to that worker's subscribers.
+    """
+
+    channel = 'open_hours:events'
+
+    def __init__(self, url, max_queue=100):
+        super().__init__(max_queue)
+        self.url = url
+        self._redis = None
+        self._listener = None
+
+    def _client(self):
+        if self._redis is None:
+            import redis
+            self._redis = redis.Redis.from_url(self.url)
+        return self._redis
+
+    def subscribe(self, activity=None, day=None):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='event-listener', daemon=True)
+                self._listener.start()
+        return super().subscribe(activity, day)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for item in pubsub.listen():
+                    self.deliver(item['data'])
+            except Exception:
+                logger.exception('Lost the event channel, reconnecting')
+                time.sleep(1)
+
+    def deliver(self, payload):
+        """
+        Fans a message from the channel out to this worker's subscribers.
+        """
+        message = json.loads(payload)
+        return super().publish(message['event'], message['data'], **message['keys'])
+
+    def has_listeners(self):
+        try:
+            return any(count for _, count in self._client().pubsub_numsub(self.channel))
+        except Exception:
+            logger.exception('Could not reach the event channel')
+            return False
+
+    def publish(self, event, data, **keys):
+        # Runs after the write has committed, so a lost event must not fail it
+        try:
+            self._client().publish(self.channel, json.dumps({'event': event, 'data': data, 'keys': keys}))
+        except Exception:
+            logger.exception('Could not publish a %s event', event)
+
+
+def make_broker():
+    url = getattr(settings, 'EVENTS_REDIS_URL', None)
+    return RedisEventBroker(url) if url else EventBroker()
+
+
+broker = make_broker()
+
+
+def format_event(message):
+    return f"id: {message['id']}\nevent: {message['event']}\ndata: {json.dumps(message['data'])}\n\n"
+
+
+def publish_availability(session_ids):
+    """
+    Publishes the current places left for the given sessions.
+    """
+    if not broker.has_listeners():
+        return
+    sessions = (
+        Session.with_next_run(Session.objects.filter(pk__in=session_ids))
+        .values('pk', 'activity_id', 'session_day', 'start_time', 'places_left')
+    )
+    for session in sessions:
+        broker.publish(
+            'availability',
+            {
+                'session': session['pk'],
+                'activity': session['activity_id'],
+                'session_day': session['session_day'],
+                'start_time': slot_label(session['start_time']),
+                'available_places': session['places_left'],
+                'is_full': (session['places_left'] or 0) <= 0,
+            },
+            activity=session['activity_id'],
+            day=session['session_day'],
+        )
+
+
+def publish_timetable_change(activity=None, day=None, start_time=None):
+    broker.publish(
+        'timetable',
+        {'activity': activity, 'session_day': day, 'start_time': slot_label(start_time)},
+        activity=activity,
+        day=day,
+    )
@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import Counter
+from django.core.cache import cache
+
+"""
+Hit and miss counters for the cached template fragments.
+
+The fragments themselves use Django's {% cache None name version ... %}
+tag. The data version (see timetable.bump_version) is one of the vary-on
+values, so a cached fragment is served until an Activity or Session is
+saved and never times out. Values that change without a save, such as a
+session's booked count, go in the vary-on list after it.
+
+{% fragment_version "name" as version %} counts a lookup and returns the
+version; {% fragment_miss "name" %}, placed inside the cache block, only
+runs when the block is rendered. Hits are the lookups that did not miss.
+
+Counting happens in process memory, so a page served from the cache
+writes nothing. Each worker adds its counts to the shared cache
+(settings.CACHES) at most every FLUSH_SECONDS, and fragment_stats() adds
+this process's unflushed counts to those, so the fragment_cache_stats
+command sees every worker's numbers, up to FLUSH_SECONDS late.
+"""
+
+FRAGMENTS = {
+    'activity_cards': 'Activity cards on the guest booking page',
+    'session_header': 'Activity name, image and time on the booking form',
+    'session_availability': 'Places left and description on the booking form',
+    'timetable_grid': 'Weekly timetable grid and activity picker',
+}
+
+LOOKUPS_KEY = 'open_hours:fragment_lookups:{}'
+MISSES_KEY = 'open_hours:fragment_misses:{}'
+FLUSH_SECONDS = 60
+
+_counts = Counter()
+_counts_lock = threading.Lock()
+_flushed_at = time.monotonic()
+
+
+def _count(key):
+    global _flushed_at
+    with _counts_lock:
+        _counts[key] += 1
+        if time.monotonic() - _flushed_at < FLUSH_SECONDS:
+            return
+        pending = dict(_counts)
+        _counts.clear()
+        _flushed_at = time.monotonic()
+    _flush(pending)
+
+
+def _flush(pending):
+    for key, count in pending.items():
+        if not cache.add(key, count, timeout=None):
+            try:
+                cache.incr(key, count)
+            except ValueError:
+                # Evicted between the add and the incr
+                cache.add(key, count, timeout=None)
+
+
+def count_lookup(name):
+    _count(LOOKUPS_KEY.format(name))
+
+
+def count_miss(name):
+    _count(MISSES_KEY.format(name))
+
+
+def fragment_stats():
+    """
+    {name: {'hits', 'misses'}} for every fragment.
+    """
+    keys = [LOOKUPS_KEY.format(name) for name in FRAGMENTS] + [MISSES_KEY.format(name) for name in FRAGMENTS]
+    counts = Counter(cache.get_many(keys))
+    with _counts_lock:
+        counts.update(_counts)
+    stats = {}
+    for name in FRAGMENTS:
+        misses = counts[MISSES_KEY.format(name)]
+        stats[name] = {
+            'hits': max(counts[LOOKUPS_KEY.format(name)] - misses, 0),
+            'misses': misses,
+        }
+    return stats
+
+
+def reset_fragment_stats():
+    """
+    Zeroes the shared counts and this process's unflushed ones. Other
+    workers' unflushed counts still arrive with their next flush.
+    """
+    global _flushed_at
+    with _counts_lock:
+        _counts.clear()
+        _flushed_at = time.monotonic()
+    cache.delete_many([LOOKUPS_KEY.format(name) for name in FRAGMENTS] +
+                      [MISSES_KEY.format(name) for name in FRAGMENTS])
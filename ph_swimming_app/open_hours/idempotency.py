@@ -0,0 +1,165 @@
+import functools
+import hashlib
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.shortcuts import render
+from django.utils import timezone
+from .models import IdempotencyKey
+
+"""
+Idempotency keys for POST endpoints that create things.
+
+A client sends a key with the POST, either as an Idempotency-Key header
+(the JSON endpoints) or as an idempotency_key form field (the booking
+forms, see the idempotency_field template tag). The first request with a
+key claims a row and stores its response; a retry with the same key gets
+that response back without running the view again. A retry that arrives
+while the first request is still running gets a 409: JSON for API
+clients, while a double-submitted form first waits a moment for the
+first answer and otherwise gets a "still processing" page. A claim only
+holds the key for a short lease until its response is stored, so a
+request that died mid-way does not block retries for the whole TTL.
+
+Only final answers are stored. Server errors and "try again later"
+responses (409, 429, 503) are not, so a retry after them runs the view.
+"""
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+FIELD = 'idempotency_key'
+NOT_STORED = {409, 429, 503}
+# How long a double-submitted form waits for the first submission's answer
+FORM_WAIT_SECONDS = 3
+POLL_SECONDS = 0.2
+
+
+def _digest(*parts):
+    return hashlib.sha256('\x1f'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def _ttl():
+    return getattr(settings, 'IDEMPOTENCY_KEY_TTL', timedelta(hours=24))
+
+
+def _lease():
+    return getattr(settings, 'IDEMPOTENCY_CLAIM_LEASE', timedelta(seconds=60))
+
+
+def _replay(stored):
+    if stored.location:
+        response = HttpResponseRedirect(stored.location)
+        response.status_code = stored.status_code
+    else:
+        response = HttpResponse(bytes(stored.body), status=stored.status_code, content_type=stored.content_type)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _claim(key, request_hash):
+    """
+    Returns (stored, claimed): the live row already holding the key, or
+    claimed=True if this request now owns it.
+    """
+    now = timezone.now()
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                IdempotencyKey.objects.create(key=key, request_hash=request_hash, expires_at=now + _lease())
+            return None, True
+        except IntegrityError:
+            stored = IdempotencyKey.objects.filter(key=key).first()
+            if stored is not None and stored.expires_at > now:
+                return stored, False
+            # Expired: clear it and try once more
+            IdempotencyKey.objects.filter(key=key, expires_at__lte=now).delete()
+    return None, False
+
+
+def _wait_for(key):
+    """
+    Polls the row holding `key` until its response is stored, it goes away
+    or FORM_WAIT_SECONDS pass. Returns the row, or None if it went away.
+    """
+    deadline = time.monotonic() + FORM_WAIT_SECONDS
+    stored = None
+    while time.monotonic() < deadline:
+        time.sleep(POLL_SECONDS)
+        stored = IdempotencyKey.objects.filter(key=key).first()
+        if stored is None or stored.status_code:
+            return stored
+    return stored
+
+
+def idempotent(scope):
+    """
+    Makes a view's POSTs replayable by idempotency key. `scope` keeps keys
+    for different endpoints apart.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'POST':
+                return view(request, *args, **kwargs)
+            # Read the raw body before request.POST consumes the stream
+            request_hash = _digest(request.get_full_path(), request.body)
+            client_key = request.META.get(HEADER) or (
+                request.POST.get(FIELD) if request.content_type != 'application/json' else None
+            )
+            if not client_key:
+                return view(request, *args, **kwargs)
+
+            user = getattr(request, 'user', None)
+            key = _digest(scope, user.pk if user and user.is_authenticated else '', client_key[:100])
+
+            from_form = not request.META.get(HEADER)
+            stored, claimed = _claim(key, request_hash)
+            if not claimed and from_form and (stored is None or stored.status_code == 0):
+                # A double-clicked form: the first submission usually answers in a moment
+                stored = _wait_for(key)
+                if stored is None:
+                    stored, claimed = _claim(key, request_hash)
+            if not claimed:
+                if stored is None or stored.status_code == 0:
+                    if from_form:
+                        return render(request, 'open_hours/request_in_progress.html', status=409)
+                    return JsonResponse(
+                        {'success': False, 'message': 'This request is already being processed.'}, status=409
+                    )
+                if stored.request_hash != request_hash:
+                    return JsonResponse(
+                        {'success': False, 'message': 'This idempotency key was used for a different request.'},
+                        status=422,
+                    )
+                return _replay(stored)
+
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception:
+                IdempotencyKey.objects.filter(key=key).delete()
+                raise
+            if response.status_code >= 500 or response.status_code in NOT_STORED or response.streaming:
+                IdempotencyKey.objects.filter(key=key).delete()
+                return response
+
+            if hasattr(response, 'render') and callable(response.render):
+                response.render()
+            IdempotencyKey.objects.filter(key=key).update(
+                expires_at=timezone.now() + _ttl(),
+                status_code=response.status_code,
+                content_type=response.get('Content-Type', ''),
+                location=response.get('Location', '')[:500],
+                body=response.content,
+            )
+            return response
+        return wrapper
+    return decorator
+
+
+def purge_expired(now=None):
+    """
+    Deletes expired keys, returning how many went.
+    """
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=now or timezone.now()).delete()
+    return deleted
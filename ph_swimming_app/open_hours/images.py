@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+"""
+Responsive variants of Activity.activity_image.
+
+The variant URLs are built once when an Activity is saved and kept on the
+row (Activity.image_variants), so templates print stored strings and the
+Cloudinary SDK does no work while a page renders. Cloudinary derives the
+resized files itself the first time each URL is fetched.
+
+ACTIVITY_IMAGE_URL_BUILDER names the function that turns an image and a
+size into a URL; local_url is a stand-in for tests and offline work.
+"""
+
+VARIANTS = {
+    'thumbnail': {'width': 160, 'height': 160, 'crop': 'thumb'},
+    'card': {'width': 480, 'height': 320, 'crop': 'fill'},
+    'hero': {'width': 1600, 'height': 600, 'crop': 'fill'},
+}
+SRCSET_WIDTHS = [320, 480, 640, 960, 1280]
+CARD_SIZES = '(max-width: 600px) 100vw, 480px'
+
+
+def cloudinary_url(image, width, height=None, crop='fill'):
+    options = {'width': width, 'crop': crop, 'quality': 'auto', 'fetch_format': 'auto', 'secure': True}
+    if height:
+        options['height'] = height
+    return image.build_url(**options)
+
+
+def local_url(image, width, height=None, crop='fill'):
+    name = f"{image.public_id}_{crop}_{width}x{height or 'auto'}.{image.format or 'jpg'}"
+    return f"{settings.MEDIA_URL}activity_images/{name}"
+
+
+def build_variants(image):
+    """
+    Returns the stored variant URLs for an image, or {} if there is none.
+    """
+    if not image or not getattr(image, 'public_id', None):
+        return {}
+    build_url = import_string(getattr(settings, 'ACTIVITY_IMAGE_URL_BUILDER', 'open_hours.images.cloudinary_url'))
+    variants = {name: build_url(image, **options) for name, options in VARIANTS.items()}
+    variants['srcset'] = ', '.join(f'{build_url(image, width)} {width}w' for width in SRCSET_WIDTHS)
+    variants['sizes'] = CARD_SIZES
+    variants['public_id'] = image.public_id
+    variants['version'] = str(image.version or '')
+    return variants
@@ -0,0 +1,223 @@
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from bookings.management.commands.loadtest import percentile
+from open_hours.models import Activity
+
+"""
+Concurrent-client benchmark for the read-only endpoints, WSGI against ASGI.
+
+Starts the app twice under gunicorn on localhost: once with sync workers
+on wsgi.py (the old deployment) and once with uvicorn workers on asgi.py
+(the Procfile), with the same number of workers each time. Then opens
+many client connections at once, each sending its request slowly, as a
+phone on a poor connection does, and counts how many are answered within
+the timeout. --streams N adds a second, separately reported run of each
+case with N live-update (/events/) connections held open alongside, as
+open timetable pages do; the WSGI deployment refuses those with a 204.
+
+Only GETs are sent, against the database in the current settings, so it
+needs a timetable with at least one activity but changes nothing.
+"""
+
+SERVERS = {
+    'wsgi': ['ph_swimming_app.wsgi:application'],
+    'asgi': ['ph_swimming_app.asgi:application', '-k', 'uvicorn.workers.UvicornWorker'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def fetch(port, path, trickle, timeout):
+    """
+    One slow request. Returns (latency in ms, status) or (None, error).
+    """
+    started = time.perf_counter()
+    writer = None
+    try:
+        async with asyncio.timeout(timeout):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            lines = [f'GET {path} HTTP/1.1', f'Host: 127.0.0.1:{port}', 'User-Agent: benchmark_reads',
+                     'Connection: close']
+            for line in lines:
+                writer.write(f'{line}\r\n'.encode())
+                await writer.drain()
+                await asyncio.sleep(trickle)
+            writer.write(b'\r\n')
+            await writer.drain()
+            status_line = await reader.readline()
+            await reader.read()
+        status = int(status_line.split()[1])
+        return (time.perf_counter() - started) * 1000, status
+    except (TimeoutError, OSError, IndexError, ValueError) as error:
+        return None, type(error).__name__
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def hold_stream(port, path):
+    """
+    Opens a live-update stream and keeps reading it until cancelled.
+    """
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    except OSError:
+        return
+    try:
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nAccept: text/event-stream\r\n\r\n'.encode())
+        await writer.drain()
+        while await reader.read(1024):
+            pass
+    except OSError:
+        pass
+    finally:
+        writer.close()
+
+
+async def run_clients(port, paths, clients, duration, trickle, timeout, streams=0, stream_path=None):
+    latencies = []
+    errors = 0
+    holders = [asyncio.create_task(hold_stream(port, stream_path)) for _ in range(streams)]
+    # Let the streams get hold of the server before the clients start
+    await asyncio.sleep(0.5 if streams else 0)
+    deadline = time.monotonic() + duration
+
+    async def client(number):
+        nonlocal errors
+        turn = number
+        while time.monotonic() < deadline:
+            latency, status = await fetch(port, paths[turn % len(paths)], trickle, timeout)
+            turn += 1
+            if latency is None or status >= 500:
+                errors += 1
+            else:
+                latencies.append(latency)
+
+    await asyncio.gather(*(client(number) for number in range(clients)))
+    for holder in holders:
+        holder.cancel()
+    await asyncio.gather(*holders, return_exceptions=True)
+    return latencies, errors
+
+
+class Command(BaseCommand):
+    help = 'Compares concurrent slow clients served by the WSGI and ASGI deployments on the read endpoints.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--clients', default='10,50,200',
+            help='Comma-separated numbers of concurrent clients to try.',
+        )
+        parser.add_argument('--workers', type=int, default=2, help='Server worker processes.')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds per run.')
+        parser.add_argument(
+            '--trickle', type=float, default=0.05,
+            help='Seconds between request header lines, to mimic a slow client.',
+        )
+        parser.add_argument('--timeout', type=float, default=5.0, help='Seconds before a client gives up.')
+        parser.add_argument(
+            '--streams', type=int, default=0,
+            help='Also run each case with this many live-update streams held open, reported separately.',
+        )
+        parser.add_argument(
+            '--server', choices=list(SERVERS), action='append',
+            help='Only benchmark this deployment (repeatable).',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            client_counts = [int(count) for count in options['clients'].split(',')]
+        except ValueError:
+            raise CommandError('--clients must be a comma-separated list of numbers.')
+        if min(client_counts) < 1 or options['workers'] < 1 or options['duration'] <= 0 or options['streams'] < 0:
+            raise CommandError('--clients, --workers and --duration must be positive, --streams not negative.')
+
+        activity = Activity.objects.order_by('pk').first()
+        if activity is None:
+            raise CommandError('Add at least one activity first; the benchmark reads the timetable.')
+        paths = [
+            reverse('home'),
+            reverse('timetable_data'),
+            reverse('get_sessions', args=[activity.pk]),
+        ]
+
+        scenarios = [0, options['streams']] if options['streams'] else [0]
+        results = {streams: {} for streams in scenarios}
+        for server in options['server'] or list(SERVERS):
+            with self.serve(server, options['workers']) as port:
+                for streams in scenarios:
+                    for clients in client_counts:
+                        self.stdout.write(
+                            f"{server}: {clients} clients for {options['duration']:.0f}s"
+                            + (f" with {streams} streams open..." if streams else "...")
+                        )
+                        results[streams][server, clients] = asyncio.run(run_clients(
+                            port, paths, clients, options['duration'], options['trickle'], options['timeout'],
+                            streams, reverse('event_stream'),
+                        ))
+        for streams, scenario in results.items():
+            self.stdout.write(f"\nWith {streams} live-update streams open:" if streams else "\nReads only:")
+            self.report(scenario, options['duration'])
+
+    @contextmanager
+    def serve(self, server, workers):
+        """
+        Runs one deployment under gunicorn and yields its port.
+        """
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', *SERVERS[server], '--workers', str(workers),
+             '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', '--graceful-timeout', '5'],
+            cwd=settings.BASE_DIR, env={**os.environ, 'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE},
+            # Its own process group, so workers stuck on a stream go down with it
+            start_new_session=True,
+        )
+        try:
+            deadline = time.monotonic() + 30
+            while True:
+                if process.poll() is not None:
+                    raise CommandError(f'The {server} server exited with code {process.returncode}.')
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise CommandError(f'The {server} server did not start within 30s.')
+                    time.sleep(0.2)
+            yield port
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                pass
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.wait()
+
+    def report(self, results, duration):
+        self.stdout.write(
+            f"{'server':<8}{'clients':>8}{'served':>8}{'errors':>8}{'req/s':>8}"
+            f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        )
+        for (server, clients), (latencies, errors) in results.items():
+            self.stdout.write(
+                f"{server:<8}{clients:>8}{len(latencies):>8}{errors:>8}{len(latencies) / duration:>8.1f}"
+                f"{percentile(latencies, 50):>10.1f}{percentile(latencies, 95):>10.1f}"
+                f"{percentile(latencies, 99):>10.1f}"
+            )
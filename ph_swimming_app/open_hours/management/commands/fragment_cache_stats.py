@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from open_hours.fragments import FRAGMENTS, fragment_stats, reset_fragment_stats
+
+class Command(BaseCommand):
+    help = 'Shows hits and misses for the cached template fragments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Zero the counters after showing them.')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'fragment':<24}{'hits':>10}{'misses':>10}{'hit rate':>10}")
+        for name, counts in fragment_stats().items():
+            total = counts['hits'] + counts['misses']
+            rate = f"{counts['hits'] / total:.0%}" if total else '-'
+            self.stdout.write(f"{name:<24}{counts['hits']:>10}{counts['misses']:>10}{rate:>10}  {FRAGMENTS[name]}")
+        if options['reset']:
+            reset_fragment_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset.'))
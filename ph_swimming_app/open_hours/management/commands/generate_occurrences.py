@@ -0,0 +1,25 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from open_hours.models import SessionOccurrence
+
+class Command(BaseCommand):
+    help = 'Creates dated session occurrences from the weekly timetable.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--weeks', type=int, default=4,
+            help='How many weeks ahead to generate, starting today.',
+        )
+
+    def handle(self, *args, **options):
+        if options['weeks'] < 1:
+            raise CommandError('--weeks must be at least 1.')
+        start = timezone.localdate()
+        end = start + timedelta(weeks=options['weeks']) - timedelta(days=1)
+        before = SessionOccurrence.objects.filter(date__range=(start, end)).count()
+        SessionOccurrence.generate(start, end)
+        after = SessionOccurrence.objects.filter(date__range=(start, end)).count()
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {after - before} occurrences between {start} and {end}.'
+        ))
@@ -1,44 +1,121 @@
-from django.core.management.base import BaseCommand
+import time
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
-from datetime import timedelta
-from open_hours.models import Session, Booking, HistoricalSession, HistoricalBooking
+from bookings.models import Booking
+from open_hours.models import Session, SessionOccurrence, HistoricalSession, HistoricalBooking, ResetCheckpoint
 
 class Command(BaseCommand):
     help = 'Resets bookings for past sessions and archives them.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date',
+            help='Archive the sessions held on this date (YYYY-MM-DD). Defaults to yesterday.',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Bookings moved per transaction.',
+        )
+
     def handle(self, *args, **options):
-        # Calculate the date and time from which to reset sessions
-        yesterday = timezone.now().date() - timedelta(days=1)
-        
-        # Find all sessions that are for yesterday or earlier
-        sessions_to_reset = Session.objects.filter(session_day__lt=yesterday) # Assuming a date field or similar
-        
-        # This is where your logic will need to be adapted based on how you handle session dates.
-        # If your Session model has a full DateTimeField, you can do this:
-        # sessions_to_reset = Session.objects.filter(start_time__lt=timezone.now() - timedelta(hours=1))
-
-        # We will use the `session_day` and `start_time` fields to determine
-        # if a session has passed. This requires some careful date math.
-        
-        self.stdout.write(self.style.SUCCESS(f'Starting booking reset for {yesterday}...'))
-
-        for session in sessions_to_reset:
-            # 1. Archive the session and its bookings
-            historical_session = HistoricalSession.objects.create(
-                activity=session.activity,
-                session_day=session.session_day,
-                start_time=session.start_time,
-                total_booked=session.people_booked  # Use the property from your model
+        if options['date']:
+            try:
+                reset_for = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--date must look like YYYY-MM-DD.')
+        else:
+            reset_for = timezone.now().date() - timedelta(days=1)
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be at least 1.')
+
+        # Bookings belong to dated occurrences, so this is a date index lookup
+        occurrences = (
+            SessionOccurrence.objects.filter(date=reset_for)
+            .select_related('session', 'activity')
+            .order_by('start_time')
+        )
+
+        self.stdout.write(self.style.SUCCESS(f'Starting booking reset for {reset_for}...'))
+
+        started = time.monotonic()
+        total_rows = 0
+        for occurrence in occurrences:
+            total_rows += self.archive_occurrence(occurrence, chunk_size)
+
+        elapsed = time.monotonic() - started
+        rate = total_rows / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully reset and archived past bookings: {total_rows} rows in {elapsed:.2f}s ({rate:.0f} rows/s).'
+        ))
+
+        # The nightly run keeps the coming week generated, so the staff
+        # views only ever read occurrences
+        today = timezone.localdate()
+        SessionOccurrence.generate(today, today + timedelta(days=6))
+    def archive_occurrence(self, occurrence, chunk_size):
+        """
+        Moves one occurrence's bookings into the history tables, a chunk per
+        transaction. The checkpoint ties the run to one HistoricalSession,
+        so a rerun after an interruption appends to it instead of starting over.
+        """
+        session = occurrence.session
+        reset_for = occurrence.date
+        with transaction.atomic():
+            checkpoint = (
+                ResetCheckpoint.objects.select_for_update()
+                .filter(session=session, reset_for=reset_for).first()
             )
+            if checkpoint is None:
+                historical_session = HistoricalSession.objects.create(
+                    activity=occurrence.activity,
+                    session_day=session.session_day,
+                    start_time=occurrence.start_time,
+                    session_date=reset_for,
+                )
+                checkpoint = ResetCheckpoint.objects.create(
+                    session=session, reset_for=reset_for, historical_session=historical_session,
+                )
+
+        if checkpoint.completed:
+            self.stdout.write(f'  {occurrence}: already archived, skipping.')
+            return 0
+
+        moved = 0
+        while True:
+            with transaction.atomic():
+                chunk = list(
+                    Booking.objects.select_for_update()
+                    .filter(occurrence=occurrence)
+                    .order_by('id')
+                    .values('id', 'number_of_people', 'booking_date', 'attended')[:chunk_size]
+                )
+                if not chunk:
+                    ResetCheckpoint.objects.filter(pk=checkpoint.pk).update(completed=True)
+                    break
 
-            for booking in session.booking_set.all():
-                HistoricalBooking.objects.create(
-                    user=booking.user,
-                    historical_session=historical_session,
-                    number_of_people=booking.number_of_people,
-                    booking_date=booking.booking_date
+                people = sum(row['number_of_people'] for row in chunk)
+                HistoricalBooking.objects.bulk_create([
+                    HistoricalBooking(
+                        historical_session_id=checkpoint.historical_session_id,
+                        number_of_people=row['number_of_people'],
+                        booking_date=timezone.make_aware(datetime.combine(row['booking_date'], datetime.min.time())),
+                        attended=row['attended'],
+                    )
+                    for row in chunk
+                ])
+                Booking.objects.filter(id__in=[row['id'] for row in chunk]).delete()
+                Session.release_places(session.pk, people, occurrence.pk)
+                HistoricalSession.objects.filter(pk=checkpoint.historical_session_id).update(
+                    total_booked=F('total_booked') + people
+                )
+                ResetCheckpoint.objects.filter(pk=checkpoint.pk).update(
+                    archived_rows=F('archived_rows') + len(chunk)
                 )
-            
-            session.booking_set.all().delete()
-            
-        self.stdout.write(self.style.SUCCESS('Successfully reset and archived past bookings.'))
\ No newline at end of file
+            moved += len(chunk)
+
+        self.stdout.write(f'  {occurrence}: archived {moved} bookings.')
+        return moved
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.24 on 2026-10-18 13:19
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def backfill_booked_number(apps, schema_editor):
+    Session = apps.get_model('open_hours', 'Session')
+    Booking = apps.get_model('bookings', 'Booking')
+    totals = (
+        Booking.objects.values('session_id')
+        .annotate(total=Sum('number_of_people'))
+        .order_by()
+    )
+    for row in totals:
+        Session.objects.filter(pk=row['session_id']).update(booked_number=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0001_initial'),
+        ('open_hours', '0010_alter_openinghour_close_alter_openinghour_open_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='booked_number',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(backfill_booked_number, migrations.RunPython.noop),
+    ]
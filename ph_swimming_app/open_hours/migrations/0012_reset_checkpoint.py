@@ -0,0 +1,33 @@
+# Generated by Django 4.2.24 on 2026-10-18 13:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_hours', '0011_session_booked_number'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalbooking',
+            name='attended',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='ResetCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reset_for', models.DateField()),
+                ('archived_rows', models.PositiveIntegerField(default=0)),
+                ('completed', models.BooleanField(default=False)),
+                ('historical_session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='open_hours.historicalsession')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='open_hours.session')),
+            ],
+            options={
+                'unique_together': {('session', 'reset_for')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.24 on 2026-10-18 13:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_hours', '0012_reset_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionOccurrence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('start_time', models.CharField(choices=[('09:00', '09:00'), ('10:00', '10:00'), ('11:00', '11:00'), ('12:00', '12:00'), ('13:00', '13:00'), ('14:00', '14:00'), ('15:00', '15:00'), ('16:00', '16:00')], max_length=5)),
+                ('booked_number', models.PositiveIntegerField(default=0)),
+                ('activity', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='open_hours.activity')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occurrences', to='open_hours.session')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date', 'start_time'], name='occurrence_date_start_idx')],
+                'unique_together': {('session', 'date')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.24 on 2026-10-18 13:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_hours', '0013_session_occurrence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalsession',
+            name='session_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
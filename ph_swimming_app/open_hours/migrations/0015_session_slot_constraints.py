@@ -0,0 +1,68 @@
+# Generated by Django 4.2.24 on 2026-10-18 13:28
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_slots(apps, schema_editor):
+    """
+    Folds sessions sharing a (session_day, start_time) into one before the
+    unique constraint goes on. The one with an activity (else the oldest)
+    keeps the slot and takes over the others' bookings, occurrences,
+    checkpoints and counters, so nothing is lost to the cascade.
+    """
+    Session = apps.get_model('open_hours', 'Session')
+    SessionOccurrence = apps.get_model('open_hours', 'SessionOccurrence')
+    ResetCheckpoint = apps.get_model('open_hours', 'ResetCheckpoint')
+    Booking = apps.get_model('bookings', 'Booking')
+    slots = (
+        Session.objects.values('session_day', 'start_time')
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+        .order_by()
+    )
+    for slot in slots:
+        kept, *duplicates = sorted(
+            Session.objects.filter(session_day=slot['session_day'], start_time=slot['start_time']),
+            key=lambda session: (session.activity_id is None, session.pk),
+        )
+        for duplicate in duplicates:
+            for occurrence in SessionOccurrence.objects.filter(session=duplicate):
+                same_day = SessionOccurrence.objects.filter(session=kept, date=occurrence.date).first()
+                if same_day is None:
+                    occurrence.session = kept
+                    occurrence.save()
+                    continue
+                Booking.objects.filter(occurrence=occurrence).update(occurrence=same_day)
+                same_day.booked_number += occurrence.booked_number
+                same_day.save()
+                occurrence.delete()
+            Booking.objects.filter(session=duplicate).update(session=kept)
+            kept_dates = set(ResetCheckpoint.objects.filter(session=kept).values_list('reset_for', flat=True))
+            ResetCheckpoint.objects.filter(session=duplicate).exclude(reset_for__in=kept_dates).update(session=kept)
+            kept.booked_number += duplicate.booked_number
+            duplicate.delete()
+        kept.save()
+    if schema_editor.connection.vendor == 'postgresql':
+        # Run the deferred FK checks now; ALTER TABLE refuses pending trigger events
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0002_booking_occurrence'),
+        ('open_hours', '0014_historicalsession_session_date'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='session',
+            index=models.Index(fields=['activity', 'session_day', 'start_time'], name='session_activity_slot_idx'),
+        ),
+        migrations.RunPython(merge_duplicate_slots, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='session',
+            constraint=models.UniqueConstraint(fields=('session_day', 'start_time'), name='unique_session_slot'),
+        ),
+    ]
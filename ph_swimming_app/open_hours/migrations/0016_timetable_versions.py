@@ -0,0 +1,45 @@
+# Generated by Django 4.2.24 on 2026-10-18 13:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_hours', '0015_session_slot_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimetableVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('status', models.CharField(choices=[('draft', 'Draft'), ('active', 'Active'), ('archived', 'Archived')], default='draft', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('activated_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='VersionSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_day', models.CharField(choices=[('Mon', 'Monday'), ('Tue', 'Tuesday'), ('Wed', 'Wednesday'), ('Thu', 'Thursday'), ('Fri', 'Friday'), ('Sat', 'Saturday'), ('Sun', 'Sunday')], max_length=10)),
+                ('start_time', models.CharField(choices=[('09:00', '09:00'), ('10:00', '10:00'), ('11:00', '11:00'), ('12:00', '12:00'), ('13:00', '13:00'), ('14:00', '14:00'), ('15:00', '15:00'), ('16:00', '16:00')], max_length=5)),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='open_hours.activity')),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slots', to='open_hours.timetableversion')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='timetableversion',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'active')), fields=('status',), name='one_active_timetable_version'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='versionslot',
+            unique_together={('version', 'session_day', 'start_time')},
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.24 on 2026-10-18 13:37
+
+from django.db import migrations, models
+
+
+# The variants as open_hours.images built them when this migration was
+# written, copied so later changes there cannot alter or break it
+VARIANTS = {
+    'thumbnail': {'width': 160, 'height': 160, 'crop': 'thumb'},
+    'card': {'width': 480, 'height': 320, 'crop': 'fill'},
+    'hero': {'width': 1600, 'height': 600, 'crop': 'fill'},
+}
+SRCSET_WIDTHS = [320, 480, 640, 960, 1280]
+CARD_SIZES = '(max-width: 600px) 100vw, 480px'
+
+
+def build_url(image, width, height=None, crop='fill'):
+    options = {'width': width, 'crop': crop, 'quality': 'auto', 'fetch_format': 'auto', 'secure': True}
+    if height:
+        options['height'] = height
+    return image.build_url(**options)
+
+
+def build_variants(image):
+    if not image or not getattr(image, 'public_id', None):
+        return {}
+    variants = {name: build_url(image, **options) for name, options in VARIANTS.items()}
+    variants['srcset'] = ', '.join(f'{build_url(image, width)} {width}w' for width in SRCSET_WIDTHS)
+    variants['sizes'] = CARD_SIZES
+    variants['public_id'] = image.public_id
+    variants['version'] = str(image.version or '')
+    return variants
+
+
+def build_existing_variants(apps, schema_editor):
+    Activity = apps.get_model('open_hours', 'Activity')
+    for activity in Activity.objects.exclude(activity_image=None).exclude(activity_image=''):
+        Activity.objects.filter(pk=activity.pk).update(image_variants=build_variants(activity.activity_image))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_hours', '0016_timetable_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.RunPython(build_existing_variants, migrations.RunPython.noop),
+    ]
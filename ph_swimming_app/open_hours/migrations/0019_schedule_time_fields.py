@@ -0,0 +1,100 @@
+# Generated by Django 4.2.24 on 2026-10-18 14:06
+
+import datetime
+from django.db import migrations, models
+
+
+def pad_sqlite_times(apps, schema_editor):
+    # PostgreSQL casts '09:00' to a time when the column type changes.
+    # SQLite keeps the text, so give it the seconds Django writes and compares.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for model_name, fields in [
+        ('HistoricalSession', ['start_time']),
+        ('OpeningHour', ['open', 'close']),
+        ('Session', ['start_time']),
+        ('SessionOccurrence', ['start_time']),
+        ('VersionSlot', ['start_time']),
+    ]:
+        table = schema_editor.quote_name(apps.get_model('open_hours', model_name)._meta.db_table)
+        for field in fields:
+            column = schema_editor.quote_name(field)
+            schema_editor.execute(f"UPDATE {table} SET {column} = {column} || ':00' WHERE length({column}) = 5")
+
+
+def end_of(start_time, duration):
+    # A copy of open_hours.models.end_of, so later changes there cannot break this
+    if start_time is None or duration is None:
+        return None
+    return (datetime.datetime.combine(datetime.date(2000, 1, 1), start_time) + duration).time()
+
+
+def fill_end_times(apps, schema_editor):
+    Activity = apps.get_model('open_hours', 'Activity')
+    durations = dict(Activity.objects.values_list('pk', 'duration'))
+    for model_name in ('Session', 'SessionOccurrence'):
+        rows = apps.get_model('open_hours', model_name).objects.exclude(activity=None)
+        for activity_id, start_time in set(rows.values_list('activity_id', 'start_time')):
+            rows.filter(activity_id=activity_id, start_time=start_time).update(
+                end_time=end_of(start_time, durations[activity_id])
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_hours', '0018_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='end_time',
+            field=models.TimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='sessionoccurrence',
+            name='end_time',
+            field=models.TimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='historicalsession',
+            name='start_time',
+            field=models.TimeField(),
+        ),
+        migrations.AlterField(
+            model_name='openinghour',
+            name='close',
+            field=models.TimeField(choices=[(datetime.time(9, 0), '09:00'), (datetime.time(10, 0), '10:00'), (datetime.time(11, 0), '11:00'), (datetime.time(12, 0), '12:00'), (datetime.time(13, 0), '13:00'), (datetime.time(14, 0), '14:00'), (datetime.time(15, 0), '15:00'), (datetime.time(16, 0), '16:00')]),
+        ),
+        migrations.AlterField(
+            model_name='openinghour',
+            name='open',
+            field=models.TimeField(choices=[(datetime.time(9, 0), '09:00'), (datetime.time(10, 0), '10:00'), (datetime.time(11, 0), '11:00'), (datetime.time(12, 0), '12:00'), (datetime.time(13, 0), '13:00'), (datetime.time(14, 0), '14:00'), (datetime.time(15, 0), '15:00'), (datetime.time(16, 0), '16:00')]),
+        ),
+        migrations.AlterField(
+            model_name='session',
+            name='start_time',
+            field=models.TimeField(choices=[(datetime.time(9, 0), '09:00'), (datetime.time(10, 0), '10:00'), (datetime.time(11, 0), '11:00'), (datetime.time(12, 0), '12:00'), (datetime.time(13, 0), '13:00'), (datetime.time(14, 0), '14:00'), (datetime.time(15, 0), '15:00'), (datetime.time(16, 0), '16:00')]),
+        ),
+        migrations.AlterField(
+            model_name='sessionoccurrence',
+            name='start_time',
+            field=models.TimeField(choices=[(datetime.time(9, 0), '09:00'), (datetime.time(10, 0), '10:00'), (datetime.time(11, 0), '11:00'), (datetime.time(12, 0), '12:00'), (datetime.time(13, 0), '13:00'), (datetime.time(14, 0), '14:00'), (datetime.time(15, 0), '15:00'), (datetime.time(16, 0), '16:00')]),
+        ),
+        migrations.AlterField(
+            model_name='versionslot',
+            name='start_time',
+            field=models.TimeField(choices=[(datetime.time(9, 0), '09:00'), (datetime.time(10, 0), '10:00'), (datetime.time(11, 0), '11:00'), (datetime.time(12, 0), '12:00'), (datetime.time(13, 0), '13:00'), (datetime.time(14, 0), '14:00'), (datetime.time(15, 0), '15:00'), (datetime.time(16, 0), '16:00')]),
+        ),
+        migrations.AddIndex(
+            model_name='session',
+            index=models.Index(fields=['session_day', 'end_time'], name='session_day_end_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sessionoccurrence',
+            index=models.Index(fields=['date', 'end_time'], name='occurrence_date_end_idx'),
+        ),
+        migrations.RunPython(pad_sqlite_times, migrations.RunPython.noop),
+        migrations.RunPython(fill_end_times, migrations.RunPython.noop),
+    ]
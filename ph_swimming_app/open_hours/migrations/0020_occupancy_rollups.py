@@ -0,0 +1,45 @@
+# Generated by Django 4.2.24 on 2026-10-18 14:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_hours', '0019_schedule_time_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('last_session_id', models.BigIntegerField(default=0)),
+                ('last_booking_id', models.BigIntegerField(default=0)),
+                ('refreshed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OccupancyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_day', models.CharField(choices=[('Mon', 'Monday'), ('Tue', 'Tuesday'), ('Wed', 'Wednesday'), ('Thu', 'Thursday'), ('Fri', 'Friday'), ('Sat', 'Saturday'), ('Sun', 'Sunday')], max_length=10)),
+                ('start_time', models.TimeField()),
+                ('session_date', models.DateField()),
+                ('sessions', models.PositiveIntegerField(default=0)),
+                ('bookings', models.PositiveIntegerField(default=0)),
+                ('headcount', models.PositiveIntegerField(default=0)),
+                ('attended', models.PositiveIntegerField(default=0)),
+                ('capacity', models.PositiveIntegerField(default=0)),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='open_hours.activity')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['activity', 'session_day', 'session_date'], name='occupancy_activity_day_idx'), models.Index(fields=['session_date'], name='occupancy_date_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='occupancyrollup',
+            constraint=models.UniqueConstraint(fields=('activity', 'session_day', 'start_time', 'session_date'), name='unique_occupancy_rollup'),
+        ),
+    ]
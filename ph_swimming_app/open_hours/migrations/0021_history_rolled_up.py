@@ -0,0 +1,40 @@
+# Generated by Django 4.2.24 on 2026-10-18 14:50
+
+from django.db import migrations, models
+
+
+def recount_history(apps, schema_editor):
+    """
+    The ids watermark could have passed history that committed late, so
+    the rollups are rebuilt: every HistoricalSession starts out not rolled
+    up and the next refresh_occupancy counts it again.
+    """
+    apps.get_model('open_hours', 'OccupancyRollup').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_hours', '0020_occupancy_rollups'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='rollupwatermark',
+            name='last_booking_id',
+        ),
+        migrations.RemoveField(
+            model_name='rollupwatermark',
+            name='last_session_id',
+        ),
+        migrations.AddField(
+            model_name='historicalsession',
+            name='rolled_up',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='historicalsession',
+            index=models.Index(condition=models.Q(('rolled_up', False)), fields=['id'], name='history_to_roll_up_idx'),
+        ),
+        migrations.RunPython(recount_history, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,13 @@
-from django.db import models
-from django.db.models import Sum
+from django.db import models, transaction
+from django.db.models import Case, DateField, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth.models import User
 from django.utils import timezone
-from datetime import timedelta, datetime
+from django.utils.dateparse import parse_time
+from datetime import date, datetime, time, timedelta
 from cloudinary.models import CloudinaryField
+from .images import build_variants
+from .capacity import remember_places, forget_places
 
 # Create your models here.
 DAY_CHOICES = [
@@ -11,6 +15,7 @@ DAY_CHOICES = [
     ('Thu', 'Thursday'), ('Fri', 'Friday'), ('Sat', 'Saturday'),
     ('Sun', 'Sunday')
 ]
+DAY_CODES = [code for code, _ in DAY_CHOICES]
 
 DURATION_CHOICE = [
     ('00:30', '30 minutes'), 
@@ -19,19 +24,59 @@ DURATION_CHOICE = [
     ('02:00', '2 hours')
 ]
  
-SESSION_CHOICE = [
-    ('09:00', '09:00'), ('10:00', '10:00'), ('11:00', '11:00'),
-    ('12:00', '12:00'), ('13:00', '13:00'), ('14:00', '14:00'), 
-    ('15:00', '15:00'), ('16:00', '16:00'),
-]
+# Hourly slots from 09:00; stored as times, shown and posted as 'HH:MM'
+SESSION_TIMES = [time(hour) for hour in range(9, 17)]
+SESSION_CHOICE = [(slot, f'{slot:%H:%M}') for slot in SESSION_TIMES]
+
+
+def slot_label(value):
+    """
+    '09:00' for a schedule time, as the JSON endpoints and scripts use it.
+    """
+    return None if value is None else value.strftime('%H:%M')
+
+
+def parse_slot(value):
+    """
+    The time for '09:00' (or '09:00:00'), or None if it is not a time.
+    """
+    if isinstance(value, time) or value is None:
+        return value
+    try:
+        return parse_time(str(value))
+    except ValueError:
+        return None
+
+
+def end_of(start_time, duration):
+    """
+    When something starting at start_time and lasting duration finishes.
+    """
+    if start_time is None or duration is None:
+        return None
+    return (datetime.combine(date(2000, 1, 1), start_time) + duration).time()
+
+
+def next_run_date(session_day, end_time, now=None):
+    """
+    The date of a weekly slot's next run that has not finished by `now`
+    (default timezone.localtime()): today until its end time, then a week on.
+    """
+    now = now or timezone.localtime()
+    today = now.date()
+    days_ahead = (DAY_CODES.index(session_day) - today.weekday()) % 7
+    if days_ahead == 0 and end_time is not None and end_time <= now.time():
+        days_ahead = 7
+    return today + timedelta(days=days_ahead)
+
 
 class OpeningHour(models.Model):
     day = models.CharField(max_length=10, choices=DAY_CHOICES)
-    open = models.CharField(max_length=5, choices=SESSION_CHOICE)
-    close = models.CharField(max_length=5, choices=SESSION_CHOICE)
+    open = models.TimeField(choices=SESSION_CHOICE)
+    close = models.TimeField(choices=SESSION_CHOICE)
 
     def __str__(self):
-        return f"{self.day}: {self.open} - {self.close}"
+        return f"{self.day}: {slot_label(self.open)} - {slot_label(self.close)}"
 
 class Activity(models.Model):
     activity_name = models.CharField(max_length=100)
@@ -40,21 +85,73 @@ class Activity(models.Model):
     price = models.DecimalField(max_digits=6, decimal_places=2)
     duration = models.DurationField(default=timedelta(hours=1))
     activity_image = CloudinaryField('image', null=True, blank=True)
+    # Sized URLs for activity_image, built on save (see images.py)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
 
     def __str__(self):
         return self.activity_name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        activity = super().from_db(db, field_names, values)
+        # Lets save() tell when the stored end times need moving
+        activity._saved_duration = activity.__dict__.get('duration')
+        return activity
+
+    def save(self, *args, **kwargs):
+        # The field uploads a new image during save, so variants come after.
+        # One transaction, so cached fragments are dropped after both writes.
+        with transaction.atomic(savepoint=False):
+            duration_changed = (
+                not self._state.adding and getattr(self, '_saved_duration', self.duration) != self.duration
+            )
+            super().save(*args, **kwargs)
+            variants = build_variants(self.activity_image)
+            if variants != self.image_variants:
+                self.image_variants = variants
+                Activity.objects.filter(pk=self.pk).update(image_variants=variants)
+            if duration_changed:
+                self.sync_end_times()
+        self._saved_duration = self.duration
+
+    def sync_end_times(self):
+        """
+        Recomputes the stored end times of this activity's sessions and
+        upcoming occurrences, one UPDATE per start time.
+        """
+        upcoming = SessionOccurrence.objects.filter(activity=self, date__gte=timezone.localdate())
+        for rows in (Session.objects.filter(activity=self), upcoming):
+            for start_time in set(rows.values_list('start_time', flat=True)):
+                rows.filter(start_time=start_time).update(end_time=end_of(start_time, self.duration))
+
     class Meta:
         verbose_name_plural = "activities"
 
 class Session(models.Model):
     activity = models.ForeignKey(Activity, on_delete=models.CASCADE, null=True, blank=True)
     session_day = models.CharField(max_length=10, choices=DAY_CHOICES, default='Monday')
-    start_time = models.CharField(max_length=5, choices=SESSION_CHOICE)
+    start_time = models.TimeField(choices=SESSION_CHOICE)
+    # start_time plus the activity's duration; set by save(), by the bulk
+    # scheduling paths and by Activity.sync_end_times()
+    end_time = models.TimeField(null=True, blank=True, editable=False)
+    # People booked across all of the session's runs, kept in step by
+    # Booking.save()/delete(); capacity is per run (SessionOccurrence)
+    booked_number = models.PositiveIntegerField(default=0, db_index=True)
     
     @property
     def people_booked(self):
-       return self.booking_set.aggregate(Sum('number_of_people'))['number_of_people__sum'] or 0
+        """
+        People booked on the next run; annotated by with_next_run(),
+        otherwise looked up.
+        """
+        if not hasattr(self, 'next_booked'):
+            self.next_booked = (
+                SessionOccurrence.objects.filter(
+                    session=self, date=next_run_date(self.session_day, self.end_time)
+                ).values_list('booked_number', flat=True).first()
+                or 0
+            )
+        return self.next_booked
 
     @property
     def available_places(self):
@@ -67,32 +164,357 @@ class Session(models.Model):
     def is_full(self):
         return self.available_places <= 0
         
+    def save(self, *args, **kwargs):
+        self.start_time = parse_slot(self.start_time) or self.start_time
+        self.end_time = end_of(self.start_time, self.activity.duration if self.activity_id else None)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'start_time', 'activity'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'end_time'}
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def on_at(cls, day, at):
+        """
+        Sessions running on `day` (a DAY_CHOICES code) at time `at`.
+        """
+        return cls.objects.filter(session_day=day, start_time__lte=at, end_time__gt=at)
+
+    @classmethod
+    def overlapping(cls, day, start_time, end_time):
+        """
+        Sessions on `day` that overlap start_time to end_time.
+        """
+        return cls.objects.filter(session_day=day, start_time__lt=end_time, end_time__gt=start_time)
+
+    @classmethod
+    def with_next_run(cls, sessions, now=None):
+        """
+        Annotates next_booked, the people booked on each session's next run
+        (the occurrence next_for() picks), and places_left from it, in the
+        same query.
+        """
+        now = now or timezone.localtime()
+        today = now.date()
+        next_dates = []
+        for code in DAY_CODES:
+            run = next_run_date(code, None, now)
+            if run == today:
+                next_dates.append(When(session_day=code, end_time__lte=now.time(), then=Value(today + timedelta(days=7))))
+            next_dates.append(When(session_day=code, then=Value(run)))
+        booked = SessionOccurrence.objects.filter(session=OuterRef('pk'), date=OuterRef('next_date'))
+        return sessions.annotate(
+            next_date=Case(*next_dates, output_field=DateField()),
+        ).annotate(
+            next_booked=Coalesce(Subquery(booked.values('booked_number')[:1]), 0),
+            places_left=Coalesce(F('activity__max_number'), 0) - F('next_booked'),
+        )
+
+    @classmethod
+    def reserve_places(cls, session_id, number, override=False, occurrence_id=None):
+        """
+        Adds `number` people to the dated occurrence the booking belongs to
+        (the session's next run if not given) and to the session's counter.
+        The occurrence row is locked for the rest of the transaction so two
+        workers cannot both take the last places on that run. Returns False
+        if the run does not have enough room (unless override is set).
+        Must be called inside transaction.atomic().
+        """
+        if occurrence_id is None:
+            occurrence_id = SessionOccurrence.next_for(cls.objects.get(pk=session_id)).pk
+        run = (
+            SessionOccurrence.objects.select_for_update(of=('self',))
+            .select_related('activity')
+            .get(pk=occurrence_id)
+        )
+        places_left = run.available_places
+        # The cached count is the next run's; other runs only clear it
+        if run.is_next_run():
+            remember = lambda places: remember_places({session_id: places})
+        else:
+            remember = lambda places: forget_places(session_id)
+        if not override and number > places_left:
+            transaction.on_commit(lambda: remember(places_left))
+            return False
+        SessionOccurrence.objects.filter(pk=occurrence_id).update(booked_number=F('booked_number') + number)
+        cls.objects.filter(pk=session_id).update(booked_number=F('booked_number') + number)
+        transaction.on_commit(lambda: remember(places_left - number))
+        return True
+
+    @classmethod
+    def release_places(cls, session_id, number, occurrence_id=None):
+        """
+        Takes `number` people off the session's booked counter (and the
+        occurrence's, if given).
+        """
+        cls.objects.filter(pk=session_id).update(
+            booked_number=Greatest(F('booked_number') - number, 0)
+        )
+        if occurrence_id:
+            SessionOccurrence.objects.filter(pk=occurrence_id).update(
+                booked_number=Greatest(F('booked_number') - number, 0)
+            )
+        transaction.on_commit(lambda: forget_places(session_id))
+
+    def __str__(self):
+        activity_name = self.activity.activity_name if self.activity else "No Activity"
+        return f"{activity_name} on {self.get_session_day_display()} starting at {slot_label(self.start_time)}"
+
+    class Meta:
+        constraints = [
+            # One session per timetable slot; add_session looks slots up by this pair
+            models.UniqueConstraint(fields=['session_day', 'start_time'], name='unique_session_slot'),
+        ]
+        indexes = [
+            # get_sessions: one activity's sessions in day/time order
+            models.Index(fields=['activity', 'session_day', 'start_time'], name='session_activity_slot_idx'),
+            # on_at / overlapping: range checks against the stored end time
+            models.Index(fields=['session_day', 'end_time'], name='session_day_end_idx'),
+        ]
+
+
+class SessionOccurrence(models.Model):
+    """
+    One dated run of a weekly Session, e.g. Monday 09:00 on 2026-10-19.
+    Generated from the timetable so bookings and reports can be queried
+    by date range on the (date, start_time) index.
+    """
+    session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name='occurrences')
+    activity = models.ForeignKey(Activity, on_delete=models.CASCADE, null=True, blank=True)
+    date = models.DateField()
+    start_time = models.TimeField(choices=SESSION_CHOICE)
+    # Copied from the session, like start_time and activity
+    end_time = models.TimeField(null=True, blank=True, editable=False)
+    # People booked onto this date; what capacity is checked against
+    booked_number = models.PositiveIntegerField(default=0)
+
     @property
-    def end_time(self):
+    def available_places(self):
         if self.activity:
-            start_time_obj = datetime.strptime(self.start_time, '%H:%M').time()
-            start_datetime = datetime.combine(timezone.now().date(), start_time_obj)
-            end_datetime = start_datetime + self.activity.duration
-            return end_datetime.time()
-        return None
-        
+            return self.activity.max_number - self.booked_number
+        return 0
+
+    @property
+    def is_full(self):
+        return self.available_places <= 0
+
+    def save(self, *args, **kwargs):
+        self.start_time = parse_slot(self.start_time) or self.start_time
+        if self.end_time is None and self.activity_id:
+            self.end_time = end_of(self.start_time, self.activity.duration)
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def on_at(cls, moment):
+        """
+        Occurrences running at a datetime, e.g. timezone.localtime().
+        """
+        return cls.objects.filter(date=moment.date(), start_time__lte=moment.time(), end_time__gt=moment.time())
+
+    def is_next_run(self, now=None):
+        """
+        Whether this is the run next_for() would pick for its session.
+        """
+        return self.date == next_run_date(DAY_CODES[self.date.weekday()], self.end_time, now)
+
+    @classmethod
+    def generate(cls, start, end):
+        """
+        Creates the occurrences of every timetabled session between two
+        dates (inclusive). Existing occurrences are left alone.
+        """
+        dates_by_day = {}
+        day = start
+        while day <= end:
+            dates_by_day.setdefault(DAY_CODES[day.weekday()], []).append(day)
+            day += timedelta(days=1)
+
+        sessions = Session.objects.filter(session_day__in=dates_by_day).values(
+            'id', 'activity_id', 'session_day', 'start_time', 'end_time'
+        )
+        cls.objects.bulk_create(
+            [
+                cls(
+                    session_id=session['id'],
+                    activity_id=session['activity_id'],
+                    date=date,
+                    start_time=session['start_time'],
+                    end_time=session['end_time'],
+                )
+                for session in sessions
+                for date in dates_by_day[session['session_day']]
+            ],
+            ignore_conflicts=True,
+        )
+
+    @classmethod
+    def next_for(cls, session, now=None):
+        """
+        Returns the session's next occurrence that has not finished by
+        `now` (default timezone.localtime()), creating it if the timetable
+        has not been generated that far.
+        """
+        occurrence, _ = cls.objects.get_or_create(
+            session=session,
+            date=next_run_date(session.session_day, session.end_time, now),
+            defaults={
+                'activity_id': session.activity_id, 'start_time': session.start_time, 'end_time': session.end_time,
+            },
+        )
+        return occurrence
+
     def __str__(self):
         activity_name = self.activity.activity_name if self.activity else "No Activity"
-        return f"{activity_name} on {self.get_session_day_display()} starting at {self.start_time}"
-    
+        return f"{activity_name} on {self.date:%a %d %b %Y} starting at {slot_label(self.start_time)}"
+
+    class Meta:
+        unique_together = ('session', 'date')
+        indexes = [
+            models.Index(fields=['date', 'start_time'], name='occurrence_date_start_idx'),
+            models.Index(fields=['date', 'end_time'], name='occurrence_date_end_idx'),
+        ]
+
+
+class TimetableVersion(models.Model):
+    """
+    A named copy of the weekly timetable. Drafts are edited alongside the
+    live week; activating one copies it onto the Session rows in one go
+    and archives the version that was active before.
+    """
+    DRAFT = 'draft'
+    ACTIVE = 'active'
+    ARCHIVED = 'archived'
+    STATUS_CHOICES = [(DRAFT, 'Draft'), (ACTIVE, 'Active'), (ARCHIVED, 'Archived')]
+
+    name = models.CharField(max_length=100, unique=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=DRAFT)
+    created_at = models.DateTimeField(auto_now_add=True)
+    activated_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.get_status_display()})"
+
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['status'], condition=models.Q(status='active'), name='one_active_timetable_version'
+            ),
+        ]
 
+
+class VersionSlot(models.Model):
     """
-    Tracking of past bookings information
+    One occupied slot of a timetable version. Slots a version does not
+    list are empty when it is active.
     """
-    class HistoricalBooking(models.Model):
-        user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
-        historical_session = models.ForeignKey('HistoricalSession', on_delete=models.CASCADE)
-        number_of_people = models.IntegerField(default=1)
-        booking_date = models.DateTimeField()
+    version = models.ForeignKey(TimetableVersion, on_delete=models.CASCADE, related_name='slots')
+    session_day = models.CharField(max_length=10, choices=DAY_CHOICES)
+    start_time = models.TimeField(choices=SESSION_CHOICE)
+    activity = models.ForeignKey(Activity, on_delete=models.CASCADE)
+
+    def __str__(self):
+        return f"{self.activity} on {self.get_session_day_display()} starting at {slot_label(self.start_time)}"
+
+    class Meta:
+        unique_together = ('version', 'session_day', 'start_time')
+
+
+class IdempotencyKey(models.Model):
+    """
+    The stored response to a POST sent with an idempotency key, replayed
+    when the same request is retried. `key` is a digest of the endpoint,
+    the user and the client's key. A claim expires after
+    IDEMPOTENCY_CLAIM_LEASE, a stored response after IDEMPOTENCY_KEY_TTL.
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+    request_hash = models.CharField(max_length=64)
+    # 0 while the first request is still running
+    status_code = models.PositiveSmallIntegerField(default=0)
+    content_type = models.CharField(max_length=100, blank=True)
+    location = models.CharField(max_length=500, blank=True)
+    body = models.BinaryField(blank=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+
+"""
+Tracking of past bookings information
+"""
+class HistoricalBooking(models.Model):
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    historical_session = models.ForeignKey('HistoricalSession', on_delete=models.CASCADE)
+    number_of_people = models.IntegerField(default=1)
+    booking_date = models.DateTimeField()
+    attended = models.BooleanField(default=False)
 
 class HistoricalSession(models.Model):
     activity = models.ForeignKey(Activity, on_delete=models.CASCADE, null=True, blank=True)
     session_day = models.CharField(max_length=10)
-    start_time = models.CharField(max_length=5)
+    start_time = models.TimeField()
     total_booked = models.IntegerField(default=0)
-    reset_date = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    reset_date = models.DateTimeField(auto_now_add=True)
+    # The date the session actually ran
+    session_date = models.DateField(null=True, blank=True)
+    # Counted into the occupancy rollups (see rollups.refresh_occupancy)
+    rolled_up = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(rolled_up=False), name='history_to_roll_up_idx'),
+        ]
+
+class ResetCheckpoint(models.Model):
+    """
+    Progress of reset_bookings for one session on one date, so an
+    interrupted run carries on where it stopped.
+    """
+    session = models.ForeignKey(Session, on_delete=models.CASCADE)
+    reset_for = models.DateField()
+    historical_session = models.ForeignKey(HistoricalSession, on_delete=models.CASCADE)
+    archived_rows = models.PositiveIntegerField(default=0)
+    completed = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('session', 'reset_for')
+
+class OccupancyRollup(models.Model):
+    """
+    Totals for one activity run on one date, built from the history tables
+    by rollups.refresh_occupancy() so reports never read the raw rows.
+    """
+    activity = models.ForeignKey(Activity, on_delete=models.CASCADE)
+    session_day = models.CharField(max_length=10, choices=DAY_CHOICES)
+    start_time = models.TimeField()
+    session_date = models.DateField()
+    # Archived runs of the slot on that date; normally one
+    sessions = models.PositiveIntegerField(default=0)
+    bookings = models.PositiveIntegerField(default=0)
+    headcount = models.PositiveIntegerField(default=0)
+    # People on bookings marked as attended
+    attended = models.PositiveIntegerField(default=0)
+    # The activity's max_number for each run, as it was when rolled up
+    capacity = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.activity} on {self.session_date} at {slot_label(self.start_time)}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['activity', 'session_day', 'start_time', 'session_date'], name='unique_occupancy_rollup'
+            ),
+        ]
+        indexes = [
+            # The report: one activity on some weekdays over a date range
+            models.Index(fields=['activity', 'session_day', 'session_date'], name='occupancy_activity_day_idx'),
+            # The report across all activities
+            models.Index(fields=['session_date'], name='occupancy_date_idx'),
+        ]
+
+
+class RollupWatermark(models.Model):
+    """
+    One row per rollup, locked while it refreshes, with the time of the
+    last refresh. What has been counted is marked on the history itself.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    refreshed_at = models.DateTimeField(null=True, blank=True)
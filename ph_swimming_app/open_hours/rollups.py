@@ -0,0 +1,143 @@
+from collections import Counter, defaultdict
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+from .models import DAY_CHOICES, HistoricalBooking, HistoricalSession, OccupancyRollup, RollupWatermark
+
+"""
+Occupancy rollups: bookings, headcount, attendance and capacity per
+activity, weekday, slot and date, kept in OccupancyRollup.
+
+A refresh counts whole archived runs. reset_bookings moves a run's
+bookings into the history a chunk per transaction, so a run is only
+counted once its ResetCheckpoint is completed; the HistoricalSession is
+then marked rolled_up in the same transaction as the rollups it went
+into. Nothing depends on the order ids commit in, so a refresh may
+overlap a reset. Sessions and bookings are counted separately, so a run
+nobody booked still adds its capacity. Run it after reset_bookings (see
+the refresh_occupancy command); reports then read only the rollups.
+
+History without an activity or a session date (archived before the date
+was recorded) cannot be placed and is skipped.
+"""
+
+OCCUPANCY = 'occupancy'
+COUNTS = ('sessions', 'bookings', 'headcount', 'attended', 'capacity')
+DAY_ORDER = {code: index for index, (code, _) in enumerate(DAY_CHOICES)}
+
+
+def _add_to_rollups(deltas):
+    """
+    Adds {(activity_id, session_day, start_time, session_date): Counter}
+    to the stored rollups, creating the missing ones.
+    """
+    existing = {
+        (rollup.activity_id, rollup.session_day, rollup.start_time, rollup.session_date): rollup
+        for rollup in OccupancyRollup.objects.filter(
+            activity_id__in={key[0] for key in deltas},
+            session_date__in={key[3] for key in deltas},
+        )
+    }
+    changed = []
+    created = []
+    for key, delta in deltas.items():
+        rollup = existing.get(key)
+        if rollup is None:
+            activity_id, session_day, start_time, session_date = key
+            rollup = OccupancyRollup(
+                activity_id=activity_id, session_day=session_day, start_time=start_time, session_date=session_date
+            )
+            created.append(rollup)
+        else:
+            changed.append(rollup)
+        for field in COUNTS:
+            setattr(rollup, field, getattr(rollup, field) + delta[field])
+    OccupancyRollup.objects.bulk_update(changed, COUNTS)
+    OccupancyRollup.objects.bulk_create(created)
+
+
+def refresh_occupancy(batch_size=5000):
+    """
+    Rolls up the runs archived since the last refresh, batch_size runs per
+    transaction. Returns the number of (sessions, bookings) read.
+    """
+    read_sessions = read_bookings = 0
+    while True:
+        with transaction.atomic():
+            # Locked, so two refreshes cannot count the same runs
+            watermark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=OCCUPANCY)
+            sessions = list(
+                HistoricalSession.objects.filter(rolled_up=False)
+                # Still being archived, so more bookings may follow
+                .exclude(resetcheckpoint__completed=False)
+                .order_by('pk')
+                .values('pk', 'activity_id', 'session_day', 'start_time', 'session_date', 'activity__max_number')
+                [:batch_size]
+            )
+            if not sessions:
+                break
+            session_ids = [row['pk'] for row in sessions]
+            bookings = {
+                row['historical_session_id']: row
+                for row in HistoricalBooking.objects.filter(historical_session_id__in=session_ids)
+                .values('historical_session_id')
+                .annotate(
+                    bookings=Count('pk'),
+                    headcount=Sum('number_of_people'),
+                    attended=Sum('number_of_people', filter=Q(attended=True), default=0),
+                )
+                .order_by()
+            }
+
+            deltas = defaultdict(Counter)
+            for row in sessions:
+                booked = bookings.get(row['pk'])
+                read_bookings += booked['bookings'] if booked else 0
+                if row['activity_id'] is None or row['session_date'] is None:
+                    continue
+                delta = deltas[row['activity_id'], row['session_day'], row['start_time'], row['session_date']]
+                delta['sessions'] += 1
+                delta['capacity'] += row['activity__max_number']
+                if booked:
+                    for field in ('bookings', 'headcount', 'attended'):
+                        delta[field] += booked[field]
+            _add_to_rollups(deltas)
+
+            HistoricalSession.objects.filter(pk__in=session_ids).update(rolled_up=True)
+            watermark.refreshed_at = timezone.now()
+            watermark.save()
+        read_sessions += len(sessions)
+        if len(sessions) < batch_size:
+            break
+    return read_sessions, read_bookings
+
+
+def occupancy_report(activity=None, days=None, start=None, end=None):
+    """
+    Totals and fill rate per activity, weekday and slot, summed from the
+    rollups in one query. Fill rate is headcount over capacity, in percent.
+    """
+    rollups = OccupancyRollup.objects.all()
+    if activity:
+        rollups = rollups.filter(activity=activity)
+    if days:
+        rollups = rollups.filter(session_day__in=days)
+    if start:
+        rollups = rollups.filter(session_date__gte=start)
+    if end:
+        rollups = rollups.filter(session_date__lte=end)
+    rows = list(
+        rollups.values('activity_id', 'activity__activity_name', 'session_day', 'start_time')
+        .annotate(**{f'total_{field}': Sum(field) for field in COUNTS})
+        .order_by()
+    )
+    for row in rows:
+        capacity = row['total_capacity']
+        row['fill_rate'] = round(100 * row['total_headcount'] / capacity, 1) if capacity else None
+        row['attendance_rate'] = (
+            round(100 * row['total_attended'] / row['total_headcount'], 1) if row['total_headcount'] else None
+        )
+    rows.sort(key=lambda row: (
+        row['activity__activity_name'], DAY_ORDER.get(row['session_day'], len(DAY_ORDER)), row['start_time']
+    ))
+    return rows
@@ -0,0 +1,142 @@
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+from .models import Session, Activity, SessionOccurrence, SESSION_TIMES, end_of, parse_slot, slot_label
+from .timetable import bump_version
+from .events import publish_timetable_change
+
+"""
+Batch placement of activities onto timetable slots.
+
+Each day's slots are read once and turned into two bitmaps, bit i standing
+for the i-th SESSION_TIMES slot: which slots exist and which already hold
+an activity. A placement needing n hours starting at slot s is the mask
+((1 << n) - 1) << s, so checking it is a couple of AND operations, and
+placements earlier in the same batch are seen simply by OR-ing them in.
+"""
+
+
+class ScheduleError(Exception):
+    pass
+
+
+def slots_needed(activity):
+    """
+    Number of consecutive 1-hour slots an activity takes up.
+    """
+    total_minutes = activity.duration.total_seconds() / 60
+    needed = int(total_minutes / 60)
+    if total_minutes % 60 != 0:
+        needed += 1
+    return needed
+
+
+class DayOccupancy:
+    def __init__(self, sessions):
+        self.sessions = {}
+        self.existing = 0
+        self.occupied = 0
+        for session in sessions:
+            if session.start_time not in SESSION_TIMES:
+                continue
+            bit = 1 << SESSION_TIMES.index(session.start_time)
+            self.sessions[session.start_time] = session
+            self.existing |= bit
+            if session.activity_id:
+                self.occupied |= bit
+
+    def place(self, start_time, needed):
+        """
+        Claims `needed` slots from `start_time`, returning their sessions.
+        """
+        start = SESSION_TIMES.index(start_time)
+        if start + needed > len(SESSION_TIMES):
+            raise ScheduleError('Activity does not fit in remaining slots.')
+        mask = ((1 << needed) - 1) << start
+        missing = mask & ~self.existing
+        if missing:
+            raise ScheduleError(f'Session slot at {slot_label(self._first_time(missing))} does not exist.')
+        clash = mask & self.occupied
+        if clash:
+            raise ScheduleError(f'Session at {slot_label(self._first_time(clash))} already booked.')
+        self.occupied |= mask
+        return [self.sessions[SESSION_TIMES[start + i]] for i in range(needed)]
+
+    @staticmethod
+    def _first_time(bits):
+        return SESSION_TIMES[(bits & -bits).bit_length() - 1]
+
+
+def schedule_placements(placements):
+    """
+    Places every {"session_day", "start_time", "activity"} item, or none.
+    Returns (ok, results) with one {"status", "message"} result per item.
+    """
+    results = []
+    cleaned = []
+    for item in placements:
+        day = item.get('session_day')
+        label = item.get('start_time')
+        activity_id = item.get('activity')
+        start_time = parse_slot(label)
+        if not all([day, label, activity_id]):
+            results.append({'status': 'error', 'message': 'All fields are required.'})
+        elif start_time not in SESSION_TIMES:
+            results.append({'status': 'error', 'message': f'Session slot at {label} does not exist.'})
+        else:
+            results.append(None)
+        cleaned.append((day, start_time, str(activity_id)))
+
+    activity_ids = {activity_id for _, _, activity_id in cleaned if activity_id.isdigit()}
+    activities = {str(pk): activity for pk, activity in Activity.objects.in_bulk(activity_ids).items()}
+
+    with transaction.atomic():
+        days = {day for day, _, _ in cleaned if day}
+        by_day = {}
+        for session in (
+            Session.objects.select_for_update()
+            .filter(session_day__in=days)
+            .only('id', 'session_day', 'start_time', 'activity_id')
+        ):
+            by_day.setdefault(session.session_day, []).append(session)
+        occupancy = {day: DayOccupancy(by_day.get(day, [])) for day in days}
+
+        changed = []
+        for index, (day, start_time, activity_id) in enumerate(cleaned):
+            if results[index] is not None:
+                continue
+            activity = activities.get(activity_id)
+            if activity is None:
+                results[index] = {'status': 'error', 'message': 'Selected activity does not exist.'}
+                continue
+            try:
+                sessions = occupancy[day].place(start_time, slots_needed(activity))
+            except ScheduleError as e:
+                results[index] = {'status': 'error', 'message': str(e)}
+                continue
+            for session in sessions:
+                session.activity = activity
+                session.end_time = end_of(session.start_time, activity.duration)
+            changed += sessions
+            results[index] = {'status': 'success', 'message': 'Activity assigned successfully!'}
+
+        ok = bool(results) and all(result['status'] == 'success' for result in results)
+        if not ok:
+            return False, results
+
+        Session.objects.bulk_update(changed, ['activity', 'end_time'])
+
+        # bulk_update skips the Session signals, so do their work once here
+        SessionOccurrence.objects.filter(
+            session_id__in=[session.pk for session in changed], date__gte=timezone.localdate()
+        ).update(**{
+            field: Subquery(Session.objects.filter(pk=OuterRef('session_id')).values(field)[:1])
+            for field in ('activity_id', 'end_time')
+        })
+
+        transaction.on_commit(bump_version)
+        for session in changed:
+            change = {'activity': session.activity_id, 'day': session.session_day, 'start_time': session.start_time}
+            transaction.on_commit(lambda change=change: publish_timetable_change(**change))
+
+    return True, results
@@ -0,0 +1,35 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import Session, Activity, SessionOccurrence
+from .timetable import bump_version
+from .events import publish_timetable_change
+
+
+@receiver(post_save, sender=Session)
+@receiver(post_delete, sender=Session)
+@receiver(post_save, sender=Activity)
+@receiver(post_delete, sender=Activity)
+def timetable_changed(sender, instance, **kwargs):
+    """
+    Invalidates the timetable snapshot once the change is committed
+    and tells live clients which part of the week moved.
+    """
+    transaction.on_commit(bump_version)
+    if sender is Session:
+        change = {'activity': instance.activity_id, 'day': instance.session_day, 'start_time': instance.start_time}
+    else:
+        change = {'activity': instance.pk}
+    transaction.on_commit(lambda: publish_timetable_change(**change))
+
+
+@receiver(post_save, sender=Session)
+def sync_future_occurrences(sender, instance, created, **kwargs):
+    """
+    Keeps upcoming dated runs in line with a changed timetable slot.
+    """
+    if not created:
+        SessionOccurrence.objects.filter(session=instance, date__gte=timezone.localdate()).update(
+            activity_id=instance.activity_id, start_time=instance.start_time, end_time=instance.end_time
+        )
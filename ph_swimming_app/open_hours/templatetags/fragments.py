@@ -0,0 +1,36 @@
+from django import template
+from open_hours.fragments import FRAGMENTS, count_lookup, count_miss
+from open_hours.timetable import current_version
+
+register = template.Library()
+
+
+def _check(name):
+    if name not in FRAGMENTS:
+        raise template.TemplateSyntaxError(f"Unknown fragment '{name}'; add it to open_hours.fragments.FRAGMENTS.")
+
+
+@register.simple_tag(takes_context=True)
+def fragment_version(context, name):
+    """
+    {% fragment_version "name" as version %}
+
+    Counts a lookup of the fragment and returns the data version for its
+    {% cache %} tag to vary on.
+    """
+    _check(name)
+    count_lookup(name)
+    # One version lookup per page, however many fragments it has
+    if 'fragment_version' not in context.render_context:
+        context.render_context['fragment_version'] = current_version()
+    return context.render_context['fragment_version']
+
+
+@register.simple_tag
+def fragment_miss(name):
+    """
+    {% fragment_miss "name" %}, inside the {% cache %} block.
+    """
+    _check(name)
+    count_miss(name)
+    return ''
@@ -0,0 +1,14 @@
+import uuid
+from django import template
+from django.utils.html import format_html
+from open_hours.idempotency import FIELD
+
+register = template.Library()
+
+
+@register.simple_tag
+def idempotency_field():
+    """
+    Hidden input with a fresh key, so a double-submitted form is only acted on once.
+    """
+    return format_html('<input type="hidden" name="{}" value="{}">', FIELD, uuid.uuid4().hex)
@@ -1,3 +1,839 @@
-from django.test import TestCase
+import asyncio
+import json
+from datetime import date, datetime, time, timedelta
+from io import StringIO
+from unittest import mock
+import cloudinary
+from asgiref.sync import sync_to_async
+from cloudinary import CloudinaryResource
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.template import Context, Template, TemplateSyntaxError
+from django.test import AsyncRequestFactory, Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from . import events, views
+from .events import EventBroker
+from bookings.models import Booking
+from .models import (
+    Activity, Session, SessionOccurrence, HistoricalSession, HistoricalBooking, ResetCheckpoint, TimetableVersion,
+    VersionSlot, IdempotencyKey, OccupancyRollup, RollupWatermark, slot_label,
+)
+from .fragments import fragment_stats, reset_fragment_stats
+from .rollups import occupancy_report, refresh_occupancy
+from .timetable import aget_snapshot, bump_version, get_snapshot
+from .versions import clone_version, activate_version
 
-# Create your tests here.
+
+# Query counts measure a view's own database work. Deployed, the cache is
+# Redis (settings.CACHES) and costs no queries; an in-process cache stands
+# in for it here.
+IN_PROCESS_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@override_settings(CACHES=IN_PROCESS_CACHE)
+class TimetableSnapshotTests(TestCase):
+    def setUp(self):
+        bump_version()
+        self.activity = Activity.objects.create(
+            activity_name="Aqua Aerobics", description="Fun", max_number=10, price=5
+        )
+        self.session = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+
+    def test_snapshot_holds_the_week(self):
+        snapshot = get_snapshot()
+        self.assertEqual(snapshot.slots["Monday"]["09:00"]["session_id"], self.session.id)
+        self.assertIsNone(snapshot.slots["Monday"]["10:00"]["activity"])
+        self.assertEqual(snapshot.data["Monday"]["09:00"]["activity_name"], "Aqua Aerobics")
+
+    def test_views_reuse_snapshot_without_queries(self):
+        get_snapshot()
+        with self.assertNumQueries(0):
+            self.client.get(reverse("home"))
+            self.client.get(reverse("timetable_data"))
+
+    def test_saving_a_session_invalidates(self):
+        first = get_snapshot()
+        self.assertIs(get_snapshot(), first)
+        with self.captureOnCommitCallbacks(execute=True):
+            Session.objects.create(activity=self.activity, session_day="Tue", start_time="10:00")
+        second = get_snapshot()
+        self.assertIsNot(second, first)
+        self.assertEqual(second.data["Tuesday"]["10:00"]["activity_name"], "Aqua Aerobics")
+
+    def test_renaming_an_activity_invalidates(self):
+        get_snapshot()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.activity.activity_name = "Swim School"
+            self.activity.save()
+        self.assertEqual(get_snapshot().data["Monday"]["09:00"]["activity_name"], "Swim School")
+
+    async def test_async_views_share_the_snapshot(self):
+        snapshot = await aget_snapshot()
+        self.assertIs(await sync_to_async(get_snapshot)(), snapshot)
+
+        response = await self.async_client.get(reverse("timetable_data"))
+        self.assertEqual(response.json()["Monday"]["09:00"]["activity_name"], "Aqua Aerobics")
+
+        # The page checks the logged-in user without touching the database on the event loop
+        admin = await sync_to_async(User.objects.create_superuser)("admin", password="pw")
+        await sync_to_async(self.async_client.force_login)(admin)
+        response = await self.async_client.get(reverse("home"))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "<th>Assign</th>")
+
+
+class EventStreamTests(TestCase):
+    async def test_subscribers_only_get_matching_events(self):
+        broker = EventBroker()
+        monday = broker.subscribe(day="Mon")
+        swim = broker.subscribe(activity=2)
+
+        broker.publish("availability", {"session": 1}, activity=1, day="Mon")
+        broker.publish("availability", {"session": 2}, activity=2, day="Tue")
+        broker.publish("timetable", {"activity": 2}, activity=2)
+
+        self.assertEqual((await monday.get(timeout=1))["data"], {"session": 1})
+        # The activity-wide timetable change has no day, so Monday still hears it
+        self.assertEqual((await monday.get(timeout=1))["event"], "timetable")
+        self.assertTrue(monday.queue.empty())
+        self.assertEqual((await swim.get(timeout=1))["data"], {"session": 2})
+        self.assertEqual((await swim.get(timeout=1))["event"], "timetable")
+
+        monday.close()
+        swim.close()
+        self.assertEqual(broker.subscriber_count, 0)
+
+    async def test_stream_view_sends_events(self):
+        request = AsyncRequestFactory().get("/events/", {"day": "Mon"})
+        response = await views.event_stream(request)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+
+        # The stream ends on its own, so the browser reconnects and the
+        # subscription is dropped even if nobody closes the response
+        with mock.patch.object(views, "STREAM_SECONDS", 0.5):
+            stream = response.streaming_content.__aiter__()
+            self.assertTrue((await anext(stream)).startswith(b"retry:"))
+            self.assertEqual(events.broker.subscriber_count, 1)
+            events.broker.publish("availability", {"session": 7}, activity=1, day="Mon")
+            chunk = await asyncio.wait_for(anext(stream), 1)
+            self.assertIn(b"event: availability", chunk)
+            self.assertIn(b'"session": 7', chunk)
+
+            rest = await asyncio.wait_for(self.drain(stream), 2)
+        self.assertEqual(rest, [b": keep-alive\n\n"])
+        self.assertEqual(events.broker.subscriber_count, 0)
+
+    async def drain(self, stream):
+        return [chunk async for chunk in stream]
+
+    def test_events_go_through_redis_when_configured(self):
+        with override_settings(EVENTS_REDIS_URL="redis://localhost:6379/0"):
+            self.assertIsInstance(events.make_broker(), events.RedisEventBroker)
+        self.assertIs(type(events.make_broker()), EventBroker)
+
+    async def test_stream_is_refused_outside_asgi(self):
+        response = await views.event_stream(RequestFactory().get("/events/"))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(events.broker.subscriber_count, 0)
+
+
+class ResetBookingsCommandTests(TestCase):
+    def setUp(self):
+        self.activity = Activity.objects.create(
+            activity_name="Aqua Aerobics", description="Fun", max_number=50, price=5
+        )
+        self.monday = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+        self.tuesday = Session.objects.create(activity=self.activity, session_day="Tue", start_time="09:00")
+        for i in range(7):
+            Booking.objects.create(
+                caravan_number=f"M{i}", first_name="Guest", last_name=str(i), email=f"m{i}@example.com",
+                session=self.monday, number_of_people=2, attended=i % 2 == 0,
+            )
+        Booking.objects.create(
+            caravan_number="T1", first_name="Guest", last_name="T", email="t@example.com",
+            session=self.tuesday, number_of_people=3,
+        )
+        self.monday_date = SessionOccurrence.next_for(self.monday).date
+
+    def run_reset(self, **options):
+        out = StringIO()
+        call_command("reset_bookings", date=self.monday_date.isoformat(), stdout=out, **options)
+        return out.getvalue()
+
+    def test_archives_only_that_weekday_in_chunks(self):
+        output = self.run_reset(chunk_size=3)
+
+        self.assertIn("7 rows", output)
+        self.assertFalse(Booking.objects.filter(session=self.monday).exists())
+        self.assertTrue(Booking.objects.filter(session=self.tuesday).exists())
+        self.monday.refresh_from_db()
+        self.assertEqual(self.monday.booked_number, 0)
+        self.assertEqual(SessionOccurrence.objects.get(session=self.monday, date=self.monday_date).booked_number, 0)
+
+        history = HistoricalSession.objects.get()
+        self.assertEqual(history.total_booked, 14)
+        self.assertEqual(history.session_date, self.monday_date)
+        self.assertEqual(history.historicalbooking_set.count(), 7)
+        self.assertEqual(history.historicalbooking_set.filter(attended=True).count(), 4)
+
+    def test_rerun_resumes_the_same_history(self):
+        history = HistoricalSession.objects.create(
+            activity=self.activity, session_day="Mon", start_time="09:00", total_booked=4
+        )
+        ResetCheckpoint.objects.create(
+            session=self.monday, reset_for=self.monday_date, historical_session=history, archived_rows=2
+        )
+
+        self.run_reset()
+        history.refresh_from_db()
+        self.assertEqual(HistoricalSession.objects.count(), 1)
+        self.assertEqual(history.total_booked, 18)
+        self.assertTrue(ResetCheckpoint.objects.get().completed)
+
+        # A completed checkpoint makes another run a no-op
+        self.assertIn("0 rows", self.run_reset())
+
+
+class OccupancyRollupTests(TestCase):
+    def setUp(self):
+        self.activity = Activity.objects.create(
+            activity_name="Aqua Aerobics", description="Fun", max_number=10, price=5
+        )
+
+    def archive(self, day, session_date, *parties, start_time="09:00"):
+        history = HistoricalSession.objects.create(
+            activity=self.activity, session_day=day, start_time=start_time, session_date=session_date,
+            total_booked=sum(people for people, _ in parties),
+        )
+        HistoricalBooking.objects.bulk_create([
+            HistoricalBooking(
+                historical_session=history, number_of_people=people, attended=attended, booking_date=timezone.now(),
+            )
+            for people, attended in parties
+        ])
+        return history
+
+    def test_refresh_reads_only_new_history(self):
+        self.archive("Tue", date(2026, 7, 7), (4, True), (2, False))
+        self.assertEqual(refresh_occupancy(), (1, 2))
+        self.assertEqual(refresh_occupancy(), (0, 0))
+
+        # Nobody booked this one, but its capacity still counts
+        self.archive("Tue", date(2026, 7, 14))
+        self.archive("Tue", date(2026, 7, 7), (1, True), start_time="10:00")
+        # Watermark, the session and booking reads, the rollup read, one insert, the mark, the watermark save
+        # and the savepoint pair
+        with self.assertNumQueries(9):
+            self.assertEqual(refresh_occupancy(), (2, 1))
+
+        rollup = OccupancyRollup.objects.get(session_date=date(2026, 7, 7), start_time=time(9))
+        self.assertEqual(
+            (rollup.sessions, rollup.bookings, rollup.headcount, rollup.attended, rollup.capacity), (1, 2, 6, 4, 10)
+        )
+        self.assertEqual(OccupancyRollup.objects.get(session_date=date(2026, 7, 14)).capacity, 10)
+        self.assertIsNotNone(RollupWatermark.objects.get().refreshed_at)
+        self.assertFalse(HistoricalSession.objects.filter(rolled_up=False).exists())
+
+    def test_runs_still_being_archived_wait_for_their_checkpoint(self):
+        # reset_bookings moves an occurrence's bookings a chunk at a time
+        history = self.archive("Tue", date(2026, 7, 7), (3, True))
+        session = Session.objects.create(activity=self.activity, session_day="Tue", start_time="09:00")
+        checkpoint = ResetCheckpoint.objects.create(
+            session=session, reset_for=date(2026, 7, 7), historical_session=history
+        )
+        # An older run committing after a newer one is still counted
+        self.archive("Wed", date(2026, 7, 8), (1, False))
+        self.assertEqual(refresh_occupancy(), (1, 1))
+
+        HistoricalBooking.objects.create(
+            historical_session=history, number_of_people=2, attended=False, booking_date=timezone.now()
+        )
+        checkpoint.completed = True
+        checkpoint.save()
+        self.assertEqual(refresh_occupancy(batch_size=1), (1, 2))
+        rollup = OccupancyRollup.objects.get(session_day="Tue")
+        self.assertEqual((rollup.sessions, rollup.bookings, rollup.headcount, rollup.attended), (1, 2, 5, 3))
+
+    def test_small_batches_give_the_same_totals(self):
+        for week in range(4):
+            self.archive("Tue", date(2026, 7, 7) + timedelta(weeks=week), (week + 1, True), (1, False))
+        self.archive("Wed", date(2026, 7, 8), (5, False))
+        # Unplaceable history is skipped but still marked rolled up
+        HistoricalSession.objects.create(activity=None, session_day="Tue", start_time="09:00")
+
+        self.assertEqual(refresh_occupancy(batch_size=2), (6, 9))
+        self.assertEqual(refresh_occupancy(), (0, 0))
+        tuesdays = OccupancyRollup.objects.filter(session_day="Tue")
+        self.assertEqual(sum(rollup.headcount for rollup in tuesdays), 14)
+        self.assertEqual(sum(rollup.sessions for rollup in tuesdays), 4)
+
+    def test_report_sums_rollups_per_weekday_and_slot(self):
+        self.archive("Tue", date(2026, 7, 7), (4, True), (2, True))
+        self.archive("Tue", date(2026, 7, 14), (2, False))
+        self.archive("Tue", date(2026, 9, 1), (10, True))
+        self.archive("Wed", date(2026, 7, 8), (1, True))
+        refresh_occupancy()
+
+        with self.assertNumQueries(1):
+            rows = occupancy_report(
+                activity=self.activity, days=["Tue"], start=date(2026, 6, 1), end=date(2026, 8, 31)
+            )
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["total_sessions"], 2)
+        self.assertEqual(rows[0]["total_headcount"], 8)
+        self.assertEqual(rows[0]["fill_rate"], 40.0)
+        self.assertEqual(rows[0]["attendance_rate"], 75.0)
+        self.assertEqual([row["session_day"] for row in occupancy_report()], ["Tue", "Wed"])
+
+        out = StringIO()
+        call_command("refresh_occupancy", stdout=out)
+        self.assertIn("0 archived sessions", out.getvalue())
+
+
+class SessionOccurrenceTests(TestCase):
+    def setUp(self):
+        self.activity = Activity.objects.create(
+            activity_name="Aqua Aerobics", description="Fun", max_number=10, price=5
+        )
+        self.monday = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+        self.friday = Session.objects.create(activity=self.activity, session_day="Fri", start_time="14:00")
+
+    def test_generate_creates_each_dated_run_once(self):
+        start = date(2026, 10, 19)  # a Monday
+        SessionOccurrence.generate(start, start + timedelta(days=13))
+        SessionOccurrence.generate(start, start + timedelta(days=13))
+        dates = sorted(SessionOccurrence.objects.values_list("date", flat=True))
+        self.assertEqual(dates, [
+            date(2026, 10, 19), date(2026, 10, 23), date(2026, 10, 26), date(2026, 10, 30),
+        ])
+
+    def test_next_for_picks_the_coming_weekday(self):
+        wednesday = timezone.make_aware(datetime(2026, 10, 21, 12))
+        self.assertEqual(SessionOccurrence.next_for(self.monday, now=wednesday).date, date(2026, 10, 26))
+        self.assertEqual(SessionOccurrence.next_for(self.friday, now=wednesday).date, date(2026, 10, 23))
+
+    def test_next_for_moves_on_once_todays_run_has_finished(self):
+        # The Friday session runs 14:00 to 15:00
+        friday = date(2026, 10, 23)
+        during = timezone.make_aware(datetime.combine(friday, time(14, 30)))
+        after = timezone.make_aware(datetime.combine(friday, time(15)))
+        self.assertEqual(SessionOccurrence.next_for(self.friday, now=during).date, friday)
+        self.assertEqual(SessionOccurrence.next_for(self.friday, now=after).date, date(2026, 10, 30))
+
+        annotated = Session.with_next_run(Session.objects.filter(pk=self.friday.pk), now=after).get()
+        self.assertEqual(annotated.next_date, date(2026, 10, 30))
+
+    def test_capacity_is_checked_per_run(self):
+        # Last week's run is full and not archived yet
+        last_week = SessionOccurrence.next_for(self.monday)
+        last_week.date -= timedelta(days=7)
+        last_week.pk = None
+        last_week.booked_number = 10
+        last_week.save()
+        Session.objects.filter(pk=self.monday.pk).update(booked_number=10)
+        self.monday.refresh_from_db()
+
+        booking = Booking.objects.create(
+            caravan_number="A1", first_name="A", last_name="B", email="a@example.com",
+            session=self.monday, number_of_people=10,
+        )
+        self.assertEqual(booking.occurrence.date, last_week.date + timedelta(days=7))
+        self.assertEqual(Session.with_next_run(Session.objects.filter(pk=self.monday.pk)).get().places_left, 0)
+        with self.assertRaises(ValidationError):
+            Booking.objects.create(
+                caravan_number="A2", first_name="A", last_name="B", email="b@example.com",
+                session=Session.objects.get(pk=self.monday.pk), number_of_people=1,
+            )
+
+    def test_bookings_count_against_their_occurrence(self):
+        booking = Booking.objects.create(
+            caravan_number="A1", first_name="A", last_name="B", email="a@example.com",
+            session=self.monday, number_of_people=3,
+        )
+        occurrence = booking.occurrence
+        occurrence.refresh_from_db()
+        self.assertEqual(occurrence.session, self.monday)
+        self.assertEqual(occurrence.booked_number, 3)
+
+        booking.delete()
+        occurrence.refresh_from_db()
+        self.assertEqual(occurrence.booked_number, 0)
+
+
+class ScheduleTimeTests(TestCase):
+    def setUp(self):
+        self.activity = Activity.objects.create(
+            activity_name="Lane Swimming", description="Laps", max_number=10, price=5,
+            duration=timedelta(minutes=90),
+        )
+        self.morning = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+        self.empty = Session.objects.create(session_day="Mon", start_time="12:00")
+
+    def test_end_time_is_stored_from_the_activity_duration(self):
+        self.morning.refresh_from_db()
+        self.assertEqual(self.morning.start_time, time(9))
+        self.assertEqual(self.morning.end_time, time(10, 30))
+        self.empty.refresh_from_db()
+        self.assertIsNone(self.empty.end_time)
+
+        self.empty.activity = self.activity
+        self.empty.save(update_fields=["activity"])
+        self.empty.refresh_from_db()
+        self.assertEqual(self.empty.end_time, time(13, 30))
+
+    def test_changing_the_duration_moves_stored_end_times(self):
+        today = timezone.localdate()
+        SessionOccurrence.generate(today, today + timedelta(days=6))
+        self.activity.duration = timedelta(minutes=45)
+        self.activity.save()
+
+        self.morning.refresh_from_db()
+        self.assertEqual(self.morning.end_time, time(9, 45))
+        self.assertEqual(
+            set(SessionOccurrence.objects.filter(session=self.morning).values_list("end_time", flat=True)),
+            {time(9, 45)},
+        )
+
+    def test_on_at_and_overlapping_use_the_stored_range(self):
+        self.assertEqual(list(Session.on_at("Mon", time(10, 15))), [self.morning])
+        self.assertFalse(Session.on_at("Mon", time(10, 30)).exists())
+        self.assertEqual(list(Session.overlapping("Mon", time(10), time(11))), [self.morning])
+        self.assertFalse(Session.overlapping("Tue", time(9), time(17)).exists())
+
+        moment = timezone.make_aware(datetime.combine(date(2026, 10, 19), time(9, 30)))
+        SessionOccurrence.generate(moment.date(), moment.date())
+        self.assertEqual([o.session for o in SessionOccurrence.on_at(moment)], [self.morning])
+
+
+@override_settings(CACHES=IN_PROCESS_CACHE)
+class TimetableQueryBudgetTests(TestCase):
+    def setUp(self):
+        self.activity = Activity.objects.create(
+            activity_name="Aqua Aerobics", description="Fun", max_number=10, price=5
+        )
+
+    def seed(self, days):
+        for day in days:
+            for time in ["09:00", "10:00", "11:00", "12:00", "13:00", "14:00", "15:00", "16:00"]:
+                Session.objects.create(activity=self.activity, session_day=day, start_time=time)
+
+    def test_rebuilding_the_timetable_costs_two_queries(self):
+        for days in (["Mon"], ["Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]):
+            self.seed(days)
+            bump_version()
+            with self.assertNumQueries(2):
+                self.client.get(reverse("home"))
+            with self.assertNumQueries(0):
+                self.client.get(reverse("home"))
+                self.client.get(reverse("timetable_data"))
+
+    def test_add_session_budget(self):
+        self.seed(["Mon"])
+        Session.objects.filter(session_day="Mon").update(activity=None)
+        admin = User.objects.create_superuser("admin", password="pw")
+        self.client.force_login(admin)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse("add_session"), {"session_day": "Mon", "start_time": "10:00", "activity": self.activity.id}
+            )
+        self.assertTrue(response.json()["success"])
+        # session + user lookups, the activity, one read of the day's slots,
+        # one bulk update, the upcoming-occurrence sync and the savepoint pair
+        self.assertEqual(len(queries), 8)
+
+
+@override_settings(CACHES=IN_PROCESS_CACHE)
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        activity = Activity.objects.create(activity_name="Aqua Aerobics", description="Fun", max_number=10, price=5)
+        Session.objects.create(activity=activity, session_day="Mon", start_time="09:00")
+        bump_version()
+
+    def test_off_by_default(self):
+        response = self.client.get(reverse("home"))
+        self.assertNotIn("Server-Timing", response)
+
+    @override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=1.0)
+    def test_reports_timings(self):
+        with self.assertLogs("ph_swimming_app.profiling", "INFO") as logs:
+            response = self.client.get(reverse("home"))
+        timing = response["Server-Timing"]
+        self.assertIn('db;dur=', timing)
+        self.assertIn('desc="2 queries"', timing)
+        self.assertIn("template;dur=", timing)
+        self.assertIn("total;dur=", timing)
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line["path"], "/")
+        self.assertEqual(line["view"], "home")
+        self.assertEqual(line["query_count"], 2)
+        self.assertIn("template_ms", line)
+
+    @override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_untouched(self):
+        response = self.client.get(reverse("home"))
+        self.assertNotIn("Server-Timing", response)
+
+
+class ScheduleBatchTests(TestCase):
+    def setUp(self):
+        self.swim = Activity.objects.create(activity_name="Swim", description="Fun", max_number=10, price=5)
+        self.long = Activity.objects.create(
+            activity_name="Gala", description="Fun", max_number=10, price=5, duration=timedelta(hours=2)
+        )
+        for day in ["Mon", "Tue"]:
+            for time in ["09:00", "10:00", "11:00", "12:00", "13:00", "14:00", "15:00", "16:00"]:
+                Session.objects.create(session_day=day, start_time=time)
+        self.client.force_login(User.objects.create_superuser("admin", password="pw"))
+
+    def post(self, placements):
+        return self.client.post(
+            reverse("schedule_batch"), json.dumps({"placements": placements}), content_type="application/json"
+        )
+
+    def assigned(self):
+        return dict(
+            ((day, slot_label(time)), name) for day, time, name in
+            Session.objects.filter(activity__isnull=False).values_list("session_day", "start_time", "activity__activity_name")
+        )
+
+    def test_needs_the_csrf_token_the_scheduler_page_sets(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(User.objects.get(username="admin"))
+        body = json.dumps({"placements": [{"session_day": "Mon", "start_time": "09:00", "activity": self.swim.id}]})
+        url = reverse("schedule_batch")
+        self.assertEqual(client.post(url, body, content_type="application/json").status_code, 403)
+
+        client.get(reverse("scheduler"))
+        token = client.cookies["csrftoken"].value
+        response = client.post(url, body, content_type="application/json", HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+
+    def test_places_many_activities_in_one_request(self):
+        occurrence = SessionOccurrence.next_for(Session.objects.get(session_day="Tue", start_time="10:00"))
+        placements = [
+            {"session_day": "Mon", "start_time": "09:00", "activity": self.swim.id},
+            {"session_day": "Mon", "start_time": "10:00", "activity": self.long.id},
+            {"session_day": "Tue", "start_time": "10:00", "activity": self.swim.id},
+        ]
+        # session + user, activities, one slot read, one bulk update, one
+        # occurrence sync and the savepoint pair
+        with self.assertNumQueries(8):
+            response = self.post(placements)
+        self.assertTrue(response.json()["success"])
+        self.assertEqual(self.assigned(), {
+            ("Mon", "09:00"): "Swim", ("Mon", "10:00"): "Gala", ("Mon", "11:00"): "Gala", ("Tue", "10:00"): "Swim",
+        })
+        occurrence.refresh_from_db()
+        self.assertEqual(occurrence.activity, self.swim)
+        self.assertEqual(occurrence.end_time, time(11))
+        self.assertEqual(Session.objects.get(session_day="Mon", start_time="10:00").end_time, time(12))
+
+    def test_a_conflict_saves_nothing(self):
+        Session.objects.filter(session_day="Tue", start_time="15:00").update(activity=self.swim)
+        response = self.post([
+            {"session_day": "Mon", "start_time": "09:00", "activity": self.long.id},
+            {"session_day": "Mon", "start_time": "10:00", "activity": self.swim.id},
+            {"session_day": "Tue", "start_time": "14:00", "activity": self.long.id},
+            {"session_day": "Tue", "start_time": "16:00", "activity": self.long.id},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([result["status"] for result in response.json()["results"]],
+                         ["success", "error", "error", "error"])
+        self.assertEqual(response.json()["results"][1]["message"], "Session at 10:00 already booked.")
+        self.assertEqual(response.json()["results"][2]["message"], "Session at 15:00 already booked.")
+        self.assertEqual(response.json()["results"][3]["message"], "Activity does not fit in remaining slots.")
+        self.assertEqual(self.assigned(), {("Tue", "15:00"): "Swim"})
+
+    def test_add_session_uses_the_same_checks(self):
+        Session.objects.filter(session_day="Mon", start_time="16:00").delete()
+        response = self.client.post(
+            reverse("add_session"), {"session_day": "Mon", "start_time": "15:00", "activity": self.swim.id}
+        )
+        self.assertTrue(response.json()["success"])
+        response = self.client.post(
+            reverse("add_session"), {"session_day": "Mon", "start_time": "15:00", "activity": self.long.id}
+        )
+        self.assertEqual(response.json()["message"], "Session slot at 16:00 does not exist.")
+
+    def test_staff_only(self):
+        self.client.force_login(User.objects.create_user("staff", password="pw", is_staff=True))
+        self.assertEqual(self.post([]).status_code, 403)
+
+    def test_replayed_batch_is_not_applied_twice(self):
+        placements = [{"session_day": "Mon", "start_time": "09:00", "activity": self.swim.id}]
+        body = json.dumps({"placements": placements})
+        first = self.client.post(reverse("schedule_batch"), body, content_type="application/json",
+                                 HTTP_IDEMPOTENCY_KEY="batch-1")
+        self.assertTrue(first.json()["success"])
+        second = self.client.post(reverse("schedule_batch"), body, content_type="application/json",
+                                  HTTP_IDEMPOTENCY_KEY="batch-1")
+        # Without the key the slot would now be taken and this would be a 400
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+
+    def test_purge_expired_keys(self):
+        IdempotencyKey.objects.create(key="old", request_hash="x", expires_at=timezone.now() - timedelta(hours=1))
+        IdempotencyKey.objects.create(key="new", request_hash="x", expires_at=timezone.now() + timedelta(hours=1))
+        call_command("purge_idempotency_keys", stdout=StringIO())
+        self.assertEqual(list(IdempotencyKey.objects.values_list("key", flat=True)), ["new"])
+
+
+class TimetableVersionTests(TestCase):
+    def setUp(self):
+        self.swim = Activity.objects.create(activity_name="Swim", description="Fun", max_number=10, price=5)
+        self.gala = Activity.objects.create(activity_name="Gala", description="Fun", max_number=10, price=5)
+        for day in ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]:
+            for time in ["09:00", "10:00", "11:00", "12:00", "13:00", "14:00", "15:00", "16:00"]:
+                Session.objects.create(session_day=day, start_time=time, activity=self.swim if time < "12:00" else None)
+        self.client.force_login(User.objects.create_superuser("admin", password="pw"))
+
+    def clone(self, name, source=None):
+        response = self.client.post(
+            reverse("clone_timetable_version"), json.dumps({"name": name, "source": source}),
+            content_type="application/json",
+        )
+        return TimetableVersion.objects.get(pk=response.json()["version"])
+
+    def test_clone_and_activate_are_constant_queries(self):
+        # insert, one read, one bulk insert and the savepoint pair
+        with self.assertNumQueries(5):
+            live = clone_version("Summer")
+        self.assertEqual(live.slots.count(), 21)
+        with self.assertNumQueries(5):
+            draft = clone_version("Winter", live)
+        VersionSlot.objects.filter(version=draft, start_time="09:00").update(activity=self.gala)
+        VersionSlot.objects.create(version=draft, session_day="Mon", start_time="16:00", activity=self.gala)
+        VersionSlot.objects.filter(version=draft, session_day="Sun").delete()
+
+        # lock, two reads, the booked-slot check, one bulk update, the
+        # occurrence sync, the two status updates and the savepoint pair
+        with self.assertNumQueries(10):
+            changed = activate_version(draft)
+        # 09:00 Mon-Sat, Mon 16:00 and the three Sunday slots
+        self.assertEqual(changed, 6 + 1 + 3)
+        draft.refresh_from_db()
+        self.assertEqual(draft.status, TimetableVersion.ACTIVE)
+        self.assertEqual(Session.objects.get(session_day="Mon", start_time="09:00").activity, self.gala)
+        self.assertEqual(Session.objects.get(session_day="Mon", start_time="16:00").activity, self.gala)
+        self.assertFalse(Session.objects.filter(session_day="Sun", activity__isnull=False).exists())
+
+        self.client.post(reverse("activate_timetable_version", args=[live.pk]))
+        draft.refresh_from_db()
+        live.refresh_from_db()
+        self.assertEqual((draft.status, live.status), (TimetableVersion.ARCHIVED, TimetableVersion.ACTIVE))
+        self.assertEqual(Session.objects.get(session_day="Mon", start_time="09:00").activity, self.swim)
+
+    def test_diff_lists_changed_slots_in_order(self):
+        draft = self.clone("Winter")
+        VersionSlot.objects.filter(version=draft, session_day="Tue", start_time="10:00").update(activity=self.gala)
+        VersionSlot.objects.filter(version=draft, session_day="Mon", start_time="11:00").delete()
+        VersionSlot.objects.create(version=draft, session_day="Mon", start_time="15:00", activity=self.gala)
+
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse("diff_timetable_version", args=[draft.pk]))
+        changes = response.json()["changes"]
+        self.assertEqual(
+            [(c["session_day"], c["start_time"], c["before"] and c["before"]["activity_name"],
+              c["after"] and c["after"]["activity_name"]) for c in changes],
+            [("Mon", "11:00", "Swim", None), ("Mon", "15:00", None, "Gala"), ("Tue", "10:00", "Swim", "Gala")],
+        )
+
+    def test_activation_moves_upcoming_occurrences(self):
+        draft = self.clone("Winter")
+        session = Session.objects.get(session_day="Wed", start_time="09:00")
+        occurrence = SessionOccurrence.next_for(session)
+        VersionSlot.objects.filter(version=draft, session_day="Wed", start_time="09:00").update(activity=self.gala)
+        self.client.post(reverse("activate_timetable_version", args=[draft.pk]))
+        occurrence.refresh_from_db()
+        self.assertEqual(occurrence.activity, self.gala)
+
+    def test_activation_is_refused_while_changed_slots_are_booked(self):
+        draft = self.clone("Winter")
+        session = Session.objects.get(session_day="Wed", start_time="09:00")
+        Booking.objects.create(
+            caravan_number="A1", first_name="A", last_name="B", email="a@example.com",
+            session=session, number_of_people=2,
+        )
+        VersionSlot.objects.filter(version=draft, session_day="Wed", start_time="09:00").update(activity=self.gala)
+
+        response = self.client.post(reverse("activate_timetable_version", args=[draft.pk]))
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("Wed 09:00", response.json()["message"])
+        draft.refresh_from_db()
+        self.assertEqual(draft.status, TimetableVersion.DRAFT)
+        self.assertEqual(Session.objects.get(pk=session.pk).activity, self.swim)
+
+        Booking.objects.get().delete()
+        response = self.client.post(reverse("activate_timetable_version", args=[draft.pk]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_admin_action_reports_booked_slots(self):
+        draft = self.clone("Winter")
+        session = Session.objects.get(session_day="Wed", start_time="09:00")
+        Booking.objects.create(
+            caravan_number="A1", first_name="A", last_name="B", email="a@example.com",
+            session=session, number_of_people=2,
+        )
+        VersionSlot.objects.filter(version=draft, session_day="Wed", start_time="09:00").update(activity=self.gala)
+
+        response = self.client.post(
+            reverse("admin:open_hours_timetableversion_changelist"),
+            {"action": "activate_selected", "_selected_action": [draft.pk]},
+            follow=True,
+        )
+        self.assertContains(response, "Wed 09:00")
+        draft.refresh_from_db()
+        self.assertEqual(draft.status, TimetableVersion.DRAFT)
+
+    def test_duplicate_name_is_a_form_error(self):
+        self.clone("Winter")
+        response = self.client.post(
+            reverse("clone_timetable_version"), json.dumps({"name": "Winter"}), content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("already exists", response.json()["message"])
+
+    def test_version_changes_need_a_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(User.objects.get(username="admin"))
+        draft = self.clone("Winter")
+        response = client.post(
+            reverse("clone_timetable_version"), json.dumps({"name": "Spring"}), content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(client.post(reverse("activate_timetable_version", args=[draft.pk])).status_code, 403)
+
+    def test_only_one_active_version(self):
+        first, second = self.clone("A"), self.clone("B")
+        self.client.post(reverse("activate_timetable_version", args=[first.pk]))
+        self.client.post(reverse("activate_timetable_version", args=[second.pk]))
+        self.assertEqual(list(TimetableVersion.objects.filter(status="active")), [second])
+
+
+@override_settings(ACTIVITY_IMAGE_URL_BUILDER="open_hours.images.local_url")
+class ActivityImageVariantTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def make_activity(self, image):
+        return Activity.objects.create(
+            activity_name="Swim", description="Fun", max_number=10, price=5, activity_image=image
+        )
+
+    def test_variants_are_stored_on_save(self):
+        activity = self.make_activity(CloudinaryResource("pool", format="png", version=3))
+        activity.refresh_from_db()
+        variants = activity.image_variants
+        self.assertEqual(variants["thumbnail"], "/media/activity_images/pool_thumb_160x160.png")
+        self.assertEqual(variants["card"], "/media/activity_images/pool_fill_480x320.png")
+        self.assertEqual(variants["hero"], "/media/activity_images/pool_fill_1600x600.png")
+        self.assertIn("/media/activity_images/pool_fill_640xauto.png 640w", variants["srcset"])
+
+    def test_unchanged_image_is_not_rebuilt(self):
+        activity = self.make_activity(CloudinaryResource("pool", format="png", version=3))
+        with self.assertNumQueries(1):
+            activity.save()
+        activity.activity_image = CloudinaryResource("lane", format="jpg", version=4)
+        with self.assertNumQueries(2):
+            activity.save()
+        self.assertEqual(activity.image_variants["public_id"], "lane")
+
+    def test_no_image_no_variants(self):
+        self.assertEqual(self.make_activity(None).image_variants, {})
+
+    def test_pages_render_without_sdk_calls(self):
+        activity = self.make_activity(CloudinaryResource("pool", format="png", version=3))
+        session = Session.objects.create(activity=activity, session_day="Mon", start_time="09:00")
+        with mock.patch.object(CloudinaryResource, "build_url", side_effect=AssertionError("SDK called")):
+            home = self.client.get(reverse("booking_home"))
+            booking = self.client.get(reverse("make_booking") + f"?session={session.pk}")
+        self.assertContains(home, 'src="/media/activity_images/pool_fill_480x320.png"')
+        self.assertContains(home, "pool_fill_1280xauto.png 1280w")
+        self.assertContains(booking, 'src="/media/activity_images/pool_fill_480x320.png"')
+
+    @override_settings(ACTIVITY_IMAGE_URL_BUILDER="open_hours.images.cloudinary_url")
+    def test_cloudinary_builder(self):
+        with mock.patch.object(cloudinary.config(), "cloud_name", "demo"):
+            activity = self.make_activity(CloudinaryResource("pool", format="png", version=3))
+        self.assertEqual(
+            activity.image_variants["card"],
+            "https://res.cloudinary.com/demo/image/upload/c_fill,f_auto,h_320,q_auto,w_480/v3/pool.png",
+        )
+
+
+@override_settings(CACHES=IN_PROCESS_CACHE)
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_fragment_stats()
+        self.activity = Activity.objects.create(activity_name="Aqua Aerobics", description="Fun", max_number=6, price=5)
+        self.session = Session.objects.create(activity=self.activity, session_day="Mon", start_time="09:00")
+
+    def test_cards_are_cached_until_an_activity_changes(self):
+        self.client.get(reverse("booking_home"))
+        # The cached cards skip the activity query
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("booking_home"))
+        self.assertContains(response, "Aqua Aerobics")
+        self.assertEqual(fragment_stats()["activity_cards"], {"hits": 1, "misses": 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.activity.activity_name = "Swim School"
+            self.activity.save()
+        response = self.client.get(reverse("booking_home"))
+        self.assertContains(response, "Swim School")
+        self.assertEqual(fragment_stats()["activity_cards"], {"hits": 1, "misses": 2})
+
+    def test_availability_follows_bookings_without_a_version_bump(self):
+        url = reverse("make_booking") + f"?session={self.session.pk}"
+        self.assertContains(self.client.get(url), "Spaces Remaining: 6")
+        Booking.objects.create(
+            caravan_number="A1", first_name="A", last_name="B", email="a@example.com",
+            session=self.session, number_of_people=2,
+        )
+        response = self.client.get(url)
+        self.assertContains(response, "Spaces Remaining: 4")
+        self.assertEqual(fragment_stats()["session_header"], {"hits": 1, "misses": 1})
+        self.assertEqual(fragment_stats()["session_availability"], {"hits": 0, "misses": 2})
+
+    def test_timetable_grid_varies_on_superuser(self):
+        self.client.get(reverse("home"))
+        self.assertNotContains(self.client.get(reverse("home")), "add-activity-btn")
+        self.client.force_login(User.objects.create_superuser("admin", password="pw"))
+        self.assertContains(self.client.get(reverse("home")), "add-activity-btn")
+        self.assertEqual(fragment_stats()["timetable_grid"], {"hits": 1, "misses": 2})
+
+    def test_a_warm_page_writes_nothing_to_the_database_cache(self):
+        database_cache = {"default": {"BACKEND": "django.core.cache.backends.db.DatabaseCache", "LOCATION": "django_cache"}}
+        with self.settings(CACHES=database_cache):
+            self.client.get(reverse("booking_home"))
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse("booking_home"))
+            self.assertEqual(fragment_stats()["activity_cards"], {"hits": 1, "misses": 1})
+        writes = [query["sql"] for query in queries if not query["sql"].startswith("SELECT")]
+        self.assertEqual(writes, [])
+
+    def test_counts_are_flushed_to_the_shared_cache(self):
+        with mock.patch("open_hours.fragments.FLUSH_SECONDS", 0):
+            self.client.get(reverse("booking_home"))
+        self.assertEqual(cache.get("open_hours:fragment_lookups:activity_cards"), 1)
+        self.assertEqual(fragment_stats()["activity_cards"], {"hits": 0, "misses": 1})
+
+    def test_stats_command(self):
+        self.client.get(reverse("booking_home"))
+        out = StringIO()
+        call_command("fragment_cache_stats", "--reset", stdout=out)
+        self.assertRegex(out.getvalue(), r"activity_cards\s+0\s+1\s+0%")
+        self.assertEqual(fragment_stats()["activity_cards"], {"hits": 0, "misses": 0})
+
+    def test_unknown_fragment_name_is_rejected(self):
+        template = Template('{% load fragments %}{% fragment_version "nope" as version %}')
+        with self.assertRaises(TemplateSyntaxError):
+            template.render(Context())
@@ -0,0 +1,126 @@
+import threading
+import time
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from .models import Session, Activity, DAY_CHOICES, SESSION_CHOICE, slot_label
+
+"""
+Shared weekly timetable snapshot.
+
+The timetable only changes when an admin edits a Session or Activity, so
+the day/slot grid is built once and reused by every timetable view until
+the version counter moves on (see signals.py). The counter lives in the
+shared cache configured in settings.CACHES, so a bump in one worker makes
+every worker rebuild.
+"""
+
+VERSION_KEY = 'open_hours:timetable_version'
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+def current_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Start from the clock so a fresh counter never reuses an old number
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+async def acurrent_version():
+    version = await cache.aget(VERSION_KEY)
+    if version is None:
+        await cache.aadd(VERSION_KEY, time.time_ns(), timeout=None)
+        version = await cache.aget(VERSION_KEY)
+    return version
+
+
+def bump_version():
+    """
+    Marks every built snapshot as stale.
+    """
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+
+
+class TimetableSnapshot:
+    """
+    Read-only view of the week built from one query.
+    """
+
+    def __init__(self, version, sessions, activities):
+        self.version = version
+        self.activities = activities
+        # Sessions in start_time order, as timetable_view lists them
+        self.sessions = sorted(sessions, key=lambda session: session.start_time)
+
+        day_map = dict(DAY_CHOICES)
+        # Keyed by day name and 'HH:MM' label, as the template and JSON use them
+        self.slots = {
+            day_name: {label: {'activity': None} for _, label in SESSION_CHOICE}
+            for _, day_name in DAY_CHOICES
+        }
+        self.data = {}
+        for session in sessions:
+            day_display = day_map.get(session.session_day, 'Unknown Day')
+            label = slot_label(session.start_time)
+            if day_display in self.slots and label in self.slots[day_display]:
+                self.slots[day_display][label] = {
+                    'activity': session.activity,
+                    'session_id': session.id
+                }
+            self.data.setdefault(day_display, {})[label] = {
+                'activity_name': session.activity.activity_name if session.activity else 'Free'
+            }
+
+    # Always built from the primary: a build from a lagging replica would
+    # be kept until the next change moved the version on.
+    @classmethod
+    def build(cls, version):
+        sessions = list(Session.objects.using(DEFAULT_DB_ALIAS).select_related('activity').order_by('id'))
+        activities = list(Activity.objects.using(DEFAULT_DB_ALIAS))
+        return cls(version, sessions, activities)
+
+    @classmethod
+    async def abuild(cls, version):
+        sessions = [
+            session async for session in
+            Session.objects.using(DEFAULT_DB_ALIAS).select_related('activity').order_by('id')
+        ]
+        activities = [activity async for activity in Activity.objects.using(DEFAULT_DB_ALIAS)]
+        return cls(version, sessions, activities)
+
+
+def get_snapshot():
+    """
+    Returns the current snapshot, rebuilding it only if the version moved.
+    """
+    global _snapshot
+    version = current_version()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    with _lock:
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = TimetableSnapshot.build(version)
+        return _snapshot
+
+
+async def aget_snapshot():
+    """
+    get_snapshot for async views. Two requests that both find the snapshot
+    stale may each rebuild it; the results are the same, so no lock is held
+    across the queries.
+    """
+    global _snapshot
+    version = await acurrent_version()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    snapshot = await TimetableSnapshot.abuild(version)
+    _snapshot = snapshot
+    return snapshot
@@ -8,9 +8,23 @@ urlpatterns = [
     # Interactive drag-and-drop session setup view
     path("add_session/", views.add_session, name='add_session'),
 
+    # Drag-and-drop scheduler, saving many placements per request
+    path("scheduler/", views.scheduler_view, name='scheduler'),
+    path('api/activities/', views.ActivityListAPIView.as_view(), name='activity_list'),
+    path('api/schedule/batch/', views.schedule_batch, name='schedule_batch'),
+
+    # Named timetable versions: stage a week, compare it and switch to it
+    path('api/timetable-versions/clone/', views.clone_timetable_version, name='clone_timetable_version'),
+    path('api/timetable-versions/<int:version_id>/diff/', views.diff_timetable_version, name='diff_timetable_version'),
+    path('api/timetable-versions/<int:version_id>/activate/', views.activate_timetable_version,
+         name='activate_timetable_version'),
+
     # Endpoint for updating sessions
     path("update_session_activity/", views.show_timetable, name='update_session_activity'),
 
     # Endpoint for fetching timetable data as JSON
-    path('api/timetable-data/', views.show_timetable, name='timetable_data'),
+    path('api/timetable-data/', views.get_timetable_data, name='timetable_data'),
+
+    # Server-Sent Events stream of live availability and timetable changes
+    path('events/', views.event_stream, name='event_stream'),
 ]
\ No newline at end of file
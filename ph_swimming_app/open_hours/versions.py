@@ -0,0 +1,140 @@
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+from .models import Session, SessionOccurrence, TimetableVersion, VersionSlot, DAY_CHOICES, end_of, slot_label
+from .timetable import bump_version
+from .events import publish_timetable_change
+
+"""
+Named timetable versions: clone, diff and activate.
+
+Every operation is a fixed handful of set-based queries whatever the size
+of the week. The live timetable stays on the Session rows, so bookings and
+public reads never look at versions; activating one rewrites the Session
+rows in a single transaction and the snapshot moves on when it commits.
+"""
+
+DAY_ORDER = {code: index for index, (code, _) in enumerate(DAY_CHOICES)}
+
+
+def _slots(version):
+    """
+    {(session_day, start_time): (activity_id, activity_name, duration)}
+    for a version, or for the live timetable when version is None.
+    """
+    if version is None:
+        rows = Session.objects.filter(activity__isnull=False)
+    else:
+        rows = VersionSlot.objects.filter(version=version)
+    return {
+        (day, start_time): (activity_id, name, duration)
+        for day, start_time, activity_id, name, duration in rows.values_list(
+            'session_day', 'start_time', 'activity_id', 'activity__activity_name', 'activity__duration'
+        )
+    }
+
+
+def clone_version(name, source=None):
+    """
+    Creates a draft copy of `source`, or of the live timetable.
+    """
+    with transaction.atomic():
+        version = TimetableVersion.objects.create(name=name)
+        VersionSlot.objects.bulk_create([
+            VersionSlot(version=version, session_day=day, start_time=start_time, activity_id=activity_id)
+            for (day, start_time), (activity_id, _, _) in _slots(source).items()
+        ])
+    return version
+
+
+def diff_versions(old, new):
+    """
+    Lists the slots that differ between two versions (None meaning the
+    live timetable), in timetable order.
+    """
+    before = _slots(old)
+    after = _slots(new)
+    changes = []
+    for key in before.keys() | after.keys():
+        if before.get(key, (None,))[0] == after.get(key, (None,))[0]:
+            continue
+        day, start_time = key
+        changes.append({
+            'session_day': day,
+            'start_time': slot_label(start_time),
+            'before': dict(zip(('id', 'activity_name'), before[key][:2])) if key in before else None,
+            'after': dict(zip(('id', 'activity_name'), after[key][:2])) if key in after else None,
+        })
+    changes.sort(key=lambda change: (
+        DAY_ORDER.get(change['session_day'], len(DAY_ORDER)), change['start_time'] or ''
+    ))
+    return changes
+
+
+def _refuse_booked_slots(sessions):
+    """
+    Raises ValidationError if any of the sessions has people booked on a
+    run from today on; those bookings would silently change activity.
+    """
+    if not sessions:
+        return
+    booked = set(
+        SessionOccurrence.objects.filter(
+            session_id__in=[session.pk for session in sessions], date__gte=timezone.localdate(), booked_number__gt=0
+        ).values_list('session__session_day', 'start_time')
+    )
+    if booked:
+        slots = sorted(booked, key=lambda slot: (DAY_ORDER.get(slot[0], len(DAY_ORDER)), slot[1]))
+        raise ValidationError(
+            'These slots have upcoming bookings; cancel or move them first: '
+            + ', '.join(f'{day} {slot_label(start_time)}' for day, start_time in slots)
+        )
+
+
+def activate_version(version):
+    """
+    Makes `version` the live timetable and archives the previous one.
+    Returns the number of Session rows that changed. Raises ValidationError,
+    changing nothing, if a slot it changes has upcoming bookings.
+    """
+    with transaction.atomic():
+        # Serialises activations: the target and the current active version
+        list(TimetableVersion.objects.select_for_update().filter(Q(pk=version.pk) | Q(status=TimetableVersion.ACTIVE)))
+        wanted = {key: (activity_id, duration) for key, (activity_id, _, duration) in _slots(version).items()}
+
+        sessions = Session.objects.select_for_update().only('id', 'session_day', 'start_time', 'activity_id', 'end_time')
+        changed = []
+        for session in sessions:
+            activity_id, duration = wanted.pop((session.session_day, session.start_time), (None, None))
+            if session.activity_id != activity_id:
+                session.activity_id = activity_id
+                session.end_time = end_of(session.start_time, duration)
+                changed.append(session)
+        _refuse_booked_slots(changed)
+        created = Session.objects.bulk_create([
+            Session(
+                session_day=day, start_time=start_time, activity_id=activity_id, end_time=end_of(start_time, duration)
+            )
+            for (day, start_time), (activity_id, duration) in wanted.items()
+        ])
+        Session.objects.bulk_update(changed, ['activity', 'end_time'])
+
+        # Upcoming dated runs follow their session, as sync_future_occurrences does
+        SessionOccurrence.objects.filter(
+            session_id__in=[session.pk for session in changed], date__gte=timezone.localdate()
+        ).update(**{
+            field: Subquery(Session.objects.filter(pk=OuterRef('session_id')).values(field)[:1])
+            for field in ('activity_id', 'end_time')
+        })
+
+        TimetableVersion.objects.filter(status=TimetableVersion.ACTIVE).exclude(pk=version.pk).update(
+            status=TimetableVersion.ARCHIVED
+        )
+        version.status = TimetableVersion.ACTIVE
+        version.activated_at = timezone.now()
+        TimetableVersion.objects.filter(pk=version.pk).update(status=version.status, activated_at=version.activated_at)
+        transaction.on_commit(bump_version)
+        transaction.on_commit(publish_timetable_change)
+
+    return len(changed) + len(created)
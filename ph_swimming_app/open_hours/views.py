@@ -1,46 +1,51 @@
-from collections import defaultdict
 from django.shortcuts import render, get_object_or_404
-from django.http import JsonResponse
+import asyncio
+import json
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.db import IntegrityError
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST
-from django.contrib.auth.decorators import login_required
-from django.views.decorators.csrf import csrf_exempt
+from django.contrib.auth.decorators import login_required, user_passes_test
+from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
 from rest_framework import generics
 from .serializers import ActivitySerializer, SessionSerializer
-from .models import Session, Activity, DAY_CHOICES, SESSION_CHOICE
-
-def show_timetable(request):
+from .models import Session, Activity, TimetableVersion, DAY_CHOICES, SESSION_CHOICE
+from .timetable import aget_snapshot
+from .scheduling import schedule_placements
+from .versions import clone_version, diff_versions, activate_version
+from .idempotency import idempotent
+from .events import broker, format_event, HEARTBEAT_SECONDS, STREAM_SECONDS
+from ph_swimming_app.db_router import use_replica
+
+async def _render(request, template_name, context):
     """
-    Renders the timetable with all slots prepopulated.
+    Renders off the event loop. The template checks the user and reads
+    cached fragments, and either may need the database.
     """
-    timetable_slots = defaultdict(lambda: defaultdict(lambda: {'activity': None}))
+    return await sync_to_async(render)(request, template_name, context)
 
-    # Prepopulate all slots
-    for day_code, day_name in DAY_CHOICES:
-        for time_str, _ in SESSION_CHOICE:
-            timetable_slots[day_name][time_str] = {'activity': None}
-
-    # Fill with existing sessions
-    existing_sessions = Session.objects.select_related('activity').all()
-    for session in existing_sessions:
-        day_display = session.get_session_day_display()
-        if day_display in timetable_slots and session.start_time in timetable_slots[day_display]:
-            timetable_slots[day_display][session.start_time] = {
-                'activity': session.activity,
-                'session_id': session.id
-            }
 
+@use_replica
+async def show_timetable(request):
+    """
+    Renders the timetable with all slots prepopulated.
+    """
+    snapshot = await aget_snapshot()
     context = {
-        'timetable_slots': timetable_slots,
-        'activities': Activity.objects.all(),
+        'timetable_slots': snapshot.slots,
+        'activities': snapshot.activities,
         'day_choices': DAY_CHOICES,
         'session_choices': SESSION_CHOICE,
     }
-    return render(request, 'timetable.html', context)
+    return await _render(request, 'timetable.html', context)
 
 
 @require_POST
 @login_required
 @csrf_exempt
+@idempotent('add_session')
 def add_session(request):
     """
     Adds or updates a session with a selected activity
@@ -48,74 +53,158 @@ def add_session(request):
     if not request.user.is_superuser:
         return JsonResponse({'success': False, 'message': 'You do not have permission.'}, status=403)
 
+    ok, results = schedule_placements([{
+        'session_day': request.POST.get('session_day'),
+        'start_time': request.POST.get('start_time'),
+        'activity': request.POST.get('activity'),
+    }])
+    if not ok:
+        return JsonResponse({'success': False, 'message': results[0]['message']}, status=400)
+    return JsonResponse({'success': True, 'message': 'Activity assigned successfully!'})
+
+
+@require_POST
+@login_required
+@idempotent('schedule_batch')
+def schedule_batch(request):
+    """
+    Places several activities at once from a JSON body
+    {"placements": [{"session_day", "start_time", "activity"}, ...]}.
+    Either every placement is saved or none is.
+    """
+    if not request.user.is_superuser:
+        return JsonResponse({'success': False, 'message': 'You do not have permission.'}, status=403)
+
+    try:
+        placements = json.loads(request.body).get('placements')
+    except (ValueError, AttributeError):
+        placements = None
+    if not isinstance(placements, list) or not placements:
+        return JsonResponse({'success': False, 'message': 'Expected a list of placements.'}, status=400)
+    if not all(isinstance(item, dict) for item in placements):
+        return JsonResponse({'success': False, 'message': 'Each placement must be an object.'}, status=400)
+
+    ok, results = schedule_placements(placements)
+    if not ok:
+        return JsonResponse(
+            {'success': False, 'message': 'No activities were assigned.', 'results': results}, status=400
+        )
+    return JsonResponse({'success': True, 'message': f'{len(results)} activities assigned.', 'results': results})
+
+
+@require_POST
+@login_required
+@idempotent('clone_timetable_version')
+def clone_timetable_version(request):
+    """
+    Creates a draft timetable version from JSON {"name", "source"}, where
+    source is a version id or null for the live timetable.
+    """
+    if not request.user.is_superuser:
+        return JsonResponse({'success': False, 'message': 'You do not have permission.'}, status=403)
+
     try:
-        session_day = request.POST.get('session_day')
-        start_time = request.POST.get('start_time')
-        activity_id = request.POST.get('activity')
-
-        if not all([session_day, start_time, activity_id]):
-            return JsonResponse({'success': False, 'message': 'All fields are required.'}, status=400)
-
-        activity = Activity.objects.get(pk=activity_id)
-
-        # Determine how many 1-hour slots are needed
-        total_minutes = activity.duration.total_seconds() / 60
-        slots_needed = int(total_minutes / 60)
-        if total_minutes % 60 != 0:
-            slots_needed += 1
-
-        # Consecutive slots
-        session_times = [time for time, _ in SESSION_CHOICE]
-        start_index = session_times.index(start_time)
-        if start_index + slots_needed > len(session_times):
-            return JsonResponse({'success': False, 'message': 'Activity does not fit in remaining slots.'}, status=400)
-
-        # Check conflicts
-        for i in range(slots_needed):
-            current_time = session_times[start_index + i]
-            try:
-                session = Session.objects.get(session_day=session_day, start_time=current_time)
-                if session.activity:
-                    return JsonResponse({'success': False, 'message': f'Session at {current_time} already booked.'}, status=400)
-            except Session.DoesNotExist:
-                return JsonResponse({'success': False, 'message': f'Session slot at {current_time} does not exist.'}, status=400)
-
-        # Assign activity
-        for i in range(slots_needed):
-            current_time = session_times[start_index + i]
-            session = Session.objects.get(session_day=session_day, start_time=current_time)
-            session.activity = activity
-            session.save()
-
-        return JsonResponse({'success': True, 'message': 'Activity assigned successfully!'})
-
-    except Activity.DoesNotExist:
-        return JsonResponse({'success': False, 'message': 'Selected activity does not exist.'}, status=400)
-    except Exception as e:
-        return JsonResponse({'success': False, 'message': f'Error: {e}'}, status=500)
-
-
-def get_timetable_data(request):
+        data = json.loads(request.body)
+        name = (data.get('name') or '').strip()
+        source_id = data.get('source')
+    except (ValueError, AttributeError):
+        return JsonResponse({'success': False, 'message': 'Expected a JSON object.'}, status=400)
+    if not name:
+        return JsonResponse({'success': False, 'message': 'A name is required.'}, status=400)
+    source = get_object_or_404(TimetableVersion, pk=source_id) if source_id else None
+
+    try:
+        version = clone_version(name, source)
+    except IntegrityError:
+        # Checked by the unique name, so two requests cannot both take it
+        return JsonResponse({'success': False, 'message': f'A version called "{name}" already exists.'}, status=400)
+    return JsonResponse({'success': True, 'message': f'Created draft "{version.name}".', 'version': version.pk})
+
+
+@login_required
+def diff_timetable_version(request, version_id):
+    """
+    Lists the slots a version would change, compared with ?against=<id>
+    or with the live timetable.
+    """
+    if not request.user.is_superuser:
+        return JsonResponse({'success': False, 'message': 'You do not have permission.'}, status=403)
+
+    version = get_object_or_404(TimetableVersion, pk=version_id)
+    against = request.GET.get('against')
+    against = get_object_or_404(TimetableVersion, pk=against) if against else None
+    return JsonResponse({'success': True, 'changes': diff_versions(against, version)})
+
+
+@require_POST
+@login_required
+@idempotent('activate_timetable_version')
+def activate_timetable_version(request, version_id):
+    """
+    Switches the live timetable to a version.
+    """
+    if not request.user.is_superuser:
+        return JsonResponse({'success': False, 'message': 'You do not have permission.'}, status=403)
+
+    version = get_object_or_404(TimetableVersion, pk=version_id)
+    try:
+        changed = activate_version(version)
+    except ValidationError as e:
+        return JsonResponse({'success': False, 'message': ' '.join(e.messages)}, status=409)
+    return JsonResponse({'success': True, 'message': f'"{version.name}" is now live ({changed} slots changed).'})
+
+
+@use_replica
+async def get_timetable_data(request):
     """
     Returns timetable as JSON for live updates.
     """
-    from collections import defaultdict
-    sessions = Session.objects.select_related('activity').all()
-    timetable_data = defaultdict(dict)
-    day_map = dict(DAY_CHOICES)
+    return JsonResponse((await aget_snapshot()).data)
 
-    for session in sessions:
-        day_display = day_map.get(session.session_day, 'Unknown Day')
-        timetable_data[day_display][session.start_time] = {
-            'activity_name': session.activity.activity_name if session.activity else 'Free'
-        }
 
-    return JsonResponse(timetable_data)
+async def event_stream(request):
+    """
+    Server-Sent Events stream of availability and timetable changes.
+    Optional ?activity=<id>&day=<code> narrow the stream. Needs the ASGI
+    entry point (asgi.py) so an open stream does not hold a worker; under
+    WSGI it answers 204, which tells EventSource not to reconnect.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    filters = {'activity': request.GET.get('activity'), 'day': request.GET.get('day')}
+
+    async def events():
+        subscription = broker.subscribe(**filters)
+        try:
+            yield "retry: 5000\n\n"
+            # Django does not stop the iterator when the client goes away, so
+            # each stream ends after a while and the browser reconnects
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + STREAM_SECONDS
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await subscription.get(timeout=min(HEARTBEAT_SECONDS, remaining))
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event(message)
+        finally:
+            subscription.close()
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 
 """
 Additional views for drag-and-drop scheduling
 """
+@user_passes_test(lambda user: user.is_superuser)
+@ensure_csrf_cookie
 def scheduler_view(request):
     """
     Renders the drag-and-drop scheduler page.
@@ -139,10 +228,7 @@ class ScheduleCreateAPIView(generics.CreateAPIView):
 
 # You'll also need a view to display the timetable on timetable.html
 # This can be a standard Django view that passes the Session objects to the template context.
-from django.shortcuts import render
-from .models import Session
-
-def timetable_view(request):
-    sessions = Session.objects.all().select_related('activity').order_by('start_time')
-    context = {'sessions': sessions}
-    return render(request, 'timetable.html', context)
\ No newline at end of file
+@use_replica
+async def timetable_view(request):
+    context = {'sessions': (await aget_snapshot()).sessions}
+    return await _render(request, 'timetable.html', context)
\ No newline at end of file
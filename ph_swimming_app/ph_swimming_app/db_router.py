@@ -0,0 +1,112 @@
+import contextvars
+import functools
+import random
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+"""
+Sends read-only views' queries to a read replica.
+
+Replicas are listed in settings.DATABASE_REPLICAS (built from
+DATABASE_REPLICA_URLS). Only views wrapped in use_replica read from one;
+everything else, and all writes, stay on the primary.
+
+A request that writes is pinned to the primary for the rest of that
+request, and ReplicaPinningMiddleware sets a short-lived cookie so the
+same browser keeps reading from the primary for REPLICA_PIN_SECONDS
+afterwards. That covers the redirect after a booking, so a guest sees
+their own booking however far behind the replica is.
+"""
+
+PIN_COOKIE = 'primary_pin'
+
+# Always read on the primary, and writing to them is not a data write that
+# should pin the browser: DatabaseCache's model, and the sessions and
+# users, which are saved after the middleware has decided on pinning, so
+# a replica could lag behind a login or a value just put in the session
+PRIMARY_APP_LABELS = {'django_cache', 'sessions', 'auth'}
+
+_state = contextvars.ContextVar('db_routing', default=None)
+
+
+class RoutingState:
+    """
+    What the router knows about the current request.
+    """
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+        self.replica_ok = False
+        self.replica = None
+
+
+def begin_request(pinned=False):
+    state = RoutingState(pinned)
+    return state, _state.set(state)
+
+
+def end_request(token):
+    _state.reset(token)
+
+
+def use_replica(view):
+    """
+    Lets a read-only view read from a replica, unless the request is
+    pinned to the primary.
+    """
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            state = _state.get()
+            if state is None:
+                return await view(request, *args, **kwargs)
+            state.replica_ok = True
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                state.replica_ok = False
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        state = _state.get()
+        if state is None:
+            return view(request, *args, **kwargs)
+        state.replica_ok = True
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            state.replica_ok = False
+    return wrapper
+
+
+class PrimaryReplicaRouter:
+    """
+    Reads go to a replica only inside a use_replica view of an unpinned
+    request; each request sticks to one replica.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+        if model._meta.app_label in PRIMARY_APP_LABELS or state is None or state.pinned or not state.replica_ok or not replicas:
+            return DEFAULT_DB_ALIAS
+        if state.replica is None:
+            state.replica = random.choice(replicas)
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None and model._meta.app_label not in PRIMARY_APP_LABELS:
+            state.pinned = True
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        aliases = {DEFAULT_DB_ALIAS, *getattr(settings, 'DATABASE_REPLICAS', [])}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
@@ -1,17 +1,30 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.http import JsonResponse
 
 class JsonErrorMiddleware:
     """
     Converts Django error responses into JSON if the path starts with /api/
-    and the response is not already JSON.
+    and the response is not already JSON. Works in both sync and async
+    chains, so async views do not get pushed onto a thread here.
     """
 
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        response = self.get_response(request)
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.to_json(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.to_json(request, await self.get_response(request))
 
+    def to_json(self, request, response):
         # Only adjust API requests
         if request.path.startswith("/bookings/api/") or request.path.startswith("/api/"):
             content_type = response.get("Content-Type", "")
@@ -0,0 +1,135 @@
+import contextvars
+import functools
+import json
+import logging
+import random
+import time
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import Template
+
+logger = logging.getLogger('ph_swimming_app.profiling')
+
+_current = contextvars.ContextVar('request_profile', default=None)
+_installed = False
+
+
+class RequestProfile:
+    """
+    Timings collected while one request is handled.
+    """
+
+    def __init__(self):
+        self.query_count = 0
+        self.query_ms = 0.0
+        self.spans = {}
+        self._depth = {}
+
+    def add(self, name, elapsed_ms):
+        self.spans[name] = self.spans.get(name, 0.0) + elapsed_ms
+
+
+def timed(name):
+    """
+    Decorator adding the wrapped call's time to the current request's
+    `name` span. Nested calls (a template including another) count once.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = _current.get()
+            if profile is None or profile._depth.get(name):
+                return func(*args, **kwargs)
+            profile._depth[name] = 1
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile._depth[name] = 0
+                profile.add(name, (time.perf_counter() - started) * 1000)
+        return wrapper
+    return decorator
+
+
+def _install_hooks():
+    """
+    Wraps template rendering and Cloudinary URL building once per process.
+    The wrappers only do work while a sampled request is being profiled.
+    """
+    global _installed
+    if _installed:
+        return
+    Template.render = timed('template')(Template.render)
+    try:
+        from cloudinary import CloudinaryResource
+    except ImportError:
+        pass
+    else:
+        CloudinaryResource.build_url = timed('cloudinary')(CloudinaryResource.build_url)
+        CloudinaryResource.image = timed('cloudinary')(CloudinaryResource.image)
+    _installed = True
+
+
+def _count_queries(execute, sql, params, many, context):
+    profile = _current.get()
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if profile is not None:
+            profile.query_count += 1
+            profile.query_ms += (time.perf_counter() - started) * 1000
+
+
+class ProfilingMiddleware:
+    """
+    Opt-in per-request profiling. When PROFILING_ENABLED is set, a
+    PROFILING_SAMPLE_RATE share of requests record wall time, ORM query
+    count and time, template render time and Cloudinary URL building time,
+    reported in a Server-Timing header and one JSON log line.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 1.0)
+        _install_hooks()
+
+    def __call__(self, request):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        profile = RequestProfile()
+        token = _current.set(profile)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(_count_queries))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        total_ms = (time.perf_counter() - started) * 1000
+
+        timings = [
+            f'db;dur={profile.query_ms:.1f};desc="{profile.query_count} queries"',
+            *(f'{name};dur={elapsed:.1f}' for name, elapsed in sorted(profile.spans.items())),
+            f'total;dur={total_ms:.1f}',
+        ]
+        response['Server-Timing'] = ', '.join(timings)
+
+        logger.info(json.dumps({
+            'event': 'request_profile',
+            'method': request.method,
+            'path': request.path,
+            'view': getattr(request.resolver_match, 'view_name', None),
+            'status': response.status_code,
+            'total_ms': round(total_ms, 1),
+            'query_count': profile.query_count,
+            'query_ms': round(profile.query_ms, 1),
+            **{f'{name}_ms': round(elapsed, 1) for name, elapsed in profile.spans.items()},
+        }))
+        return response
@@ -0,0 +1,47 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from ph_swimming_app.db_router import PIN_COOKIE, begin_request, end_request
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ReplicaPinningMiddleware:
+    """
+    Tracks each request for the database router. Writes, and requests
+    carrying the pin cookie set after a recent write, read from the primary.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.pin_seconds = getattr(settings, 'REPLICA_PIN_SECONDS', 15)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state, token = begin_request(self.pinned(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            end_request(token)
+        return self.pin(state, response)
+
+    async def __acall__(self, request):
+        state, token = begin_request(self.pinned(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            end_request(token)
+        return self.pin(state, response)
+
+    def pinned(self, request):
+        return request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES
+
+    def pin(self, state, response):
+        if state.wrote:
+            response.set_cookie(PIN_COOKIE, '1', max_age=self.pin_seconds, httponly=True, samesite='Lax')
+        return response
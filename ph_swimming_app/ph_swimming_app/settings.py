@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 from pathlib import Path
+from datetime import timedelta
 import os
 import dj_database_url
 if os.path.isfile("env.py"):
@@ -31,6 +32,38 @@ DEBUG = False
 
 ALLOWED_HOSTS = ['127.0.0.1', 'localhost', '.herokuapp.com']
 
+# Per-request profiling (Server-Timing header + log line), off unless asked for.
+# Use a low sample rate such as 0.01 in production.
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED') == '1'
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', '1.0'))
+
+# Guest booking admission control, shared by all workers (bookings/admission.py)
+BOOKING_ADMISSION = {
+    'rate': 20,
+    'burst': 40,
+    'max_queue': 500,
+}
+
+# How long a stored idempotent response is replayed for (open_hours/idempotency.py)
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+# How long a request holds its key before its response is stored
+IDEMPOTENCY_CLAIM_LEASE = timedelta(seconds=60)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'ph_swimming_app.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 
 # Application definition
 
@@ -56,12 +89,14 @@ LOGIN_REDIRECT_URL = '/'
 Account_LOGOUT_REDIRECT_URL = '/'
 
 MIDDLEWARE = [
+    'ph_swimming_app.middleware.profiling_middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'ph_swimming_app.middleware.json_error_middleware.JsonErrorMiddleware',
+    'ph_swimming_app.middleware.replica_middleware.ReplicaPinningMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -101,6 +136,47 @@ DATABASES = {
     'default': dj_database_url.parse(os.environ.get("DATABASE_URL"), conn_max_age=600, ssl_require=True)
 }
 
+# Read replicas, as a comma-separated DATABASE_REPLICA_URLS. Views marked
+# use_replica read from them (ph_swimming_app/db_router.py); a request that
+# writes, and the same browser for REPLICA_PIN_SECONDS after, reads from
+# the primary.
+DATABASE_REPLICAS = []
+for index, url in enumerate(filter(None, os.environ.get("DATABASE_REPLICA_URLS", "").split(","))):
+    alias = f'replica_{index}'
+    DATABASES[alias] = dj_database_url.parse(
+        url.strip(), conn_max_age=600, ssl_require=not url.strip().startswith('sqlite')
+    )
+    # Tests read the replica through the primary's test database
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['ph_swimming_app.db_router.PrimaryReplicaRouter']
+REPLICA_PIN_SECONDS = 15
+
+# One cache for all workers. The timetable version, cached fragments and
+# places left must be the same in every worker, or an edit in one never
+# reaches the others. Redis when REDIS_URL is set; otherwise the database
+# (the Procfile's release step runs createcachetable).
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ["REDIS_URL"],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'django_cache',
+        }
+    }
+
+# Live-update events (open_hours/events.py) go through Redis pub/sub, so
+# a change reaches the streams open on every worker. Unset, each worker
+# only reaches its own streams, which is only right for a single worker.
+EVENTS_REDIS_URL = os.environ.get("REDIS_URL")
+
 CSRF_TRUSTED_ORIGINS = ['https://*.herokuapp.com']
 
 # Password validation
@@ -143,6 +219,11 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static'), ]
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+MEDIA_URL = '/media/'
+
+# Builds the stored activity image variant URLs (open_hours/images.py)
+ACTIVITY_IMAGE_URL_BUILDER = 'open_hours.images.cloudinary_url'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -44,6 +44,7 @@ document.addEventListener('DOMContentLoaded', function() {
         } else if (data.sessions && data.sessions.length > 0) {
             data.sessions.forEach(session => {
                 const listItem = document.createElement("li");
+                listItem.dataset.sessionId = session.pk;
 
                 let bookingLinkHtml = session.is_full
                     ? '<span style="color: red; font-weight: bold;">Fully Booked</span>'
@@ -67,6 +68,24 @@ document.addEventListener('DOMContentLoaded', function() {
 });
 }
 
+        // Live availability: one shared stream instead of re-polling the API
+        if (activityCards.length > 0 && window.EventSource) {
+            const stream = new EventSource('/events/');
+            stream.addEventListener('availability', event => {
+                const session = JSON.parse(event.data);
+                const listItem = sessionList.querySelector(`li[data-session-id="${session.session}"]`);
+                if (!listItem) {
+                    return;
+                }
+                const bookingLinkHtml = session.is_full
+                    ? '<span style="color: red; font-weight: bold;">Fully Booked</span>'
+                    : `<a href="/bookings/make/?session=${session.session}">Book Now (${session.available_places} spaces left)</a>`;
+                listItem.innerHTML = `
+                    <strong>${session.session_day}</strong> at ${session.start_time} - ${bookingLinkHtml}
+                `;
+            });
+        }
+
         if (activityCards.length > 0) {
             activityCards.forEach(card => {
                 card.addEventListener('click', function() {
@@ -125,4 +144,74 @@ document.addEventListener('DOMContentLoaded', function() {
             });
         });
     }
+
+    // Batch attend / release for the session bookings page
+    const batchActions = document.getElementById('batch-actions');
+    if (batchActions) {
+        const selectAll = document.getElementById('select-all-bookings');
+        if (selectAll) {
+            selectAll.addEventListener('change', () => {
+                document.querySelectorAll('.booking-select').forEach(box => {
+                    box.checked = selectAll.checked;
+                });
+            });
+        }
+
+        batchActions.querySelectorAll('[data-batch-action]').forEach(button => {
+            button.addEventListener('click', () => {
+                const action = button.dataset.batchAction;
+                const selected = Array.from(document.querySelectorAll('.booking-select:checked'));
+                if (selected.length === 0) {
+                    return;
+                }
+
+                fetch(batchActions.dataset.batchUrl, {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                        'X-CSRFToken': batchActions.querySelector('[name=csrfmiddlewaretoken]').value
+                    },
+                    body: JSON.stringify({
+                        actions: selected.map(box => ({ booking_id: box.value, action: action }))
+                    })
+                })
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error('Network response was not ok');
+                    }
+                    return response.json();
+                })
+                .then(data => {
+                    let done = 0;
+                    data.results.forEach(result => {
+                        if (result.status !== 'success') {
+                            return;
+                        }
+                        done++;
+                        if (action === 'release') {
+                            const row = document.getElementById(`booking-${result.booking_id}`);
+                            if (row) row.remove();
+                        } else {
+                            const cell = document.querySelector(`.attended-status-${result.booking_id}`);
+                            if (cell) cell.textContent = 'Yes';
+                        }
+                    });
+                    const messageContainer = document.getElementById('message-container');
+                    if (messageContainer) {
+                        messageContainer.innerHTML = `<div class="alert alert-success">${done} of ${data.results.length} bookings updated.</div>`;
+                        setTimeout(() => {
+                            messageContainer.innerHTML = '';
+                        }, 3000);
+                    }
+                })
+                .catch(error => {
+                    console.error('Error applying batch action:', error);
+                    const messageContainer = document.getElementById('message-container');
+                    if (messageContainer) {
+                        messageContainer.innerHTML = `<div class="alert alert-danger">An error occurred: ${error.message}</div>`;
+                    }
+                });
+            });
+        });
+    }
 });
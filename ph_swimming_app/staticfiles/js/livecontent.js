@@ -32,6 +32,32 @@ document.addEventListener('DOMContentLoaded', () => {
         showDay(currentIndex);
     }
 
+    // --- Live timetable updates ---
+    // The server pushes a 'timetable' event whenever a slot changes,
+    // then the grid is refreshed from the cached timetable JSON.
+    if (dayPages.length > 0 && window.EventSource) {
+        const stream = new EventSource('/events/');
+        stream.addEventListener('timetable', () => {
+            fetch('/api/timetable-data/')
+                .then(response => response.json())
+                .then(refreshTimetable)
+                .catch(err => console.error('Timetable refresh failed:', err));
+        });
+    }
+
+    function refreshTimetable(data) {
+        document.querySelectorAll('.timetable').forEach(table => {
+            const dayName = table.closest('.day-page').querySelector('h2').textContent.trim();
+            const daySlots = data[dayName] || {};
+            table.querySelectorAll('td[data-time]').forEach(cell => {
+                const slot = daySlots[cell.dataset.time];
+                const name = slot && slot.activity_name !== 'Free' ? slot.activity_name : '-';
+                cell.textContent = name;
+                cell.closest('tr').classList.toggle('lunch-row', name === 'Lunch');
+            });
+        });
+    }
+
     // --- Modal handling ---
     const modal = document.getElementById('activityModal');
     const closeModal = document.getElementById('closeModal');
@@ -50,11 +76,15 @@ document.addEventListener('DOMContentLoaded', () => {
             if (e.target === modal) modal.style.display = 'none';
         });
 
+        // Sent with each assignment; a double-clicked Assign reuses it
+        let idempotencyKey = null;
+
         document.querySelectorAll('.add-activity-btn').forEach(btn => {
             btn.addEventListener('click', () => {
                 modal.style.display = 'block';
                 modalDay.value = btn.dataset.day;
                 modalTime.value = btn.dataset.time;
+                idempotencyKey = newIdempotencyKey();
             });
         });
         
@@ -74,11 +104,14 @@ document.addEventListener('DOMContentLoaded', () => {
                 method: 'POST',
                 headers: {
                     'X-CSRFToken': getCookie('csrftoken'),
-                    'Content-Type': 'application/x-www-form-urlencoded'
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'Idempotency-Key': idempotencyKey
                 },
                 body: `session_day=${day}&start_time=${time}&activity=${activityId}`
             })
             .then(response => {
+                // The request was answered, so the next attempt is a new one
+                idempotencyKey = newIdempotencyKey();
                 if (!response.ok) {
                     throw new Error('Network response was not ok');
                 }
@@ -114,6 +147,14 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 });
 
+// crypto.randomUUID() only exists on HTTPS pages; getRandomValues works on plain HTTP too
+function newIdempotencyKey() {
+    if (typeof crypto.randomUUID === 'function') {
+        return crypto.randomUUID();
+    }
+    return Array.from(crypto.getRandomValues(new Uint8Array(16)), byte => byte.toString(16).padStart(2, '0')).join('');
+}
+
 // --- CSRF helper function ---
 function getCookie(name) {
     let cookieValue = null;